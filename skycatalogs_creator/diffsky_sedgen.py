@@ -2,7 +2,9 @@ import galsim
 import numpy as np
 import os
 import logging
-import h5py
+import multiprocessing as mp
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from lsstdesc_diffsky import read_diffskypop_params
 from lsstdesc_diffsky.io_utils import load_healpixel
 from lsstdesc_diffsky.io_utils import load_diffsky_params
@@ -10,59 +12,93 @@ from lsstdesc_diffsky.legacy.roman_rubin_2023.dsps.data_loaders.load_ssp_data im
 from lsstdesc_diffsky.legacy.roman_rubin_2023.dsps.data_loaders.defaults import SSPDataSingleMet
 from lsstdesc_diffsky.defaults import OUTER_RIM_COSMO_PARAMS
 from lsstdesc_diffsky.sed.disk_bulge_sed_kernels_singlemet import calc_rest_sed_disk_bulge_knot_galpop
+from .utils.diffsky_sed_utils import DiffskySedWriter
+from .utils.cache_utils import get_cache_dir, array_digest, file_digest
+from .utils.cache_utils import save_npz
 all_diffskypop_params = read_diffskypop_params("roman_rubin_2023")
 
 __all__ = ['DiffskySedGenerator']
 
 
-def _calculate_sed_multi(send_conn, _redshift, _mah_params, _ms_params,
-                         _q_params, _fbulge_params, _fknot, _ssp_data,
-                         galaxy_id, n_per):
-    def _calc_seds(_redshift, _mah_params, _ms_params, _q_params,
-                   _fbulge_params, _fknot, _ssp_data, l_bnd, u_bnd, n_per):
-        # Documentation for calculation available here:
-        # https://lsstdesc-diffsky.readthedocs.io/en/latest/demo_roman_rubin_2023_seds_singlemet.html
-        args = (_redshift[l_bnd:u_bnd],
-                _mah_params[l_bnd:u_bnd],
-                _ms_params[l_bnd:u_bnd],
-                _q_params[l_bnd:u_bnd],
-                _fbulge_params[l_bnd:u_bnd],
-                _fknot[l_bnd:u_bnd],
-                _ssp_data,
-                all_diffskypop_params,
-                OUTER_RIM_COSMO_PARAMS)
-        return calc_rest_sed_disk_bulge_knot_galpop(*args)
-
-    # DSPS units
-    # import astropy.units as u
-    # _wave_type = u.angstrom
-    # _flux_type = u.Lsun / u.Hz / u.Mpc**2
-    # flux_factor = (1 * _flux_type).to(galsim.SED._fnu).value
-    flux_factor = 4.0204145742268754e-16
-
-    # Iterate over chunks of n_per
-    l_bnd = 0
-    u_bnd = len(galaxy_id)
-    out_list = []
-    lb = l_bnd
-    u = min(l_bnd + n_per, u_bnd)
-    for i in range((u_bnd-l_bnd)//n_per+1):
-        if lb == u:
-            break
-        sed_info = _calc_seds(_redshift, _mah_params, _ms_params, _q_params,
-                              _fbulge_params, _fknot, _ssp_data, lb, u, n_per)
-        # Accumulate output chunks
-        out_list.append({'galaxy_id': galaxy_id[lb:u],
-                         'bulge': sed_info.rest_sed_bulge*flux_factor,
-                         'disk': sed_info.rest_sed_diffuse_disk*flux_factor,
-                         'knots': sed_info.rest_sed_knot*flux_factor})
-        lb = u
-        u = min(lb + n_per, u_bnd)
-
-    if send_conn is not None:
-        send_conn.send(out_list)
-    else:
-        return out_list
+# DSPS units
+# import astropy.units as u
+# _wave_type = u.angstrom
+# _flux_type = u.Lsun / u.Hz / u.Mpc**2
+# flux_factor = (1 * _flux_type).to(galsim.SED._fnu).value
+_FLUX_FACTOR = 4.0204145742268754e-16
+
+# Rough estimate of memory used to compute the SED of one galaxy, in units
+# of (4-byte) values per wavelength: an (n_age, n_wave) array of weighted
+# SSP templates plus the three output components and temporaries
+_SED_EXTRA_VALUES = 6
+
+# Columns to read from diffsky files in addition to model parameters
+_MOCK_COLUMNS = ('galaxy_id',)
+
+
+def _calc_sed_chunk(_redshift, _mah_params, _ms_params, _q_params,
+                    _fbulge_params, _fknot, _ssp_data, galaxy_id):
+    '''
+    Compute SEDs for a chunk of galaxies.  Returns dict with keys
+    galaxy_id, bulge, disk, knots.  SED arrays are float32, as stored
+    '''
+    # Documentation for calculation available here:
+    # https://lsstdesc-diffsky.readthedocs.io/en/latest/demo_roman_rubin_2023_seds_singlemet.html
+    sed_info = calc_rest_sed_disk_bulge_knot_galpop(
+        _redshift, _mah_params, _ms_params, _q_params, _fbulge_params,
+        _fknot, _ssp_data, all_diffskypop_params, OUTER_RIM_COSMO_PARAMS)
+    return {'galaxy_id': galaxy_id,
+            'bulge': np.asarray(sed_info.rest_sed_bulge*_FLUX_FACTOR,
+                                dtype='f4'),
+            'disk': np.asarray(sed_info.rest_sed_diffuse_disk*_FLUX_FACTOR,
+                               dtype='f4'),
+            'knots': np.asarray(sed_info.rest_sed_knot*_FLUX_FACTOR,
+                                dtype='f4')}
+
+
+class _GalaxyIndex:
+    '''
+    Look up rows of an array of galaxy ids by binary search
+    '''
+    def __init__(self, galaxy_id):
+        self._order = np.argsort(galaxy_id, kind='stable')
+        self._sorted = galaxy_id[self._order]
+
+    def rows(self, ids):
+        '''
+        Return rows for those of ids which are present, in the order of ids
+        '''
+        ids = np.asarray(ids)
+        if len(self._sorted) == 0:
+            return np.zeros(0, dtype=np.int64)
+        pos = np.searchsorted(self._sorted, ids)
+        pos[pos == len(self._sorted)] = 0
+        found = self._sorted[pos] == ids
+        return self._order[pos[found]]
+
+
+def _sed_chunk_args(n_per, *arrays):
+    '''
+    Yield tuples of slices of arrays, n_per elements at a time
+    '''
+    n_obj = len(arrays[0])
+    for lb in range(0, n_obj, n_per):
+        yield tuple(a[lb:lb + n_per] for a in arrays)
+
+
+# Thinned SSP templates for a worker process, set by _init_sed_worker
+_worker_ssp_data = None
+
+
+def _init_sed_worker(ssp_data):
+    global _worker_ssp_data
+    _worker_ssp_data = ssp_data
+
+
+def _do_sed_chunk(args):
+    (z, mah, ms, q, fbulge, fknot, gid) = args
+    return _calc_sed_chunk(z, mah, ms, q, fbulge, fknot, _worker_ssp_data,
+                           gid)
 
 
 class DiffskySedGenerator():
@@ -83,9 +119,23 @@ class DiffskySedGenerator():
     wave_ang_max    Maximum wavelength to keep in SEDs [angstrom].
     n_per           Number of SEDs to batch calculate in diffsky.
                     Memory footprint increases nonlinearly with larger n_per
+    sed_memory_gb   If not None, memory budget for SED computation in GB.
+                    n_per is derived from it, overriding the value above
     sed_out         If SEDs are to go somewhere other than usual output_dir
     parts           Pixels for which SEDs are created (only used if auto_loop
                     is True
+    sed_layout      'per_galaxy' (default) writes one dataset per galaxy.
+                    'consolidated' writes one array of SEDs and one of
+                    galaxy ids per group of galaxies. See
+                    utils.diffsky_sed_utils
+    sed_compression h5py compression filter, e.g. 'gzip', for consolidated
+                    layout. Default is None (no compression)
+    sed_parallel    Number of processes among which chunks of n_per
+                    galaxies are distributed. Default is 1 (sequential).
+                    Output is the same either way. Call close() when
+                    done to shut down the processes
+    cache_dir       Root directory for thinned SSP templates saved between
+                    runs. If None, use utils.cache_utils.get_cache_dir()
     '''
 
     def __init__(self, logname='skyCatalogs.creator', galaxy_truth=None,
@@ -93,13 +143,21 @@ class DiffskySedGenerator():
                  auto_loop=False,
                  wave_ang_min=500, wave_ang_max=100000,
                  rel_err=0.03, n_per=100000,
-                 sed_out=None, parts=None):
+                 sed_out=None, parts=None, sed_layout='per_galaxy',
+                 sed_compression=None, sed_parallel=1,
+                 sed_memory_gb=None, cache_dir=None):
         self._output_dir = output_dir
         self._cat = sky_cat
         self._logger = logging.getLogger(logname)
         self._skip_done = skip_done
         self._n_per = n_per
         self._sed_out = sed_out
+        self._parts = parts
+        self._sed_layout = sed_layout
+        self._sed_compression = sed_compression
+        self._sed_parallel = max(1, sed_parallel)
+        self._pool = None
+        self._cache_dir = cache_dir
 
         # Setup thinned SSP templates for evaluating SED over
         # ############### Maybe temporary ############
@@ -112,6 +170,8 @@ class DiffskySedGenerator():
 
         self._get_thinned_ssp_data(rel_err, wave_ang_min, wave_ang_max,
                                    SSP_file_name=SINGLE_MET)
+        if sed_memory_gb is not None:
+            self._n_per = self._n_per_for_budget(sed_memory_gb)
         import GCRCatalogs
         gal_cat = GCRCatalogs.load_catalog(galaxy_truth)
 
@@ -140,8 +200,21 @@ class DiffskySedGenerator():
 
         Side-effects
         ------------
-        Saves thinned SSP data structure
+        Saves thinned SSP data structure.  It is also written to the cache
+        directory and read from there by later calls with the same
+        arguments and SSP file contents
         """
+        digest = array_digest(file_digest(SSP_file_name), rel_err,
+                              wave_ang_min, wave_ang_max)
+        cache_path = os.path.join(get_cache_dir('ssp', self._cache_dir),
+                                  f'thin_ssp_{digest}.npz')
+        if os.path.exists(cache_path):
+            with np.load(cache_path) as npz:
+                self.ssp_data = SSPDataSingleMet(npz['ssp_lg_age_gyr'],
+                                                 npz['ssp_wave'],
+                                                 npz['ssp_flux'])
+            self._logger.info(f'Read thinned SSP templates from {cache_path}')
+            return
 
         # Read default SSP templates
         ssp_data = load_ssp_templates_singlemet(fn=SSP_file_name)
@@ -160,67 +233,112 @@ class DiffskySedGenerator():
         # Thin template sum to target tolerance.
         sed2 = sed.thin(rel_err=rel_err, fast_search=False)
         # Create mask for which wavelengths should be kept based on thinning.
-        mask2 = np.where(np.in1d(ssp_wave_nm[mask], sed2.wave_list))[0]
+        mask2 = np.where(np.isin(ssp_wave_nm[mask], sed2.wave_list))[0]
 
         # Reconstruct thinned SSP templates and save.
         thin_ssp_wave_ang = ssp_data.ssp_wave[mask][mask2]
         thin_ssp_flux = ssp_data.ssp_flux[:, mask][:, mask2]
         self.ssp_data = SSPDataSingleMet(ssp_data.ssp_lg_age_gyr,
                                          thin_ssp_wave_ang, thin_ssp_flux)
+        save_npz(cache_path, **self.ssp_data._asdict())
+
+    def _n_per_for_budget(self, sed_memory_gb):
+        '''
+        Return number of galaxies per chunk such that chunks being computed
+        or waiting to be written fit in sed_memory_gb
+        '''
+        n_wave = len(self.ssp_data.ssp_wave)
+        n_age = len(self.ssp_data.ssp_lg_age_gyr)
+        per_galaxy = 4 * n_wave * (n_age + _SED_EXTRA_VALUES)
+        n_chunks = self._max_in_flight()
+        n_per = max(1, int(sed_memory_gb * 2**30 / (per_galaxy * n_chunks)))
+        self._logger.info(f'Using n_per = {n_per} for memory budget of {sed_memory_gb} GB')
+        return n_per
+
+    def _max_in_flight(self):
+        '''
+        Max. number of chunks computed or held at once
+        '''
+        if self._sed_parallel == 1:
+            return 1
+        return 2 * self._sed_parallel
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._logger.info(f'Starting pool of {self._sed_parallel} SED processes')
+            # jax, used to compute SEDs, is multithreaded and so is not
+            # safe to fork.  Workers get their own copy of the thinned
+            # SSP templates once, when they start
+            # ProcessPoolExecutor rather than multiprocessing.Pool so that
+            # a worker which fails to start or dies raises
+            # BrokenProcessPool instead of hanging
+            ctx = mp.get_context('spawn')
+            self._pool = ProcessPoolExecutor(self._sed_parallel,
+                                             mp_context=ctx,
+                                             initializer=_init_sed_worker,
+                                             initargs=(self.ssp_data,))
+        return self._pool
+
+    def _calculate_seds(self, redshift, mah_params, ms_params, q_params,
+                        fbulge_params, fknot, galaxy_id):
+        '''
+        Generate SED chunks (see _calc_sed_chunk) of up to n_per galaxies
+        each, in order.  A chunk is computed only when there is room for it;
+        at most _max_in_flight() chunks exist at once, including the one
+        last yielded, so callers should drop each chunk before asking
+        for the next
+        '''
+        args = _sed_chunk_args(self._n_per, redshift, mah_params, ms_params,
+                               q_params, fbulge_params, fknot, galaxy_id)
+        if self._sed_parallel == 1:
+            for a in args:
+                yield _calc_sed_chunk(*a[:6], self.ssp_data, a[6])
+            return
 
-    def _combine_col(self, cnt, col1, col2, col3):
-        if len(np.shape(col1)) > 1:
-            tmp = np.zeros((cnt, np.shape(col1)[1]), dtype=col1.dtype)
-            tmp[0:len(col1), :] = col1
-            tmp[len(col1):len(col1)+len(col2), :] = col2
-            tmp[len(col1)+len(col2):len(col1)+len(col2)+len(col3), :] = col3
-        else:
-            tmp = np.zeros(cnt, dtype=col1.dtype)
-            tmp[0:len(col1)] = col1
-            tmp[len(col1):len(col1)+len(col2)] = col2
-            tmp[len(col1)+len(col2):len(col1)+len(col2)+len(col3)] = col3
-        return tmp
+        pool = self._get_pool()
+        pending = deque()
+        try:
+            for a in args:
+                if len(pending) == self._max_in_flight() - 1:
+                    yield pending.popleft().result()
+                pending.append(pool.submit(_do_sed_chunk, a))
+            while pending:
+                yield pending.popleft().result()
+        except BaseException:
+            # Don't compute chunks no one will ask for
+            for fut in pending:
+                fut.cancel()
+            raise
+
+    def close(self):
+        '''
+        Shut down SED processes, if any
+        '''
+        if self._pool is not None:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+            self._pool = None
 
     def _load_diffsky_data(self, pixel):
-
-        hdf5_file_path = os.path.join(self._hdf5_root_dir,
-                                      self._hdf5_name_template.format(0, 1,
-                                                                      pixel))
-        mock1, metadata = load_healpixel(hdf5_file_path)
-        diffsky_param_data1 = load_diffsky_params(mock1)
-        hdf5_file_path = os.path.join(self._hdf5_root_dir,
-                                      self._hdf5_name_template.format(1, 2,
-                                                                      pixel))
-        mock2, metadata = load_healpixel(hdf5_file_path)
-        diffsky_param_data2 = load_diffsky_params(mock2)
-        hdf5_file_path = os.path.join(self._hdf5_root_dir,
-                                      self._hdf5_name_template.format(2, 3,
-                                                                      pixel))
-        mock3, metadata = load_healpixel(hdf5_file_path)
-        diffsky_param_data3 = load_diffsky_params(mock3)
-        cnt = len(mock1['galaxy_id'])+len(mock2['galaxy_id'])+len(mock3['galaxy_id'])
-        galaxy_id = self._combine_col(cnt, mock1['galaxy_id'],
-                                      mock2['galaxy_id'], mock3['galaxy_id'])
-        redshift = self._combine_col(cnt, mock1['redshift'],
-                                     mock2['redshift'], mock3['redshift'])
-        mah_params = self._combine_col(cnt, diffsky_param_data1.mah_params,
-                                       diffsky_param_data2.mah_params,
-                                       diffsky_param_data3.mah_params)
-        ms_params = self._combine_col(cnt, diffsky_param_data1.ms_params,
-                                      diffsky_param_data2.ms_params,
-                                      diffsky_param_data3.ms_params)
-        q_params = self._combine_col(cnt, diffsky_param_data1.q_params,
-                                     diffsky_param_data2.q_params,
-                                     diffsky_param_data3.q_params)
-        fbulge_params = self._combine_col(cnt,
-                                          diffsky_param_data1.fbulge_params,
-                                          diffsky_param_data2.fbulge_params,
-                                          diffsky_param_data3.fbulge_params)
-        fknot = self._combine_col(cnt, diffsky_param_data1.fknot,
-                                  diffsky_param_data2.fknot,
-                                  diffsky_param_data3.fknot)
-
-        return galaxy_id, redshift, mah_params, ms_params, q_params, fbulge_params, fknot
+        '''
+        Read the columns needed for SEDs from the files for each redshift
+        range of pixel.  Return galaxy_id, redshift, mah_params, ms_params,
+        q_params, fbulge_params, fknot, each concatenated over the files
+        '''
+        parts = []
+        for z_lo in range(3):
+            hdf5_file_path = os.path.join(
+                self._hdf5_root_dir,
+                self._hdf5_name_template.format(z_lo, z_lo + 1, pixel))
+            # Model parameters are always read; skip all other columns
+            # besides galaxy_id
+            mock, _ = load_healpixel(hdf5_file_path, patlist=_MOCK_COLUMNS)
+            params = load_diffsky_params(mock)
+            parts.append((mock['galaxy_id'], mock['redshift'],
+                          params.mah_params, params.ms_params,
+                          params.q_params, params.fbulge_params,
+                          params.fknot))
+            del mock, params
+        return tuple(np.concatenate(cols) for cols in zip(*parts))
 
     def generate_pixel(self, pixel):
         """
@@ -255,59 +373,36 @@ class DiffskySedGenerator():
                 self._logger.info(f'Skipping regeneration of {output_path}')
                 return
 
-        # Set up h5 file and metadata on wavelengths
-        f = h5py.File(output_path, 'w', libver='latest')
-        _ = f.create_dataset('meta/wave_list',
-                             maxshape=(len(self.ssp_data.ssp_wave),),
-                             shape=(len(self.ssp_data.ssp_wave),),
-                             dtype='f4',  # compression="gzip",
-                             # compression_opts=9,
-                             data=self.ssp_data.ssp_wave)
-        # Set up hdf5 groups
-        h5_groups = {}
-        for g in np.unique(diffsky_galaxy_id//100000):
-            h5_groups[g] = f.create_group('galaxy/'+str(g))
-
-        tmp_store = np.zeros((3, len(self.ssp_data.ssp_wave)), dtype='f4')
+        # Rows of diffsky data for galaxies in each collection of the
+        # matching skycatalog
+        index = _GalaxyIndex(diffsky_galaxy_id)
+        collections = object_list.get_collections()
+        cat_rows = [index.rows(c.get_native_attribute('galaxy_id'))
+                    for c in collections]
+        to_write = diffsky_galaxy_id[np.concatenate(cat_rows)]
+        writer = DiffskySedWriter(output_path, self.ssp_data.ssp_wave,
+                                  to_write, layout=self._sed_layout,
+                                  compression=self._sed_compression)
+
         # Loop over object collections to do SED calculations
         # If there are multiple row groups, each is stored in a separate
         # object collection. Need to loop over them
-        for object_coll in object_list.get_collections():
-            galaxy_id = object_coll.get_native_attribute('galaxy_id')
-            rg_written = 0
-            self._logger.debug(f'Handling range 0 to {len(galaxy_id)}')
-
-            # Limit objects to those in the matching skycatalog
-            mask = np.in1d(diffsky_galaxy_id, galaxy_id)
+        rg_written = 0
+        for rows in cat_rows:
+            self._logger.debug(f'Handling range 0 to {len(rows)}')
 
             # Build output SED data chunks
-            out_list = _calculate_sed_multi(None,
-                                            redshift[mask],
-                                            mah_params[mask],
-                                            ms_params[mask],
-                                            q_params[mask],
-                                            fbulge_params[mask],
-                                            fknot[mask],
-                                            self.ssp_data,
-                                            diffsky_galaxy_id[mask],
-                                            self._n_per)
-            ichunk = 0
-            for chunk in out_list:
-                print('chunk', ichunk)
-                ichunk += 1
-                for igid, gid in enumerate(chunk['galaxy_id']):
-                    tmp_store[0, :] = chunk['bulge'][igid, :]
-                    tmp_store[1, :] = chunk['disk'][igid, :]
-                    tmp_store[2, :] = chunk['knots'][igid, :]
-                    _ = h5_groups[gid//100000].\
-                        create_dataset(str(gid),
-                                       maxshape=(3,
-                                                 len(self.ssp_data.ssp_wave),),
-                                       shape=(3, len(self.ssp_data.ssp_wave),),
-                                       dtype='f4',  # compression="gzip",
-                                       # compression_opts=9,
-                                       data=tmp_store)
+            chunks = self._calculate_seds(redshift[rows], mah_params[rows],
+                                          ms_params[rows], q_params[rows],
+                                          fbulge_params[rows], fknot[rows],
+                                          diffsky_galaxy_id[rows])
+            # Write each chunk in bulk
+            for chunk in chunks:
+                writer.write(chunk['galaxy_id'], chunk['bulge'],
+                             chunk['disk'], chunk['knots'])
+                # Release before the next chunk is computed
+                del chunk
             rg_written += 1
 
-        f.close()
+        writer.close()
         self._logger.debug(f'SEDs for galaxies in {rg_written} row groups have been written')
@@ -2,13 +2,17 @@ import os
 import sys
 import logging
 import numpy as np
-import pandas as pd
-import pyarrow as pa
-import pyarrow.parquet as pq
-from multiprocessing import Process, Pipe
+from contextlib import contextmanager
+from concurrent.futures import TimeoutError
 from .utils.config_creator_utils import assemble_file_metadata
 from .utils.parquet_schema_utils import make_galaxy_flux_schema
 from .utils.parquet_schema_utils import make_star_flux_schema
+from .utils.arrow_utils import ParquetStreamWriter
+from .flux_worker_pool import FluxWorkerPool
+from .utils.tophat_utils import TophatFluxEngine, TOPHAT_FLUX_TOLERANCE
+from .utils.star_flux_utils import StarFluxCache, STAR_FLUX_TOLERANCE
+from .utils.diffsky_sed_utils import install_diffsky_sed_reader
+import skycatalogs.objects.base_object as base_object
 from skycatalogs.objects.base_object import LSST_BANDS
 from skycatalogs.objects.base_object import ROMAN_BANDS
 from .sso_catalog_creator import SsoFluxCatalogCreator
@@ -22,6 +26,11 @@ __all__ = ['FluxCatalogCreator']
 
 _MW_rv_constant = 3.1
 _nside_allowed = 2**np.arange(15)
+_flux_engines = ('galsim', 'fast', 'validate')
+
+# Number of objects per row group checked against per-object galsim
+# computation when flux_engine is 'validate'
+_FLUX_VALIDATE_SAMPLE = 100
 
 
 # Collection of galaxy objects for current row group, current pixel
@@ -73,8 +82,13 @@ class FluxCatalogCreator:
                  pkg_root=None,
                  skip_done=False,
                  flux_parallel=16,
+                 flux_chunk_size=1000,
                  include_roman_flux=False,
                  sso_sed=None,
+                 flux_engine='galsim',
+                 cache_dir=None,
+                 mjd_min=None,
+                 mjd_max=None,
                  run_options=None):
         """
         Store context for catalog creation
@@ -101,11 +115,30 @@ class FluxCatalogCreator:
         skip_done       If True, skip over files which already exist. Otherwise
                         (by default) overwrite with new version.
                         Output info message in either case if file exists.
-        flux_parallel   Number of processes to divide work of computing fluxes
+        flux_parallel   Number of processes to divide work of computing fluxes.
+                        If greater than 1, a pool of this many processes
+                        is started when first needed and reused for all
+                        pixels and row groups
+        flux_chunk_size Max. number of objects handed to a flux worker
+                        at a time. Smaller chunks balance load better
         # dc2             Whether to adjust values to provide input comparable
         #                to that for the DC2 run
         include_roman_flux Calculate and write Roman flux values
         sso_sed         Path to sed file to be used for all SSOs
+        flux_engine     How to compute cosmodc2 galaxy, star and sso fluxes.
+                        'galsim' (default) makes a galsim SED for each
+                        object; 'fast' computes all fluxes for a row group
+                        at once with TophatFluxEngine (galaxies),
+                        StarFluxCache (stars) or SsoFluxEngine (sso);
+                        'validate' uses fast but checks a sample against
+                        galsim
+        cache_dir       Where to keep data reused between runs, such as
+                        star SED weights. See utils.cache_utils.get_cache_dir
+        mjd_min, mjd_max  If either is not None, sso fluxes are only computed
+                        for visits with mjd_min <= mjd < mjd_max, reading
+                        only row groups which may contain such visits, and
+                        are written to a file whose name includes the window.
+                        Ignored for other object types
         run_options     The options the outer script (create_sc.py) was
                         called with
 
@@ -141,6 +174,8 @@ class FluxCatalogCreator:
 
         self._cat = open_catalog(self.get_config_file_path(),
                                  skycatalog_root=self._skycatalog_root)
+        # SED files may have either layout written by DiffskySedGenerator
+        install_diffsky_sed_reader(self._cat)
 
         # if we're not skipping existing files (that is, we're overwriting)
         # and the catalogs are partitioned by healpixel, tell skyCatalogs
@@ -154,7 +189,21 @@ class FluxCatalogCreator:
         self._logger = logging.getLogger(logname)
         self._skip_done = skip_done
         self._flux_parallel = flux_parallel
+        self._flux_pool = FluxWorkerPool(flux_parallel, self._cat,
+                                         self._logger,
+                                         chunk_size=flux_chunk_size)
         self._include_roman_flux = include_roman_flux
+        if flux_engine not in _flux_engines:
+            raise ValueError(f'Unknown flux_engine {flux_engine}')
+        self._flux_engine = flux_engine
+        self._tophat_engine = None
+        self._star_flux_cache = None
+        self._cache_dir = cache_dir
+        if mjd_min is not None and mjd_max is not None and mjd_min >= mjd_max:
+            raise ValueError(f'Empty mjd window [{mjd_min}, {mjd_max})')
+        self._mjd_window = None
+        if mjd_min is not None or mjd_max is not None:
+            self._mjd_window = (mjd_min, mjd_max)
         self._obs_sed_factory = None
         self._sso_creator = SsoFluxCatalogCreator(self)
         self._trilegal_creator = TrilegalFluxCatalogCreator(self, include_roman_flux=self._include_roman_flux)
@@ -171,18 +220,67 @@ class FluxCatalogCreator:
         None
         """
         object_type = self._object_type
-        if object_type in {'cosmodc2_galaxy', 'diffsky_galaxy'}:
-            self.create_galaxy_flux_catalog()
-        elif object_type == ('star'):
-            self.create_pointsource_flux_catalog()
-        elif object_type == ('sso'):
-            self._sso_creator.create_sso_flux_catalog()
-        elif object_type == ('trilegal'):
-            self._trilegal_creator.create_trilegal_flux_catalog()
+        try:
+            if object_type in {'cosmodc2_galaxy', 'diffsky_galaxy'}:
+                self.create_galaxy_flux_catalog()
+            elif object_type == ('star'):
+                self.create_pointsource_flux_catalog()
+            elif object_type == ('sso'):
+                self._sso_creator.create_sso_flux_catalog()
+            elif object_type == ('trilegal'):
+                self._trilegal_creator.create_trilegal_flux_catalog()
 
-        else:
-            raise NotImplementedError(
-                f'FluxCatalogCreator.create: unsupported object type {object_type}')
+            else:
+                raise NotImplementedError(
+                    f'FluxCatalogCreator.create: unsupported object type {object_type}')
+        except BaseException:
+            self._flux_pool.close(terminate=True)
+            raise
+        self._flux_pool.close()
+
+    @contextmanager
+    def _compute_in_pool(self, chunk_func, object_type, pixel, row_group,
+                         n_obj, instrument_needed, arrow_schema,
+                         extra_args=(), min_timeout=5):
+        '''
+        Compute fluxes for all objects in a row group using the worker pool.
+        Exit if any worker takes too long.  Use as a context manager; see
+        FluxWorkerPool.compute
+
+        Parameters
+        ----------
+        chunk_func         callable  computes fluxes for a slice. See
+                                     FluxWorkerPool.compute
+        object_type        string
+        pixel              int
+        row_group          int       index of the object collection
+        n_obj              int       number of objects in the row group
+        instrument_needed  list      which fluxes to compute
+        arrow_schema       pa.schema schema of flux file. Flux columns are
+                                     returned from workers in shared memory
+        extra_args         tuple     additional arguments for chunk_func
+        min_timeout        int       lower bound in seconds for the time
+                                     allowed a worker for one chunk
+
+        Yields
+        ------
+        dict of output columns
+        '''
+        n_per = self._flux_pool.chunk_size(n_obj)
+        # Expect to be able to do about 1500/minute/process
+        tm = max(int((n_per*60)/500), min_timeout)  # Give ourselves a cushion
+        self._logger.info(f'Using timeout value {tm} for chunks of {n_per} sources')
+        flux_columns = [name for name in arrow_schema.names
+                        if name.startswith(('lsst_flux_', 'roman_flux_'))]
+        try:
+            with self._flux_pool.compute(chunk_func, object_type, pixel,
+                                         row_group, n_obj, instrument_needed,
+                                         flux_columns, extra_args=extra_args,
+                                         timeout=tm) as out_dict:
+                yield out_dict
+        except TimeoutError:
+            self._logger.error(f'Flux worker timed out after {tm} sec')
+            sys.exit(1)
 
     def create_galaxy_flux_catalog(self, config_file=None):
         '''
@@ -276,7 +374,7 @@ class FluxCatalogCreator:
                                            f'galaxy_sed_{pixel}.hdf5')
             if not os.path.exists(sed_output_path):
                 if not self._sed_gen:
-                    from skycatalogs.diffsky_sedgen import DiffskySedGenerator
+                    from .diffsky_sedgen import DiffskySedGenerator
                     # Default values are ok for all the diffsky-specific
                     # parameters: include_nonLSST_flux, sed_parallel, auto_loop,
                     # wave_ang_min, wave_ang_max, rel_err, n_per
@@ -289,86 +387,161 @@ class FluxCatalogCreator:
 
                 self._sed_gen.generate_pixel(pixel)
 
-        writer = None
+        writer = ParquetStreamWriter(output_path, self._gal_flux_schema)
         _instrument_needed = []
-        rg_written = 0
         for field in self._gal_flux_needed:
             if 'lsst' in field and 'lsst' not in _instrument_needed:
                 _instrument_needed.append('lsst')
             if 'roman' in field and 'roman' not in _instrument_needed:
                 _instrument_needed.append('roman')
 
-        for object_coll in object_list.get_collections():
-            _galaxy_collection = object_coll
-            # prefetch everything we need.
-            for att in self._get_needed_flux_attrs():
-                _ = object_coll.get_native_attribute(att)
-            l_bnd = 0
+        use_engine = (self._flux_engine != 'galsim' and
+                      self._galaxy_type == 'cosmodc2')
+        for rg, object_coll in enumerate(object_list.get_collections()):
             u_bnd = len(object_coll)
+            if u_bnd == 0:
+                continue
+            self._logger.debug(f'Handling range 0 up to {u_bnd}')
+
+            if use_engine:
+                out_dict = self._compute_tophat_fluxes(object_coll,
+                                                       _instrument_needed)
+                writer.write(out_dict)
+            elif self._flux_parallel == 1:
+                # prefetch everything we need.
+                for att in self._get_needed_flux_attrs():
+                    _ = object_coll.get_native_attribute(att)
+                # For debugging call directly
+                out_dict = _do_flux_chunk(None, object_coll,
+                                          _instrument_needed, 0, u_bnd,
+                                          'galaxy_id')
+                writer.write(out_dict)
+            else:
+                with self._compute_in_pool(_do_flux_chunk,
+                                           self._object_type, pixel, rg,
+                                           u_bnd, _instrument_needed,
+                                           self._gal_flux_schema,
+                                           extra_args=('galaxy_id',)) as out_dict:
+                    writer.write(out_dict)
 
-            self._logger.debug(f'Handling range {l_bnd} up to {u_bnd}')
-
-            out_dict = {}
-            for field in self._gal_flux_needed:
-                out_dict[field] = []
+        writer.close()
+        self._logger.debug(f'# row groups written to flux file: {writer.rg_written}')
 
-            n_parallel = self._flux_parallel
+    def _get_bandpasses(self, instrument_needed):
+        '''
+        Return dict of bandpasses keyed by flux column name, in the
+        order used by _galsim_fluxes
+        '''
+        bandpasses = dict()
+        if 'lsst' in instrument_needed:
+            for band in LSST_BANDS:
+                bandpasses[f'lsst_flux_{band}'] =\
+                    base_object.lsst_bandpasses[band]
+        if 'roman' in instrument_needed:
+            for band in ROMAN_BANDS:
+                bandpasses[f'roman_flux_{band}'] =\
+                    base_object.roman_bandpasses[band]
+        return bandpasses
+
+    def _get_tophat_engine(self, instrument_needed):
+        if self._tophat_engine is None:
+            self._logger.info('Building tophat flux engine')
+            self._tophat_engine = TophatFluxEngine(
+                self._cat.observed_sed_factory('galaxy'),
+                self._cat.extinguisher,
+                self._get_bandpasses(instrument_needed))
+        return self._tophat_engine
+
+    def _compute_tophat_fluxes(self, object_coll, instrument_needed):
+        '''
+        Compute fluxes for all cosmodc2 galaxies in a collection with
+        TophatFluxEngine.  Galaxies outside the range of the engine are
+        handled one at a time as for the galsim engine
 
-            if n_parallel == 1:
-                n_per = u_bnd - l_bnd
-            else:
-                n_per = int((u_bnd - l_bnd + n_parallel)/n_parallel)
-            lb = l_bnd
-            u = min(l_bnd + n_per, u_bnd)
-            readers = []
+        Parameters
+        ----------
+        object_coll        ObjectCollection  one row group of a pixel
+        instrument_needed  list              which fluxes to compute
 
-            if n_parallel == 1:
-                # For debugging call directly
-                out_dict = _do_flux_chunk(None, _galaxy_collection,
-                                          _instrument_needed, lb, u, 'galaxy_id')
-            else:
-                # Expect to be able to do about 1500/minute/process
-                tm = max(int((n_per*60)/500), 5)  # Give ourselves a cushion
-                self._logger.info(
-                    f'Using timeout value {tm} for {n_per} sources')
-                p_list = []
-                for i in range(n_parallel):
-                    conn_rd, conn_wrt = Pipe(duplex=False)
-                    readers.append(conn_rd)
-                    proc = Process(target=_do_flux_chunk,
-                                   name=f'proc_{i}',
-                                   args=(conn_wrt, _galaxy_collection,
-                                         _instrument_needed, lb, u, 'galaxy_id'))
-                    proc.start()
-                    p_list.append(proc)
-                    lb = u
-                    u = min(lb + n_per, u_bnd)
-
-                self._logger.debug('Processes started')
-                for i in range(n_parallel):
-                    ready = readers[i].poll(tm)
-                    if not ready:
-                        self._logger.error(
-                            f'Process {i} timed out after {tm} sec')
-                        sys.exit(1)
-                    dat = readers[i].recv()
-                    for field in self._gal_flux_needed:
-                        out_dict[field] += dat[field]
-                for p in p_list:
-                    p.join()
-
-            out_df = pd.DataFrame.from_dict(out_dict)
-            out_table = pa.Table.from_pandas(out_df,
-                                             schema=self._gal_flux_schema)
-
-            if not writer:
-                writer = pq.ParquetWriter(output_path, self._gal_flux_schema)
-            writer.write_table(out_table)
-
-            rg_written += 1
+        Returns
+        -------
+        dict with keys galaxy_id and flux column names
+        '''
+        engine = self._get_tophat_engine(instrument_needed)
+
+        # Components with negligible values are skipped when making
+        # SEDs for single objects
+        sed_vals = 0.0
+        for cmp in object_coll.subcomponents:
+            vals = object_coll.get_native_attribute(f'sed_val_{cmp}')
+            used = np.max(vals, axis=1) >= np.finfo('float').resolution
+            sed_vals = sed_vals + vals * used[:, None]
+
+        gamma1 = object_coll.get_native_attribute('shear_1')
+        gamma2 = object_coll.get_native_attribute('shear_2')
+        kappa = object_coll.get_native_attribute('convergence')
+        mu = 1./((1. - kappa)**2 - (gamma1**2 + gamma2**2))
+        fluxes = engine.compute(
+            sed_vals, object_coll.get_native_attribute('redshift'),
+            object_coll.get_native_attribute('redshift_hubble'),
+            object_coll.get_native_attribute('MW_av'), mu)
+
+        out_dict = {'galaxy_id':
+                    object_coll.get_native_attribute('galaxy_id')}
+        slow = np.flatnonzero(np.isnan(fluxes[:, 0]))
+        if len(slow) > 0:
+            self._logger.debug(f'{len(slow)} galaxies out of range of tophat flux engine')
+            fluxes[slow] = self._galsim_fluxes(object_coll, slow,
+                                               instrument_needed)
+        if self._flux_engine == 'validate':
+            self._validate_fluxes(object_coll, fluxes, instrument_needed,
+                                  TOPHAT_FLUX_TOLERANCE)
+        for i, name in enumerate(engine.band_names):
+            out_dict[name] = fluxes[:, i]
+        return out_dict
 
-        writer.close()
-        self._logger.debug(f'# row groups written to flux file: {rg_written}')
+    def _galsim_fluxes(self, object_coll, ixes, instrument_needed):
+        '''
+        Return array (len(ixes), n_bands) of fluxes computed one object
+        at a time, columns in the same order as for _get_bandpasses
+        '''
+        out = []
+        for i in ixes:
+            obj = object_coll[int(i)]
+            row = []
+            if 'lsst' in instrument_needed:
+                row += obj.get_LSST_fluxes(as_dict=False)
+            if 'roman' in instrument_needed:
+                row += obj.get_roman_fluxes(as_dict=False)
+            out.append(row)
+        return np.array(out).reshape(len(ixes), -1)
+
+    def _validate_fluxes(self, object_coll, fluxes, instrument_needed,
+                         tolerance, galsim_fluxes=None):
+        '''
+        Compare fast fluxes for a random sample of objects with those
+        computed by galsim.  Raise RuntimeError if the max. relative
+        difference exceeds tolerance.  If galsim_fluxes is not None it
+        is called with the sample indices (into fluxes) in place of
+        _galsim_fluxes
+        '''
+        n_obj = len(fluxes)
+        rng = np.random.default_rng()
+        ixes = np.sort(rng.choice(n_obj, size=min(n_obj,
+                                                  _FLUX_VALIDATE_SAMPLE),
+                                  replace=False))
+        if galsim_fluxes is None:
+            ref = self._galsim_fluxes(object_coll, ixes, instrument_needed)
+        else:
+            ref = galsim_fluxes(ixes)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rel = np.abs(fluxes[ixes] - ref) / np.abs(ref)
+        rel[(ref == 0) & (fluxes[ixes] == 0)] = 0.0
+        diff = float(np.max(rel))
+        self._logger.info(f'{self._object_type} fluxes: max relative difference fast - galsim = {diff}')
+        if diff > tolerance:
+            raise RuntimeError(
+                f'Fast {self._object_type} fluxes differ from galsim by {diff}; tolerance is {tolerance}')
 
     def create_pointsource_flux_catalog(self, config_file=None):
         '''
@@ -402,8 +575,42 @@ class FluxCatalogCreator:
         for p in self._parts:
             self._logger.info(f'Starting on pixel {p}')
             self._create_pointsource_flux_pixel(p)
+            if self._star_flux_cache:
+                self._star_flux_cache.save()
             self._logger.info(f'Completed pixel {p}')
 
+    def _compute_star_fluxes(self, star_coll, instrument_needed):
+        '''
+        Compute fluxes for all stars in a collection with StarFluxCache
+
+        Parameters
+        ----------
+        star_coll          ObjectCollection  one row group of a pixel
+        instrument_needed  list              which fluxes to compute
+
+        Returns
+        -------
+        dict with keys id and flux column names
+        '''
+        if self._star_flux_cache is None:
+            self._star_flux_cache = StarFluxCache(
+                self._cat.extinguisher,
+                self._get_bandpasses(instrument_needed),
+                os.getenv('SIMS_SED_LIBRARY_DIR'),
+                cache_dir=self._cache_dir, logger=self._logger)
+        flux_cache = self._star_flux_cache
+        fluxes = flux_cache.compute(
+            star_coll.get_native_attribute('sed_filepath'),
+            star_coll.get_native_attribute('magnorm'),
+            star_coll.get_native_attribute('MW_av'))
+        if self._flux_engine == 'validate':
+            self._validate_fluxes(star_coll, fluxes, instrument_needed,
+                                  STAR_FLUX_TOLERANCE)
+        out_dict = {'id': star_coll.get_native_attribute('id')}
+        for i, name in enumerate(flux_cache.band_names):
+            out_dict[name] = fluxes[:, i]
+        return out_dict
+
     def _create_pointsource_flux_pixel(self, pixel):
         '''
         Create a parquet file for a single healpix pixel containing only
@@ -434,80 +641,38 @@ class FluxCatalogCreator:
         n_parallel = self._flux_parallel
 
         object_list = self._cat.get_object_type_by_hp(pixel, 'star')
-        writer = None
+        writer = ParquetStreamWriter(output_path, self._ps_flux_schema)
         instrument_needed = []
         for field in self._ps_flux_needed:
             if 'lsst' in field and 'lsst' not in instrument_needed:
                 instrument_needed.append('lsst')
             if 'roman' in field and 'roman' not in instrument_needed:
                 instrument_needed.append('roman')
-        rg_written = 0
-        fields_needed = self._ps_flux_schema.names
-
-        for i in range(object_list.collection_count):
-            _star_collection = object_list.get_collections()[i]
-
-            l_bnd = 0
-            u_bnd = len(_star_collection)
-
-            out_dict = {}
-            for field in fields_needed:
-                out_dict[field] = []
-
-            if n_parallel == 1:
-                n_per = u_bnd - l_bnd
-            else:
-                n_per = int((u_bnd - l_bnd + n_parallel)/n_parallel)
 
-            lb = l_bnd
-            u = min(l_bnd + n_per, u_bnd)
-            readers = []
+        for rg, star_coll in enumerate(object_list.get_collections()):
+            u_bnd = len(star_coll)
+            if u_bnd == 0:
+                continue
 
-            if n_parallel == 1:
+            if self._flux_engine != 'galsim':
+                out_dict = self._compute_star_fluxes(star_coll,
+                                                     instrument_needed)
+                writer.write(out_dict)
+            elif n_parallel == 1:
                 # For debugging call directly
-                out_dict = _do_flux_chunk(None, _star_collection,
-                                          instrument_needed, lb, u, 'id')
+                out_dict = _do_flux_chunk(None, star_coll,
+                                          instrument_needed, 0, u_bnd, 'id')
+                writer.write(out_dict)
             else:
-                # Expect to be able to do about 1500/minute/process
-
-                tm = max(int((n_per*60)/500), 5)  # Give ourselves a cushion
-                self._logger.info(f'Using timeout value {tm} for {n_per} sources')
-                p_list = []
-                for i in range(n_parallel):
-                    conn_rd, conn_wrt = Pipe(duplex=False)
-                    readers.append(conn_rd)
-                    proc = Process(target=_do_flux_chunk,
-                                   name=f'proc_{i}',
-                                   args=(conn_wrt, _star_collection,
-                                         instrument_needed, lb, u, 'id'))
-                    proc.start()
-                    p_list.append(proc)
-                    lb = u
-                    u = min(lb + n_per, u_bnd)
-
-                self._logger.debug('Processes started')
-                for i in range(n_parallel):
-                    ready = readers[i].poll(tm)
-                    if not ready:
-                        self._logger.error(f'Process {i} timed out after {tm} sec')
-                        sys.exit(1)
-                    dat = readers[i].recv()
-                    for field in fields_needed:
-                        out_dict[field] += dat[field]
-                for p in p_list:
-                    p.join()
-
-            out_df = pd.DataFrame.from_dict(out_dict)
-            out_table = pa.Table.from_pandas(out_df,
-                                             schema=self._ps_flux_schema)
-
-            if not writer:
-                writer = pq.ParquetWriter(output_path, self._ps_flux_schema)
-            writer.write_table(out_table)
-            rg_written += 1
+                with self._compute_in_pool(_do_flux_chunk, 'star',
+                                           pixel, rg, u_bnd,
+                                           instrument_needed,
+                                           self._ps_flux_schema,
+                                           extra_args=('id',)) as out_dict:
+                    writer.write(out_dict)
 
         writer.close()
-        self._logger.debug(f'# row groups written to flux file: {rg_written}')
+        self._logger.debug(f'# row groups written to flux file: {writer.rg_written}')
 
     def get_config_file_path(self):
         '''
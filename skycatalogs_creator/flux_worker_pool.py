@@ -0,0 +1,324 @@
+import os
+import time
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from contextlib import contextmanager
+import logging
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+
+"""
+Long-lived pool of processes used to compute fluxes
+"""
+
+__all__ = ['FluxWorkerPool']
+
+# Per-worker state, set by _init_flux_worker.  Worker processes are forked
+# from the flux catalog creator after the sky catalog has been opened, so
+# bandpasses and SED factories loaded by the parent are inherited and stay
+# loaded for the life of the pool.
+_sky_cat = None
+
+# Object list for the pixel most recently handled by this worker. Later
+# row groups and slices of the same pixel reuse it.
+_current_key = None
+_current_object_list = None
+
+
+def _init_flux_worker(sky_cat):
+    global _sky_cat
+    _sky_cat = sky_cat
+
+
+def _get_collection(pixel, object_type, row_group):
+    global _current_key, _current_object_list
+    key = (pixel, object_type)
+    if key != _current_key:
+        _current_object_list = None       # release previous pixel first
+        _current_object_list = _sky_cat.get_object_type_by_hp(
+            pixel, object_type)
+        _current_key = key
+    return _current_object_list.get_collections()[row_group]
+
+
+def _do_flux_task(task):
+    '''
+    Compute fluxes for a slice of a row group in a worker process
+
+    Parameters
+    ----------
+    task   tuple  (chunk_func, object_type, pixel, row_group, l_bnd, u_bnd,
+                  instrument_needed, extra_args, n_obj, shm_names)
+                  chunk_func is called as
+                  chunk_func(None, collection, instrument_needed, l_bnd, u_bnd,
+                  *extra_args)
+                  shm_names maps column name to the name of a shared memory
+                  block holding float32 values for all n_obj objects in the
+                  row group
+
+    Returns
+    -------
+    tuple (l_bnd, out_dict, pid, elapsed).  out_dict has numpy arrays for
+    columns not in shm_names, e.g. id. Values for columns in shm_names are
+    written to elements [l_bnd, u_bnd) of the shared blocks rather than
+    being returned.  elapsed is the time in seconds spent on the task
+    '''
+    start = time.monotonic()
+    (chunk_func, object_type, pixel, row_group, l_bnd, u_bnd,
+     instrument_needed, extra_args, n_obj, shm_names) = task
+    collection = _get_collection(pixel, object_type, row_group)
+    out_dict = chunk_func(None, collection, instrument_needed, l_bnd, u_bnd,
+                          *extra_args)
+    for col, shm_name in shm_names.items():
+        vals = out_dict.pop(col)
+        shm = SharedMemory(name=shm_name)
+        try:
+            dest = np.ndarray((n_obj,), dtype=np.float32, buffer=shm.buf)
+            dest[l_bnd:u_bnd] = vals
+            del dest
+        finally:
+            shm.close()
+    out_dict = {k: np.asarray(v) for k, v in out_dict.items()}
+    return l_bnd, out_dict, os.getpid(), time.monotonic() - start
+
+
+class _SharedColumns:
+    '''
+    float32 shared memory blocks, one per column, each large enough for
+    all objects in a row group
+    '''
+    def __init__(self, columns, n_obj):
+        self._n_obj = n_obj
+        self._shms = dict()
+        try:
+            for col in columns:
+                # Zero-size blocks are not allowed
+                self._shms[col] = SharedMemory(create=True,
+                                               size=max(4 * n_obj, 4))
+        except BaseException:
+            self.release()
+            raise
+
+    @property
+    def names(self):
+        return {col: shm.name for col, shm in self._shms.items()}
+
+    def arrays(self):
+        '''
+        Return dict of arrow arrays which use the shared memory as their
+        data buffers.  While any of them is referenced, release raises
+        BufferError rather than unmapping memory still in use
+        '''
+        out = dict()
+        for col, shm in self._shms.items():
+            data = pa.py_buffer(shm.buf)
+            vals = pa.Array.from_buffers(pa.float32(), self._n_obj,
+                                         [None, data])
+            # As for other columns, NaN is stored as null
+            is_nan = pc.is_nan(vals)
+            n_nan = pc.sum(is_nan).as_py() or 0
+            if n_nan > 0:
+                validity = pc.invert(is_nan).buffers()[1]
+                vals = pa.Array.from_buffers(pa.float32(), self._n_obj,
+                                             [validity, data],
+                                             null_count=n_nan)
+            out[col] = vals
+        return out
+
+    def release(self):
+        '''
+        Close and unlink the blocks.  Raise BufferError if arrays from
+        arrays() still use some of them; those stay mapped, and are
+        released by a later call once the arrays are gone
+        '''
+        busy = []
+        for col, shm in list(self._shms.items()):
+            try:
+                shm.close()
+            except BufferError:
+                busy.append(col)
+                continue
+            shm.unlink()
+            del self._shms[col]
+        if busy:
+            raise BufferError(f'Shared memory for {busy} is still in use')
+
+
+class FluxWorkerPool:
+    '''
+    Pool of worker processes created once and reused for every row group of
+    every pixel, in place of new processes per row group.  The pool is not
+    started until there is work for it.
+
+    Row groups are split into chunks which are handed out to workers as
+    they become free, so that a few expensive objects don't hold up
+    the others.
+
+    Parameters
+    ----------
+    n_proc      int              Number of worker processes
+    sky_cat     SkyCatalog       Catalog from which workers get objects
+    logger      logging.Logger
+    chunk_size  int              Max. number of objects per chunk
+    '''
+    def __init__(self, n_proc, sky_cat, logger, chunk_size=1000):
+        self._n_proc = n_proc
+        self._sky_cat = sky_cat
+        self._logger = logger
+        self._chunk_size = max(1, chunk_size)
+        self._pool = None
+
+        # Seconds spent on tasks, by worker pid, and wall time spent in
+        # compute, since the pool was started
+        self._busy = dict()
+        self._wall = 0.0
+
+    @property
+    def n_proc(self):
+        return self._n_proc
+
+    def chunk_size(self, n_obj):
+        '''
+        Number of objects per chunk for a row group of n_obj objects.
+        Small row groups are split so that every worker gets some
+        '''
+        return max(1, min(self._chunk_size, -(-n_obj // self._n_proc)))
+
+    def _start(self):
+        if self._pool is None:
+            self._logger.info(f'Starting pool of {self._n_proc} flux workers')
+            # Workers must share our resource tracker. Otherwise each
+            # starts its own, which considers shared memory the worker
+            # attached to as leaked when the worker exits
+            resource_tracker.ensure_running()
+            # If a worker dies, pending and later tasks fail with
+            # BrokenProcessPool rather than waiting forever
+            self._pool = ProcessPoolExecutor(
+                self._n_proc, mp_context=mp.get_context('fork'),
+                initializer=_init_flux_worker, initargs=(self._sky_cat,))
+        return self._pool
+
+    @contextmanager
+    def compute(self, chunk_func, object_type, pixel, row_group, n_obj,
+                instrument_needed, flux_columns, extra_args=(), timeout=None):
+        '''
+        Split a row group into chunks and compute fluxes for all of them,
+        collecting results in whatever order they complete.  Workers write
+        fluxes directly to shared memory.  Use as a context manager; output
+        columns are only valid inside the with block:
+
+            with pool.compute(...) as out_dict:
+                writer.write(out_dict)
+
+        Parameters
+        ----------
+        chunk_func         callable  module-level function with signature
+                                     (send_conn, collection, instrument_needed,
+                                     l_bnd, u_bnd, *extra_args), returning
+                                     a dict of columns when send_conn is None
+        object_type        string    as passed to get_object_type_by_hp
+        pixel              int
+        row_group          int       index of collection within object list
+        n_obj              int       number of objects in the row group
+        instrument_needed  list      passed on to chunk_func
+        flux_columns       list      names of float columns to be returned
+                                     through shared memory
+        extra_args         tuple     passed on to chunk_func
+        timeout            float     max. seconds allowed for a chunk.
+                                     The row group as a whole is allowed
+                                     this times the number of chunks per
+                                     worker
+
+        Yields
+        ------
+        dict of columns keyed by column name. Flux columns are float32
+        arrow arrays backed by shared memory; others are numpy arrays.
+        BufferError is raised on leaving the with block if references to
+        flux columns remain.
+        Raises concurrent.futures.TimeoutError if chunks don't complete
+        in time, BrokenProcessPool if a worker dies, or the exception
+        raised by chunk_func
+        '''
+        pool = self._start()
+        n_per = self.chunk_size(n_obj)
+        shared = _SharedColumns(flux_columns, n_obj)
+        out_dict = dict()
+        try:
+            start = time.monotonic()
+            tasks = [(chunk_func, object_type, pixel, row_group, l_bnd,
+                      min(l_bnd + n_per, n_obj), instrument_needed,
+                      extra_args, n_obj, shared.names)
+                     for l_bnd in range(0, n_obj, n_per)]
+            self._logger.debug(f'Dispatching {len(tasks)} chunks of row group {row_group}')
+            if timeout is not None:
+                timeout = timeout * -(-len(tasks) // self._n_proc)
+            results = dict()
+            busy = dict()
+            futures = [pool.submit(_do_flux_task, task) for task in tasks]
+            try:
+                for fut in as_completed(futures, timeout=timeout):
+                    l_bnd, chunk_dict, pid, elapsed = fut.result()
+                    results[l_bnd] = chunk_dict
+                    busy[pid] = busy.get(pid, 0.0) + elapsed
+            except BaseException:
+                for fut in futures:
+                    fut.cancel()
+                raise
+            wall = time.monotonic() - start
+            for pid, t in busy.items():
+                self._busy[pid] = self._busy.get(pid, 0.0) + t
+            self._wall += wall
+            self._log_utilization(f'Row group {row_group}', busy, wall,
+                                  logging.DEBUG)
+
+            results = [results[k] for k in sorted(results)]
+            for k in results[0]:
+                out_dict[k] = np.concatenate([r[k] for r in results])
+            del results
+            out_dict.update(shared.arrays())
+            yield out_dict
+        finally:
+            # Shared memory can't be closed while arrays refer to it
+            out_dict.clear()
+            shared.release()
+
+    def _log_utilization(self, label, busy, wall, level):
+        '''
+        Log fraction of wall time each worker spent on tasks.  If all is
+        well, all fractions should be close to 1.
+
+        Parameters
+        ----------
+        label   string  start of log message
+        busy    dict    seconds of work by worker pid
+        wall    float   elapsed time in seconds
+        level   int     logging level
+        '''
+        if wall <= 0 or not self._logger.isEnabledFor(level):
+            return
+        util = [busy.get(pid, 0.0) / wall for pid in busy]
+        # Workers which got no chunks were idle the whole time
+        util += [0.0] * (self._n_proc - len(util))
+        self._logger.log(level, f'{label}: worker utilization min {min(util):.2f} mean {np.mean(util):.2f} max {max(util):.2f} over {wall:.1f} sec')
+
+    def close(self, terminate=False):
+        '''
+        Shut down worker processes, if any.  If terminate is True, don't
+        wait for outstanding work
+        '''
+        if self._pool is None:
+            return
+        self._log_utilization('All row groups', self._busy, self._wall,
+                              logging.INFO)
+        self._busy = dict()
+        self._wall = 0.0
+        if terminate:
+            # ProcessPoolExecutor has no public way to stop a worker stuck
+            # on a task, and shutdown would wait for it
+            for proc in list((self._pool._processes or {}).values()):
+                proc.terminate()
+        self._pool.shutdown(wait=True, cancel_futures=terminate)
+        self._pool = None
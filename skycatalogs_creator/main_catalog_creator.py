@@ -1,12 +1,11 @@
 import os
 import re
 import logging
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
-import numpy.ma as ma
 import healpy
 import pandas as pd
-import pyarrow as pa
-import pyarrow.parquet as pq
 import sqlite3
 from skycatalogs.utils.sed_tools import TophatSedFactory, get_star_sed_path
 from .utils.config_creator_utils import assemble_cosmology
@@ -17,6 +16,10 @@ from .utils.star_parquet_input import _star_parquet_reader
 from .utils.parquet_schema_utils import make_galaxy_schema
 from .utils.parquet_schema_utils import make_star_schema
 from .utils.creator_utils import make_MW_extinction_av, make_MW_extinction_rv
+from .utils.creator_utils import EXTINCTION_MODES
+from .utils.tophat_utils import batch_magnorm, compare_magnorm
+from .utils.tophat_utils import MAGNORM_TOLERANCE
+from .utils.arrow_utils import ParquetStreamWriter
 from skycatalogs.objects.star_object import StarConfigFragment
 from skycatalogs.objects.galaxy_object import GalaxyConfigFragment
 from skycatalogs.objects.diffsky_object import DiffskyConfigFragment
@@ -31,6 +34,11 @@ __all__ = ['MainCatalogCreator']
 
 _MW_rv_constant = 3.1
 _nside_allowed = 2**np.arange(15)
+_magnorm_modes = ('batch', 'scalar', 'validate')
+
+# Number of objects per component checked against the scalar magnorm
+# computation when magnorm_mode is 'validate'
+_MAGNORM_VALIDATE_SAMPLE = 10000
 
 
 def _get_tophat_info(columns):
@@ -118,32 +126,69 @@ def _find_subpixels(pixel, subpixel_nside, pixel_nside=32, nest=False):
         return [healpy.nest2ring(subpixel_nside, p) for p in pixels]
 
 
-def _generate_subpixel_masks(ra, dec, subpixels, nside=32):
+def _partition_by_subpixel(ra, dec, subpixels, nside=32):
     '''
     Given ra, dec values for objects within a particular pixel and a list of
-    its subpixels for some greater value of nside, return dict with subpixel
-    ids as keys and values a mask which masks off all values except those
-    belonging to subpixel
+    its subpixels for some greater value of nside, find a permutation which
+    groups objects by subpixel and the range of permuted objects belonging
+    to each subpixel.  Within a subpixel, objects stay in input order.
 
     Parameters
     ----------
     ra         float array   ra for all objects in a particular pixel
     dec        float array   dec for all objects in a particular pixel
-    subpixels  int array     pixels for which masks should be generated
+    subpixels  int array     pixels for which ranges should be found
     nside      int           healpix ordering parameter
 
     Returns
     -------
-    masks      dict          mask for each subpixel, keyed by subpixel id
+    order      int array     permutation sorting objects by subpixel
+    slices     dict          keyed by subpixel id. Value is a slice
+                             selecting objects in the subpixel from the
+                             permuted arrays
     '''
-
-    pix_id = np.array(healpy.pixelfunc.ang2pix(nside, ra, dec, lonlat=True))
-    masks = dict()
+    pix_id = healpy.pixelfunc.ang2pix(nside, np.asarray(ra), np.asarray(dec),
+                                      lonlat=True)
+    order = np.argsort(pix_id, kind='stable')
+    sorted_id = pix_id[order]
+    slices = dict()
     for p in subpixels:
-        m = np.array(pix_id != p)
-        masks[p] = m
+        l_bnd = np.searchsorted(sorted_id, p, side='left')
+        u_bnd = np.searchsorted(sorted_id, p, side='right')
+        slices[p] = slice(l_bnd, u_bnd)
+
+    return order, slices
+
+
+# Set in each worker process by _init_pixel_worker when pixels are
+# processed in parallel
+_pixel_func = None
+_pixel_args = ()
 
-    return masks
+
+def _init_pixel_worker(pixel_func, pixel_args, setup=None):
+    '''
+    Pool initializer. Worker processes are forked so arguments are
+    inherited rather than pickled.  If it raises, the pool is broken and
+    the parent gets BrokenProcessPool rather than waiting for workers
+
+    Parameters
+    ----------
+    pixel_func   callable   called as pixel_func(pixel, *pixel_args)
+    pixel_args   tuple      additional arguments for pixel_func
+    setup        callable   If not None, called with no arguments before any
+                            pixels are processed, e.g. to acquire resources
+                            which must be owned by the worker
+    '''
+    global _pixel_func, _pixel_args
+    _pixel_func = pixel_func
+    _pixel_args = pixel_args
+    if setup:
+        setup()
+
+
+def _do_pixel(pixel):
+    return pixel, _pixel_func(pixel, *_pixel_args)
 
 
 class MainCatalogCreator:
@@ -155,8 +200,10 @@ class MainCatalogCreator:
                  knots=True, logname='skyCatalogs.creator',
                  pkg_root=None, skip_done=False,
                  nside=32, stride=1000000, dc2=False,
-                 star_input_fmt='sqlite', sso_sed=None,
-                 run_options=None):
+                 star_input_fmt='sqlite', sso_sed=None, sso_shard=False,
+                 magnorm_mode='batch', pixel_parallel=1,
+                 extinction_mode='exact', extinction_nside=1024,
+                 cache_dir=None, run_options=None):
         """
         Store context for catalog creation
 
@@ -193,6 +240,25 @@ class MainCatalogCreator:
         dc2             Whether to adjust values to provide input comparable
                         to that for the DC2 run
         star_input_fmt  May be either 'sqlite' or 'parquet'
+        sso_shard       If True, sso main files are made by reading each
+                        input db file once, routing rows by healpixel,
+                        rather than querying once per healpixel
+        magnorm_mode    How to compute tophat magnorm for cosmodc2 galaxies.
+                        'batch' (default) computes all values in a single
+                        vectorized pass; 'scalar' calls
+                        TophatSedFactory.magnorm once per object; 'validate'
+                        uses batch but checks a sample against scalar
+        pixel_parallel  Number of processes among which pixels are
+                        distributed. Each has its own input catalog handle.
+                        Default is 1 (sequential)
+        extinction_mode 'exact' (default) interpolates in the SFD dust map
+                        for MW_av. 'healpix' uses the value at the center of
+                        the HEALPix pixel (of extinction_nside) containing
+                        the object; faster but less precise
+        extinction_nside  nside of E(B-V) map for extinction_mode 'healpix'
+        cache_dir       Root directory for data saved between runs, such as
+                        the E(B-V) HEALPix map, the UW star pixel to file
+                        map and the sso db file inventory
         run_options     The options the outer script (create_main.py) was
                         called with
 
@@ -235,6 +301,7 @@ class MainCatalogCreator:
         self._skip_done = skip_done
         self._nside = nside
         self._dc2 = dc2
+        self._sso_shard = sso_shard
         self._obs_sed_factory = None
         if object_type == 'sso':
             self._sso_creator = SsoMainCatalogCreator(self)
@@ -242,6 +309,15 @@ class MainCatalogCreator:
             self._trilegal_creator = TrilegalMainCatalogCreator(self)
         self._run_options = run_options
         self._tophat_sed_bins = None
+        if magnorm_mode not in _magnorm_modes:
+            raise ValueError(f'Unknown magnorm_mode {magnorm_mode}')
+        self._magnorm_mode = magnorm_mode
+        self._pixel_parallel = max(1, pixel_parallel)
+        if extinction_mode not in EXTINCTION_MODES:
+            raise ValueError(f'Unknown extinction_mode {extinction_mode}')
+        self._extinction_mode = extinction_mode
+        self._extinction_nside = extinction_nside
+        self._cache_dir = cache_dir
 
         self._config_writer = ConfigWriter(self._skycatalog_root,
                                            self._catalog_dir,
@@ -249,7 +325,7 @@ class MainCatalogCreator:
                                            not self._skip_done,
                                            self._logname)
 
-    def _make_tophat_columns(self, dat, names, cmp):
+    def _make_tophat_columns(self, dat, names, cmp, magnorm_mode='batch'):
         '''
         Create columns sed_val_cmp, cmp_magnorm where cmp is one of "disk",
         "bulge", "knots"
@@ -260,15 +336,30 @@ class MainCatalogCreator:
                      everything in names plus entry for redshiftHubble
         names        Names of SED columns for this component
         cmp          Component name
+        magnorm_mode One of 'batch', 'scalar', 'validate'
 
         Returns
         -------
         Add keys  sed_val_cmp, cmp_magnorm to input dat. Then return dat.
+        Value for sed_val_cmp is a 2-d numpy array, one row per object
         '''
-        sed_vals = (np.array([dat[k] for k in names]).T).tolist()
-        dat['sed_val_' + cmp] = sed_vals
-        dat[cmp + '_magnorm'] = [self._obs_sed_factory.magnorm(s, z) for (s, z)
-                                 in zip(sed_vals, dat['redshiftHubble'])]
+        sed_block = np.array([dat[k] for k in names]).T
+        z_H = dat['redshiftHubble']
+        if magnorm_mode == 'scalar':
+            magnorm = [self._obs_sed_factory.magnorm(s, z) for (s, z)
+                       in zip(sed_block, z_H)]
+        else:
+            magnorm = batch_magnorm(self._obs_sed_factory, sed_block, z_H)
+            if magnorm_mode == 'validate':
+                diff = compare_magnorm(self._obs_sed_factory, sed_block, z_H,
+                                       magnorm=magnorm,
+                                       n_sample=_MAGNORM_VALIDATE_SAMPLE)
+                self._logger.info(f'{cmp} magnorm: max |batch - scalar| = {diff}')
+                if diff > MAGNORM_TOLERANCE:
+                    raise RuntimeError(
+                        f'Batch {cmp} magnorm differs from scalar by {diff}; tolerance is {MAGNORM_TOLERANCE}')
+        dat['sed_val_' + cmp] = sed_block
+        dat[cmp + '_magnorm'] = magnorm
         for k in names:
             del dat[k]
         return dat
@@ -295,31 +386,76 @@ class MainCatalogCreator:
             raise NotImplementedError(
                 f'MainCatalogCreator.create: unsupported object type {object_type}')
 
-    def create_galaxy_catalog(self):
-        """
-        Create the 'main' galaxy catalog, including everything except
-        fluxes
+    def _process_pixels(self, pixel_func, pixel_args=(), setup=None,
+                        pixels=None):
+        '''
+        Call pixel_func(p, *pixel_args) for each pixel p, either in this
+        process or, if pixel_parallel > 1, in a pool of forked worker
+        processes.  Only the parent writes configs, so pixel_func should
+        just write data files.
+
+        Parameters
+        ----------
+        pixel_func   callable   Processes a single pixel
+        pixel_args   tuple      Additional arguments for pixel_func
+        setup        callable   Run once in each worker before processing
+                                any pixels. Not run when processing is
+                                sequential
+        pixels       list       Pixels to process. Defaults to self._parts
 
         Returns
         -------
-        None
-
-        """
-        _cosmo_cat = 'cosmodc2_v1.1.4_image_addon_knots'
-        _diffsky_cat = 'roman_rubin_2023_v1.1.2_elais'
+        List of values returned by pixel_func, in order of completion.
+        An exception raised by pixel_func or setup in a worker, or the death
+        of a worker, is raised here and remaining pixels are abandoned
+        '''
+        if pixels is None:
+            pixels = self._parts
+        n_proc = min(self._pixel_parallel, len(pixels))
+        results = []
+        if n_proc <= 1:
+            for p in pixels:
+                self._logger.info(f'Starting on pixel {p}')
+                results.append(pixel_func(p, *pixel_args))
+                self._logger.info(f'Completed pixel {p}')
+            return results
+
+        self._logger.info(f'Distributing {len(pixels)} pixels among {n_proc} processes')
+        ctx = mp.get_context('fork')
+        with ProcessPoolExecutor(n_proc, mp_context=ctx,
+                                 initializer=_init_pixel_worker,
+                                 initargs=(pixel_func, pixel_args,
+                                           setup)) as pool:
+            futures = [pool.submit(_do_pixel, p) for p in pixels]
+            try:
+                for fut in as_completed(futures):
+                    p, result = fut.result()
+                    self._logger.info(f'Completed pixel {p}')
+                    results.append(result)
+            except BaseException:
+                for fut in futures:
+                    fut.cancel()
+                raise
+        return results
+
+    def _load_worker_galaxy_catalog(self):
+        self._gal_cat = self._load_galaxy_catalog()
+
+    def _load_galaxy_catalog(self):
+        '''
+        Load the galaxy truth catalog named by self._truth. Called once by
+        the parent and once by each worker process when pixels are
+        processed in parallel, since catalog handles may not be shared
+        across processes
 
+        Returns
+        -------
+        GCRCatalogs catalog object
+        '''
         import GCRCatalogs
 
-        if self._object_type == 'cosmodc2_galaxy':
-            self._galaxy_type = 'cosmodc2'
-            if self._truth is None:
-                self._truth = _cosmo_cat
-        else:    # only other possibility is diffsky
-            self._galaxy_type = 'diffsky'
-            if self._truth is None:
-                self._truth = _diffsky_cat
         if self._truth != 'GCR_CI':
-            gal_cat = GCRCatalogs.load_catalog(self._truth)
+            return GCRCatalogs.load_catalog(self._truth)
         else:
             # Special handling for CI.  The config file is not
             # part of the normal GCRCatalogs collection and the
@@ -336,9 +472,32 @@ class MainCatalogCreator:
                 # time we have to do resolution of root dir by hand.
                 config_register = GCRCatalogs.ConfigSource.get_config_source()
                 resolved = config_register.resolve_root_dir(config_dict)
-                gal_cat = GCRCatalogs.load_catalog_from_config_dict(resolved)
+                return GCRCatalogs.load_catalog_from_config_dict(resolved)
             else:
                 raise NotImplementedError(f'No CI for {self._galaxy_type} galaxies')
+
+    def create_galaxy_catalog(self):
+        """
+        Create the 'main' galaxy catalog, including everything except
+        fluxes
+
+        Returns
+        -------
+        None
+
+        """
+        _cosmo_cat = 'cosmodc2_v1.1.4_image_addon_knots'
+        _diffsky_cat = 'roman_rubin_2023_v1.1.2_elais'
+
+        if self._object_type == 'cosmodc2_galaxy':
+            self._galaxy_type = 'cosmodc2'
+            if self._truth is None:
+                self._truth = _cosmo_cat
+        else:    # only other possibility is diffsky
+            self._galaxy_type = 'diffsky'
+            if self._truth is None:
+                self._truth = _diffsky_cat
+        gal_cat = self._load_galaxy_catalog()
         self._gal_cat = gal_cat
 
         # Save cosmology in case we need to write parameters out later
@@ -354,10 +513,16 @@ class MainCatalogCreator:
                                           galaxy_type=self._galaxy_type,
                                           metadata_input=file_metadata)
 
-        for p in self._parts:
-            self._logger.info(f'Starting on pixel {p}')
-            self.create_galaxy_pixel(p, gal_cat, arrow_schema)
-            self._logger.info(f'Completed pixel {p}')
+        if self._galaxy_type == 'cosmodc2':
+            # Needed for the config. Workers find their own copy
+            self._tophat_sed_bins, _, _ = _get_tophat_info(
+                gal_cat.list_all_quantities())
+
+        # gal_cat of None means use self._gal_cat, which each worker
+        # process replaces with its own handle
+        self._process_pixels(self.create_galaxy_pixel,
+                             pixel_args=(None, arrow_schema),
+                             setup=self._load_worker_galaxy_catalog)
 
         # Now make config.   We need it for computing LSST fluxes for
         # the second part of the galaxy catalog
@@ -379,52 +544,39 @@ class MainCatalogCreator:
         Parameters
         ----------
         dat           dict    The data to write out. Column names are the keys;
-                              values are numpy array
+                              values are numpy array. 2-d arrays are
+                              written as list columns
         output_path   string  path to output file
         arrow_schema          Schema for output parquet file
         stride        int     number of rows to include in a row group
         to_rename     dict    Associate input column name with output name
                               if they differ
         '''
-        dlen = 0
-        for val in dat.values():
-            dlen = len(val)
-            break
-        if dlen == 0:
-            return
-        last_row_ix = dlen - 1
-        u_bnd = min(stride, dlen)
-        l_bnd = 0
-        rg_written = 0
-        writer = None
-
-        while u_bnd > l_bnd:
-            out_dict = {k: dat[k][l_bnd: u_bnd] for k in dat if k not in to_rename}
-            for k in to_rename:
-                out_dict[to_rename[k]] = dat[k][l_bnd: u_bnd]
-            out_df = pd.DataFrame.from_dict(out_dict)
-            out_table = pa.Table.from_pandas(out_df, schema=arrow_schema)
-            if not writer:
-                writer = pq.ParquetWriter(output_path, arrow_schema)
-
-            writer.write_table(out_table)
-            rg_written += 1
-            l_bnd = u_bnd
-            u_bnd = min(l_bnd + stride, last_row_ix + 1)
-
-        writer.close()
+        with ParquetStreamWriter(output_path, arrow_schema,
+                                 stride=stride) as writer:
+            rg_written = writer.write(dat, to_rename=to_rename)
         self._logger.debug(f'# row groups written to {output_path}: {rg_written}')
 
-    def create_galaxy_pixel(self, pixel, gal_cat, arrow_schema):
+    def create_galaxy_pixel(self, pixel, gal_cat, arrow_schema,
+                            magnorm_mode=None):
         """
         Parameters
         ----------
         pixel           Pixel for which catalog(s) is(are) to be generated.
                         Note: input pixels are assumed to use nside=32. Output
                         pixels may be finer
-        gal_cat         GCRCatalogs-loaded galaxy truth (e.g. cosmoDC2)
+        gal_cat         GCRCatalogs-loaded galaxy truth (e.g. cosmoDC2).
+                        If None, use catalog loaded by create_galaxy_catalog
         arrow_schema    schema to use for output file
+        magnorm_mode    'batch', 'scalar' or 'validate'. If None use value
+                        supplied to constructor. Applies only to cosmodc2
         """
+        if gal_cat is None:
+            gal_cat = self._gal_cat
+        if magnorm_mode is None:
+            magnorm_mode = self._magnorm_mode
+        elif magnorm_mode not in _magnorm_modes:
+            raise ValueError(f'Unknown magnorm_mode {magnorm_mode}')
 
         # The typical galaxy input file to date (cosmoDC2 or diffsky)
         # is partitioned into nside=32 healpixels. This code will only
@@ -505,7 +657,10 @@ class MainCatalogCreator:
                                         filters=mag_cut_filter)
 
         df['MW_rv'] = make_MW_extinction_rv(df['ra'], df['dec'])
-        df['MW_av'] = make_MW_extinction_av(df['ra'], df['dec'])
+        df['MW_av'] = make_MW_extinction_av(df['ra'], df['dec'],
+                                            mode=self._extinction_mode,
+                                            nside=self._extinction_nside,
+                                            cache_dir=self._cache_dir)
         self._logger.debug('Made extinction')
 
         # For cosmodc2 input some columns need to be renamed and there is
@@ -534,14 +689,27 @@ class MainCatalogCreator:
                                           np.clip(1 - df['knots_flux_ratio'],
                                                   eps, None)) * df[d_name]
 
+        if self._galaxy_type == 'cosmodc2':
+            df = self._make_tophat_columns(df, sed_disk_names, 'disk',
+                                           magnorm_mode)
+            df = self._make_tophat_columns(df, sed_bulge_names, 'bulge',
+                                           magnorm_mode)
+            if self._knots:
+                df = self._make_tophat_columns(df, sed_knot_names, 'knots',
+                                               magnorm_mode)
+
+        # Group objects by output pixel with a single permutation of
+        # each column. Data for each subpixel is then a contiguous view
         if len(self._out_pixels) > 1:
-            subpixel_masks = _generate_subpixel_masks(df['ra'], df['dec'],
-                                                      self._out_pixels,
-                                                      nside=self._nside)
+            order, subpixel_slices = _partition_by_subpixel(
+                df['ra'], df['dec'], self._out_pixels, nside=self._nside)
+            for k in df:
+                df[k] = np.asarray(df[k])[order]
+            del order
         else:
-            subpixel_masks = {pixel: None}
+            subpixel_slices = {pixel: slice(None)}
 
-        for p, val in subpixel_masks.items():
+        for p, sl in subpixel_slices.items():
             output_path = os.path.join(self._output_dir, f'galaxy_{p}.parquet')
             if os.path.exists(output_path):
                 if not self._skip_done:
@@ -550,36 +718,10 @@ class MainCatalogCreator:
                 else:
                     continue
 
-            if val is not None:
-                compressed = dict()
-                for k in df:
-                    compressed[k] = ma.array(df[k], mask=val).compressed()
-
-                if self._galaxy_type == 'cosmodc2':
-                    compressed = self._make_tophat_columns(compressed,
-                                                           sed_disk_names,
-                                                           'disk')
-                    compressed = self._make_tophat_columns(compressed,
-                                                           sed_bulge_names,
-                                                           'bulge')
-                    if self._knots:
-                        compressed = self._make_tophat_columns(compressed,
-                                                               sed_knot_names,
-                                                               'knots')
-
-                self._write_subpixel(dat=compressed, output_path=output_path,
-                                     arrow_schema=arrow_schema,
-                                     stride=stride, to_rename=to_rename)
-            else:
-                if self._galaxy_type == 'cosmodc2':
-                    df = self._make_tophat_columns(df, sed_disk_names, 'disk')
-                    df = self._make_tophat_columns(df, sed_bulge_names, 'bulge')
-                    if self._knots:
-                        df = self._make_tophat_columns(df, sed_knot_names,
-                                                       'knots')
-                self._write_subpixel(dat=df, output_path=output_path,
-                                     arrow_schema=arrow_schema,
-                                     stride=stride, to_rename=to_rename)
+            self._write_subpixel(dat={k: v[sl] for k, v in df.items()},
+                                 output_path=output_path,
+                                 arrow_schema=arrow_schema,
+                                 stride=stride, to_rename=to_rename)
 
     def create_pointsource_catalog(self):
 
@@ -613,11 +755,8 @@ class MainCatalogCreator:
 
         arrow_schema = make_star_schema(metadata_input=file_metadata)
 
-        for p in self._parts:
-            self._logger.debug(f'Point sources. Starting on pixel {p}')
-            self.create_pointsource_pixel(p, arrow_schema,
-                                          star_cat=self._truth)
-            self._logger.debug(f'Completed pixel {p}')
+        self._process_pixels(self.create_pointsource_pixel,
+                             pixel_args=(arrow_schema, self._truth))
 
         prov = assemble_provenance(self._pkg_root,
                                    inputs={'star_truth': self._truth},
@@ -642,8 +781,6 @@ class MainCatalogCreator:
                 self._logger.info(f'Skipping regeneration of {output_path}')
                 return
 
-        writer = pq.ParquetWriter(output_path, arrow_schema)
-
         # Get data for this pixel
         if self._star_input_fmt == 'sqlite':
             cols = ','.join(['format("%s",simobjid) as id', 'ra',
@@ -656,8 +793,12 @@ class MainCatalogCreator:
             with sqlite3.connect(star_cat) as conn:
                 star_df = pd.read_sql_query(q, conn)
         elif self._star_input_fmt == 'parquet':
+            read_stats = {}
             star_df = _star_parquet_reader(self._truth, pixel,
-                                           arrow_schema)
+                                           arrow_schema,
+                                           read_stats=read_stats,
+                                           cache_dir=self._cache_dir)
+            self._logger.debug(f'Pixel {pixel}: read {read_stats["row_groups_read"]} row groups ({read_stats["bytes_read"]} bytes), skipped {read_stats["row_groups_skipped"]}')
         nobj = len(star_df['id'])
         self._logger.debug(f'Found {nobj} stars')
         if nobj == 0:
@@ -674,23 +815,8 @@ class MainCatalogCreator:
         star_df['variability_model'] = np.full((nobj,), '')
         star_df['salt2_params'] = np.full((nobj,), None)
 
-        last_row_ix = nobj - 1
-        u_bnd = min(stride, nobj)
-        l_bnd = 0
-        rg_written = 0
-
-        while u_bnd > l_bnd:
-            out_dict = {k: star_df[k][l_bnd: u_bnd] for k in star_df.columns}
-            out_df = pd.DataFrame.from_dict(out_dict)
-
-            out_table = pa.Table.from_pandas(out_df, schema=arrow_schema)
-            self._logger.debug('Created arrow table from star dataframe')
-
-            # write a row broup
-            writer.write_table(out_table)
-            rg_written += 1
-            l_bnd = u_bnd
-            u_bnd = min(l_bnd + stride, last_row_ix + 1)
-
-        writer.close()
+        with ParquetStreamWriter(output_path, arrow_schema,
+                                 stride=stride) as writer:
+            rg_written = writer.write(star_df)
+        self._logger.debug(f'# row groups written to {output_path}: {rg_written}')
         return
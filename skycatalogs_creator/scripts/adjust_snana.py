@@ -4,6 +4,8 @@ added columns MW_av, MW_rv
 '''
 import os
 import argparse
+import logging
+import platform
 from skycatalogs_creator.utils.add_extinction import AddExtinction
 
 parser = argparse.ArgumentParser(description='''
@@ -18,13 +20,33 @@ parser.add_argument('--pixels', type=int, nargs='*', default=[],
 parser.add_argument('--starts-with',
                     help='That part of the filename preceding healpixel',
                     default='snana_')
+parser.add_argument('--parallel', type=int, default=1,
+                    help='''number of processes among which pixels are
+                    distributed''')
+parser.add_argument('--log-level', help='controls logging output',
+                    default='INFO', choices=['DEBUG', 'INFO', 'WARNING',
+                                             'ERROR'])
 
 args = parser.parse_args()
 
 if os.path.abspath(args.indir) == os.path.abspath(args.outdir):
     raise ValueError('Input and output directories must be different')
 
-writer = AddExtinction(args.indir, args.outdir, args.starts_with)
+logname = 'skyCatalogs.creator'
+logger = logging.getLogger(logname)
+logger.setLevel(args.log_level)
+ch = logging.StreamHandler()
+ch.setLevel(args.log_level)
+formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+ch.setFormatter(formatter)
+logger.addHandler(ch)
 
-for p in args.pixels:
-    writer.write(p)
+# Workers are forked, so only support parallel processing for Linux
+plat = platform.system()
+if plat != 'Linux' and args.parallel > 1:
+    args.parallel = 1
+    logger.warning(f'Parallel processing not supported on {plat}.')
+
+writer = AddExtinction(args.indir, args.outdir, args.starts_with,
+                       logname=logname)
+writer.write_pixels(args.pixels, n_proc=args.parallel)
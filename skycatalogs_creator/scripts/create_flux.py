@@ -56,6 +56,21 @@ if __name__ == '__main__':
     parser.add_argument(
         '--flux-parallel', default=16, type=int,
         help='Number of processes to run in parallel when computing fluxes')
+    parser.add_argument(
+        '--flux-chunk-size', default=1000, type=int,
+        help='''Max. number of objects handed to a flux process at a time
+        when flux-parallel is greater than 1''')
+    parser.add_argument(
+        '--flux-engine', default='galsim',
+        choices=['galsim', 'fast', 'validate'], help='''
+        How galaxy, star and sso fluxes are computed. "fast" computes
+        fluxes for a row group at once; "validate" uses fast but checks a
+        sample against galsim. Applies only if object_type is
+        "cosmodc2_galaxy", "star" or "sso"''')
+    parser.add_argument('--cache-dir', default=None, help='''
+        directory for data reused between runs. If no value, use
+        environment variable SKYCATALOGS_CREATOR_CACHE if set, else
+        ~/.cache/skycatalogs_creator''')
     parser.add_argument('--options-file', default=None, help='''
                     path to yaml file associating option names with values.
                     Values for any options included will take precedence.''')
@@ -65,6 +80,12 @@ if __name__ == '__main__':
     parser.add_argument('--sso-sed', default=None, help='''
                     path to two-column text file containing SED to be used
                     for all SSOs''')
+    parser.add_argument('--mjd-min', default=None, type=float, help='''
+                    If supplied, compute sso fluxes only for visits with
+                    mjd >= this value''')
+    parser.add_argument('--mjd-max', default=None, type=float, help='''
+                    If supplied, compute sso fluxes only for visits with
+                    mjd < this value''')
 
     args = parser.parse_args()
 
@@ -117,8 +138,13 @@ if __name__ == '__main__':
                                  logname=logname,
                                  skip_done=args.skip_done,
                                  flux_parallel=args.flux_parallel,
+                                 flux_chunk_size=args.flux_chunk_size,
                                  include_roman_flux=args.include_roman_flux,
                                  sso_sed=args.sso_sed,
+                                 flux_engine=args.flux_engine,
+                                 cache_dir=args.cache_dir,
+                                 mjd_min=args.mjd_min,
+                                 mjd_max=args.mjd_max,
                                  run_options=opt_dict)
     if len(parts) > 0:
         logger.info(f'Starting with healpix pixel {parts[0]}')
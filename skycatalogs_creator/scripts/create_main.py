@@ -7,6 +7,7 @@ import os
 import numpy as np
 import argparse
 import logging
+import platform
 import yaml
 from skycatalogs_creator.main_catalog_creator import MainCatalogCreator
 from skycatalogs.utils.common_utils import print_date, log_callinfo
@@ -76,6 +77,32 @@ parser.add_argument('--star-input-fmt', default='sqlite',
 parser.add_argument('--sso-sed', default=None, help='''
                     path to sqlite file containing SED to be used
                     for all SSOs. Ignored of object_type is not sso''')
+parser.add_argument('--sso-shard', action='store_true', help='''
+                    If supplied, read each sso input db file once, routing
+                    rows to output files by healpixel, rather than querying
+                    once per healpixel. Ignored if object_type is not sso''')
+parser.add_argument('--magnorm-mode', default='batch',
+                    choices=['batch', 'scalar', 'validate'], help='''
+                    How tophat magnorm is computed. "validate" computes in
+                    batch but checks against scalar computation. Applies
+                    only if object_type is "cosmodc2_galaxy"''')
+parser.add_argument('--pixel-parallel', default=1, type=int, help='''
+                    number of processes among which pixels are distributed.
+                    Does not apply to object_type "sso"''')
+parser.add_argument('--extinction-mode', default='exact',
+                    choices=['exact', 'healpix'], help='''
+                    How MW_av is computed for galaxies. "exact"
+                    interpolates in the SFD dust map; "healpix" looks up
+                    E(B-V) in a map of nside --extinction-nside, made once
+                    and saved in the cache directory''')
+parser.add_argument('--extinction-nside', default=1024, type=int,
+                    choices=2**np.arange(15),
+                    help='''nside of E(B-V) map for extinction mode
+                    "healpix"''')
+parser.add_argument('--cache-dir', default=None, help='''
+                    directory for data reused between runs. If no value, use
+                    environment variable SKYCATALOGS_CREATOR_CACHE if set,
+                    else ~/.cache/skycatalogs_creator''')
 
 args = parser.parse_args()
 
@@ -99,6 +126,13 @@ ch.setFormatter(formatter)
 
 logger.addHandler(ch)
 
+# Workers are forked, so only support parallel processing for Linux
+plat = platform.system()
+if plat != 'Linux' and args.pixel_parallel > 1:
+    args.pixel_parallel = 1
+    logger.warning(f'Parallel processing not supported on {plat}.')
+    logger.warning('For platforms other than Linux all processing is sequential')
+
 log_callinfo('create_main', args, logname)
 
 skycatalog_root = args.skycatalog_root
@@ -124,6 +158,12 @@ creator = MainCatalogCreator(args.object_type, parts,
                              dc2=args.dc2,
                              star_input_fmt=args.star_input_fmt,
                              sso_sed=args.sso_sed,  # probably not needed
+                             sso_shard=args.sso_shard,
+                             magnorm_mode=args.magnorm_mode,
+                             pixel_parallel=args.pixel_parallel,
+                             extinction_mode=args.extinction_mode,
+                             extinction_nside=args.extinction_nside,
+                             cache_dir=args.cache_dir,
                              run_options=opt_dict)
 if len(parts) > 0:
     logger.info(f'Starting with healpix pixel {parts[0]}')
@@ -1,42 +1,257 @@
 import os
-import sys
-from multiprocessing import Process, Pipe
 import sqlite3
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
 import pyarrow as pa
+import pyarrow.compute as pc
 import pyarrow.parquet as pq
 import json
 from skycatalogs.objects.base_object import LSST_BANDS
 from skycatalogs.objects.sso_object import SsoConfigFragment
+from skycatalogs.objects.sso_object import SsoCollection
+from skycatalogs.readers import ParquetReader
 from .utils.config_creator_utils import assemble_provenance
 from .utils.config_creator_utils import assemble_file_metadata
+from .utils.arrow_utils import ParquetStreamWriter
+from .utils.cache_utils import get_cache_dir, array_digest
+from .utils.sso_flux_utils import SsoFluxEngine, SSO_FLUX_TOLERANCE
 
 
 """
 Code for creating sky catalogs for sso objects
 """
 
-__all__ = ['SsoMainCatalogCreator', 'SsoFluxCatalogCreator']
+__all__ = ['SsoMainCatalogCreator', 'SsoFluxCatalogCreator', 'mjd_index_path']
 
 _DEFAULT_ROW_GROUP_SIZE = 100000      # Maybe could be larger
 
+# For sharding: # rows fetched from a db file at a time, and # rows held
+# in memory before they are spilled to per-healpix files
+_SHARD_FETCH_ROWS = 100000
+_SHARD_SPILL_ROWS = 2000000
+
+# Max. # threads scanning db files for the healpixels they contain
+_INVENTORY_THREADS = 8
+
+_MJD_ORDER = [('mjd', 'ascending'), ('id', 'ascending')]
+
+
+def mjd_index_path(parquet_path):
+    '''
+    Return path of the sidecar file describing row groups of an sso main
+    file.  It's a json file with a list "row_groups" with an entry for each
+    row group in the parquet file, containing keys mjd_min, mjd_max, num_rows
+    '''
+    return parquet_path.replace('.parquet', '_mjd_index.json')
+
+
+def _rows_to_table(rows, names):
+    '''
+    Make a table from rows fetched from a db file.  id is cast to string
+    '''
+    tbl = pa.table(dict(zip(names, zip(*rows))))
+    return tbl.set_column(names.index('id'), 'id',
+                          pc.cast(tbl['id'], pa.string()))
+
+
+def _merge_by_mjd(sources):
+    '''
+    Merge sources, each an iterable of tables sorted by mjd, into a
+    single sequence of tables sorted by mjd, then id.  Rows with equal
+    mjd are always in the same table.  Only a batch from each source is
+    held at a time, or more if a run of equal mjd spans batches
+    '''
+    iters = [iter(src) for src in sources]
+    bufs = [None] * len(iters)
+    while True:
+        for i, it in enumerate(iters):
+            while it is not None and (bufs[i] is None or bufs[i].num_rows == 0):
+                bufs[i] = next(it, None)
+                if bufs[i] is None:
+                    iters[i] = it = None
+        live = [i for i, b in enumerate(bufs) if b is not None and b.num_rows]
+        if not live:
+            return
+        # Rows before the smallest last mjd of a source which may have more
+        # rows can't be preceded, or tied, by rows not yet fetched
+        open_ends = [bufs[i]['mjd'][-1].as_py() for i in live
+                     if iters[i] is not None]
+        bound = min(open_ends) if open_ends else None
+        pieces = []
+        for i in live:
+            n = bufs[i].num_rows
+            if bound is not None:
+                n = int(np.searchsorted(bufs[i]['mjd'].to_numpy(), bound,
+                                        side='left'))
+            if n:
+                pieces.append(bufs[i].slice(0, n))
+                bufs[i] = bufs[i].slice(n)
+        if not pieces:
+            # Buffers ending at bound hold nothing else.  Append the next
+            # batch of each, since it may have more rows with that mjd
+            for i in live:
+                if (iters[i] is not None and
+                        bufs[i]['mjd'][-1].as_py() == bound):
+                    more = next(iters[i], None)
+                    if more is None:
+                        iters[i] = None
+                    else:
+                        bufs[i] = pa.concat_tables([bufs[i], more])
+            continue
+        yield pa.concat_tables(pieces).sort_by(_MJD_ORDER)
+
+
+def _ipc_batches(path):
+    '''
+    Yield record batches of an Arrow IPC file as tables
+    '''
+    with pa.memory_map(path) as source:
+        reader = pa.ipc.open_file(source)
+        for i in range(reader.num_record_batches):
+            yield pa.Table.from_batches([reader.get_batch(i)])
+
+
+class _SsoPixelWriter:
+    '''
+    Write an sso main file from tables arriving in mjd order, in row
+    groups of row_group_size rows (the last may be smaller).  On close
+    also write the mjd index sidecar (see mjd_index_path)
+
+    Parameters
+    ----------
+    output_path     string
+    arrow_schema    pa.schema
+    row_group_size  int
+    '''
+    def __init__(self, output_path, arrow_schema, row_group_size):
+        self._output_path = output_path
+        self._schema = arrow_schema
+        self._row_group_size = row_group_size
+        self._writer = ParquetStreamWriter(output_path, arrow_schema,
+                                           stride=row_group_size)
+        self._pending = []
+        self._n_pending = 0
+        self._row_groups = []
+
+    def _write_rows(self, tbl):
+        tbl = tbl.select(self._schema.names).cast(self._schema)
+        self._writer.write_batch(tbl)
+        for lo in range(0, tbl.num_rows, self._row_group_size):
+            mjd = pc.min_max(tbl['mjd'].slice(lo, self._row_group_size))
+            self._row_groups.append(
+                {'mjd_min': mjd['min'].as_py(), 'mjd_max': mjd['max'].as_py(),
+                 'num_rows': min(self._row_group_size, tbl.num_rows - lo)})
+
+    def write(self, tbl):
+        self._pending.append(tbl)
+        self._n_pending += tbl.num_rows
+        if self._n_pending < self._row_group_size:
+            return
+        tbl = pa.concat_tables(self._pending)
+        n_full = (tbl.num_rows // self._row_group_size) * self._row_group_size
+        self._write_rows(tbl.slice(0, n_full))
+        self._pending = [tbl.slice(n_full)]
+        self._n_pending = tbl.num_rows - n_full
+
+    def close(self):
+        if self._n_pending:
+            self._write_rows(pa.concat_tables(self._pending))
+        self._pending = []
+        self._n_pending = 0
+        self._writer.close()
+        if self._row_groups:
+            with open(mjd_index_path(self._output_path), 'w') as f:
+                json.dump({'row_groups': self._row_groups}, f)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _row_group_mjd_ranges(parquet_path):
+    '''
+    Return list of (mjd_min, mjd_max) for each row group of an sso main
+    file, from the mjd index sidecar if there is one, else from parquet
+    statistics.  Either value is None if not known
+    '''
+    index_path = mjd_index_path(parquet_path)
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            return [(e['mjd_min'], e['mjd_max'])
+                    for e in json.load(f)['row_groups']]
+    meta = pq.read_metadata(parquet_path)
+    i_mjd = meta.schema.to_arrow_schema().get_field_index('mjd')
+    ranges = []
+    for rg in range(meta.num_row_groups):
+        stats = meta.row_group(rg).column(i_mjd).statistics
+        if stats is None or not stats.has_min_max:
+            ranges.append((None, None))
+        else:
+            ranges.append((stats.min, stats.max))
+    return ranges
+
+
+def _window_row_groups(ranges, mjd_min, mjd_max):
+    '''
+    Return indices of row groups which may have rows with
+    mjd_min <= mjd < mjd_max.  ranges is as returned by
+    _row_group_mjd_ranges.  None for either bound means unbounded
+    '''
+    active = []
+    for rg, (lo, hi) in enumerate(ranges):
+        if mjd_min is not None and hi is not None and hi < mjd_min:
+            continue
+        if mjd_max is not None and lo is not None and lo >= mjd_max:
+            continue
+        active.append(rg)
+    return active
+
+
+def _window_rows(mjd, mjd_min, mjd_max):
+    '''
+    Return indices of elements of mjd with mjd_min <= mjd < mjd_max: a
+    range if they're contiguous (as they are when the file is in mjd
+    order), else an array
+    '''
+    in_window = np.full(len(mjd), True)
+    if mjd_min is not None:
+        in_window &= (mjd >= mjd_min)
+    if mjd_max is not None:
+        in_window &= (mjd < mjd_max)
+    rows = np.flatnonzero(in_window)
+    if len(rows) and rows[-1] - rows[0] + 1 == len(rows):
+        rows = range(int(rows[0]), int(rows[-1]) + 1)
+    return rows
+
 
 def _do_sso_flux_chunk(send_conn, sso_collection, instrument_needed,
-                       l_bnd, u_bnd):
+                       l_bnd, u_bnd, rows=None):
     '''
     end_conn         output connection
     star_collection  information from main file
     instrument_needed List of which calculations should be done
     l_bnd, u_bnd     demarcates slice to process
+    rows             If not None, indices in sso_collection of the objects
+                     to process (a range or array); l_bnd, u_bnd then
+                     index rows
 
     returns
                     dict with keys id, lsst_flux_u, ... lsst_flux_y
     '''
     out_dict = {}
 
-    o_list = sso_collection[l_bnd: u_bnd]
-    out_dict['id'] = list(sso_collection._id[l_bnd: u_bnd])
-    out_dict['mjd'] = list(sso_collection._mjds[l_bnd: u_bnd])
+    if rows is None:
+        o_list = sso_collection[l_bnd: u_bnd]
+        sel = slice(l_bnd, u_bnd)
+    else:
+        sel = rows[l_bnd: u_bnd]
+        o_list = sso_collection[(sel,)]
+    out_dict['id'] = list(sso_collection._id[sel])
+    out_dict['mjd'] = list(sso_collection._mjds[sel])
     if 'lsst' in instrument_needed:
         all_fluxes = [o.get_LSST_fluxes(as_dict=False, mjd=o._mjd) for o in o_list]
         all_fluxes_transpose = zip(*all_fluxes)
@@ -95,6 +310,12 @@ class SsoMainCatalogCreator:
                  trailedSourceMag as trailed_source_mag from {tbl}
                  where healpix = (?)
                  order by mjd, ObjID'''
+        self._shard_query = f'''select ObjID as id, {mjd_c} as mjd,
+                 "RA_deg" as ra, "Dec_deg" as dec,
+                 "RARateCosDec_deg_day" as ra_rate,
+                 "DecRate_deg_day" as dec_rate,
+                 trailedSourceMag as trailed_source_mag, healpix
+                 from {tbl}'''
 
     @property
     def sso_truth(self):
@@ -126,28 +347,155 @@ class SsoMainCatalogCreator:
                                    conn)
         return set(df['healpix'])
 
+    def _get_inventory(self, db_files):
+        '''
+        Return dict associating each db file with the set of healpixels it
+        contains.  Files are scanned concurrently.  Results are saved in a
+        manifest in the cache directory, so a file is only scanned again if
+        its size or modification time changes.
+        '''
+        manifest_path = os.path.join(
+            get_cache_dir('sso', self._catalog_creator._cache_dir),
+            f'sso_inventory_{array_digest(os.path.abspath(self._sso_truth), self._sso_db_tbl)}.json')
+        manifest = dict()
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+
+        hps_by_file = dict()
+        to_scan = []
+        for f in db_files:
+            st = os.stat(f)
+            entry = manifest.get(os.path.basename(f))
+            if (entry and entry['size'] == st.st_size and
+                    entry['mtime'] == st.st_mtime):
+                hps_by_file[f] = set(entry['healpix'])
+            else:
+                to_scan.append((f, st))
+        self._logger.info(f'Scanning {len(to_scan)} of {len(db_files)} sso db files for healpixels')
+        if not to_scan:
+            return hps_by_file
+
+        n_thread = min(_INVENTORY_THREADS, len(to_scan))
+        with ThreadPoolExecutor(n_thread) as executor:
+            scanned = executor.map(self._get_hps, [f for f, _ in to_scan])
+            for (f, st), hps in zip(to_scan, scanned):
+                hps_by_file[f] = hps
+                manifest[os.path.basename(f)] = {
+                    'size': st.st_size, 'mtime': st.st_mtime,
+                    'healpix': sorted(int(h) for h in hps)}
+
+        tmp_path = f'{manifest_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, manifest_path)
+        return hps_by_file
+
+    def _query_hp(self, filepath, hp):
+        '''
+        Yield tables of rows for hp in a db file, ordered by mjd
+        '''
+        conn = sqlite3.connect(f'file:{filepath}?mode=ro', uri=True)
+        try:
+            cursor = conn.execute(self._dfhp_query, (hp,))
+            names = [c[0] for c in cursor.description]
+            while True:
+                rows = cursor.fetchmany(_SHARD_FETCH_ROWS)
+                if not rows:
+                    break
+                yield _rows_to_table(rows, names)
+        finally:
+            conn.close()
+
+    def _write_merged(self, hp, sources, arrow_schema):
+        '''
+        Merge sources of mjd-ordered tables for hp and write them
+        '''
+        output_path = os.path.join(self._output_dir, f'sso_{hp}.parquet')
+        with _SsoPixelWriter(output_path, arrow_schema,
+                             self._row_group_size) as writer:
+            for tbl in _merge_by_mjd(sources):
+                writer.write(tbl)
+
     def _write_hp(self, hp, hps_by_file, arrow_schema):
-        df_list = []
-        for f in hps_by_file:
-            if hp in hps_by_file[f]:
-                conn = sqlite3.connect(f'file:{f}?mode=ro', uri=True)
-                one_df = pd.read_sql_query(self._dfhp_query, conn,
-                                           params=(hp,))
-                df_list.append(one_df)
-        if df_list == []:
+        sources = [self._query_hp(f, hp) for f in hps_by_file
+                   if hp in hps_by_file[f]]
+        if sources == []:
             return
-        writer = pq.ParquetWriter(os.path.join(self._output_dir,
-                                               f'sso_{hp}.parquet'),
-                                  arrow_schema)
+        self._write_merged(hp, sources, arrow_schema)
 
-        df = pd.concat(df_list)
-        df_sorted = df.sort_values('mjd')
+    def _shard_db_files(self, db_files, arrow_schema, hps=None):
+        '''
+        Write output for all healpixels while reading each db file only
+        once.  Rows are fetched in batches and sorted into buffers by
+        healpix; when the buffers get large they are written to
+        per-healpix spill files, sorted by mjd.  Finally each healpix's
+        spill files and buffer are merged and written.
 
-        # Should be prepared to write multiple row groups here
-        # depending on # of rows in the table.
-        # For now only a single row group will be necessary
-        tbl = pa.Table.from_pandas(df_sorted, schema=arrow_schema)
-        writer.write_table(tbl)
+        Parameters
+        ----------
+        db_files      list of paths of Sorcha db files
+        arrow_schema  schema for output
+        hps           If not None, collection of healpixels to be written.
+                      Rows for other healpixels are discarded
+
+        Returns
+        -------
+        Sorted list of healpixels written
+        '''
+        if hps is not None:
+            hps = np.array(sorted(hps), dtype=np.int64)
+        buffers = dict()
+        spilled = dict()
+        n_buffered = 0
+
+        with tempfile.TemporaryDirectory(dir=self._output_dir,
+                                         prefix='sso_shard_') as spill_dir:
+            def _spill():
+                for hp, tbls in buffers.items():
+                    n = len(spilled.setdefault(hp, []))
+                    path = os.path.join(spill_dir, f'{hp}_{n}.arrow')
+                    tbl = pa.concat_tables(tbls).sort_by(_MJD_ORDER)
+                    with pa.ipc.new_file(path, tbl.schema) as sink:
+                        sink.write_table(tbl, max_chunksize=_SHARD_FETCH_ROWS)
+                    spilled[hp].append(path)
+                buffers.clear()
+
+            for f in db_files:
+                self._logger.info(f'Sharding {f}')
+                with sqlite3.connect(f'file:{f}?mode=ro', uri=True) as conn:
+                    cursor = conn.execute(self._shard_query)
+                    names = [c[0] for c in cursor.description]
+                    while True:
+                        rows = cursor.fetchmany(_SHARD_FETCH_ROWS)
+                        if not rows:
+                            break
+                        tbl = _rows_to_table(rows, names)
+                        hp = tbl['healpix'].to_numpy()
+                        order = np.argsort(hp, kind='stable')
+                        hp = hp[order]
+                        tbl = tbl.take(order)
+                        starts = np.flatnonzero(np.r_[True, hp[1:] != hp[:-1]])
+                        ends = np.r_[starts[1:], len(hp)]
+                        for lo, hi in zip(starts, ends):
+                            h = int(hp[lo])
+                            if hps is not None and not np.isin(h, hps):
+                                continue
+                            buffers.setdefault(h, []).append(
+                                tbl.slice(lo, hi - lo))
+                            n_buffered += hi - lo
+                        if n_buffered > _SHARD_SPILL_ROWS:
+                            _spill()
+                            n_buffered = 0
+
+            written = sorted(set(buffers) | set(spilled))
+            for hp in written:
+                sources = [_ipc_batches(path) for path in spilled.get(hp, [])]
+                if hp in buffers:
+                    sources.append(
+                        [pa.concat_tables(buffers[hp]).sort_by(_MJD_ORDER)])
+                self._write_merged(hp, sources, arrow_schema)
+        return written
 
     def create_sso_catalog(self):
         """
@@ -164,18 +512,31 @@ class SsoMainCatalogCreator:
         arrow_schema = self._create_main_schema(metadata_input=file_metadata)
         db_files = [os.path.join(self._sso_truth, f) for f in files if f.endswith('.db')]
 
-        all_hps = set()
-        hps_by_file = dict()
-        for f in db_files:
-            hps_by_file[f] = self._get_hps(f)
-        all_hps = sorted(all_hps.union(hps_by_file[f]))
-
         todo = self._catalog_creator._parts
+        if self._catalog_creator._sso_shard:
+            hps = None
+            if len(todo):
+                # Only read files with some wanted healpixels
+                hps = set(todo)
+                hps_by_file = self._get_inventory(db_files)
+                db_files = [f for f in db_files if hps & hps_by_file[f]]
+            written = self._shard_db_files(sorted(db_files), arrow_schema,
+                                           hps=hps)
+            self._logger.info(f'Wrote files for {len(written)} healpixels')
+            self._write_config()
+            return
+
+        hps_by_file = self._get_inventory(db_files)
+        all_hps = sorted(set().union(*hps_by_file.values()))
+
         if len(todo) == 0:
             todo = all_hps
         for h in todo:
             self._write_hp(h, hps_by_file, arrow_schema)
 
+        self._write_config()
+
+    def _write_config(self):
         # Add config information for sso
         prov = assemble_provenance(
             self._catalog_creator._pkg_root,
@@ -195,6 +556,7 @@ class SsoFluxCatalogCreator:
         self._catalog_creator = catalog_creator
         self._output_dir = catalog_creator._output_dir
         self._logger = catalog_creator._logger
+        self._sso_flux_engine = None
 
     def _create_flux_schema(self, metadata_input=None,
                             metadata_key='provenance'):
@@ -216,10 +578,85 @@ class SsoFluxCatalogCreator:
 
         return pa.schema(fields, metadata=final_metadata)
 
+    def _window_collections(self, pixel):
+        '''
+        Yield (row group, collection, rows) for each row group of the main
+        file for pixel whose mjd range overlaps the mjd window.  Other row
+        groups are not read.  rows are as returned by _window_rows.
+        Yield nothing if there is no main file for pixel
+        '''
+        mjd_min, mjd_max = self._catalog_creator._mjd_window
+        main_path = os.path.join(self._output_dir, f'sso_{pixel}.parquet')
+        if not os.path.exists(main_path):
+            self._logger.info(f'No sso main file for pixel {pixel}')
+            return
+        ranges = _row_group_mjd_ranges(main_path)
+        active = _window_row_groups(ranges, mjd_min, mjd_max)
+        self._logger.info(f'Skipped {len(ranges) - len(active)} of {len(ranges)} row groups outside mjd window for pixel {pixel}')
+        reader = ParquetReader(main_path, mask=None)
+        for rg in active:
+            cols = reader.read_columns(['id', 'ra', 'dec', 'mjd'], None, rg)
+            rows = _window_rows(cols['mjd'], mjd_min, mjd_max)
+            coll = SsoCollection(cols['ra'], cols['dec'], cols['id'], pixel,
+                                 self._cat, mjd_individual=cols['mjd'],
+                                 readers=[reader], row_group=rg)
+            yield rg, coll, rows
+
+    def _compute_fast_fluxes(self, sso_collection, rows, instrument_needed):
+        '''
+        Compute fluxes for a collection with SsoFluxEngine
+
+        Parameters
+        ----------
+        sso_collection     SsoCollection  one row group of a pixel
+        rows               indices of objects to include (range or array),
+                           or None for all.  See _do_sso_flux_chunk
+        instrument_needed  list           which fluxes to compute
+
+        Returns
+        -------
+        dict with keys id, mjd and flux column names
+        '''
+        if self._sso_flux_engine is None:
+            self._sso_flux_engine = SsoFluxEngine(
+                self._cat.observed_sed_factory('sso').create(),
+                self._catalog_creator._get_bandpasses(instrument_needed))
+        engine = self._sso_flux_engine
+        sel = slice(None) if rows is None else rows
+        fluxes = engine.compute(
+            sso_collection.get_native_attribute('trailed_source_mag')[sel])
+
+        if self._catalog_creator._flux_engine == 'validate':
+            def _galsim_fluxes(ixes):
+                if rows is not None:
+                    ixes = np.asarray(rows)[ixes]
+                out = _do_sso_flux_chunk(None, sso_collection,
+                                         instrument_needed, 0, len(ixes),
+                                         ixes)
+                return np.array([out[name] for name in engine.band_names]).T
+
+            self._catalog_creator._validate_fluxes(
+                sso_collection, fluxes, instrument_needed,
+                SSO_FLUX_TOLERANCE, galsim_fluxes=_galsim_fluxes)
+
+        out_dict = {'id': sso_collection._id[sel],
+                    'mjd': sso_collection._mjds[sel]}
+        for i, name in enumerate(engine.band_names):
+            out_dict[name] = fluxes[:, i]
+        return out_dict
+
+    def _window_flux_filename(self, pixel):
+        mjd_min, mjd_max = self._catalog_creator._mjd_window
+        lo = 'start' if mjd_min is None else str(mjd_min)
+        hi = 'end' if mjd_max is None else str(mjd_max)
+        return f'sso_flux_{pixel}_mjd_{lo}_{hi}.parquet'
+
     def _create_sso_flux_pixel(self, pixel, arrow_schema):
         '''
         Create parquet file for a single healpix pixel, containing
-        id, mjd and fluxes
+        id, mjd and fluxes.  If the catalog creator has an mjd window
+        only visits in the window are included and the file name includes
+        the window (see _window_flux_filename)
         Parameters
         pixel         int
         arrow_schema  schema for parquet file to be output
@@ -229,7 +666,10 @@ class SsoFluxCatalogCreator:
         '''
 
         # global _sso_collection
-        output_filename = f'sso_flux_{pixel}.parquet'
+        if self._catalog_creator._mjd_window:
+            output_filename = self._window_flux_filename(pixel)
+        else:
+            output_filename = f'sso_flux_{pixel}.parquet'
         output_path = os.path.join(self._output_dir, output_filename)
         if os.path.exists(output_path):
             if not self._catalog_creator._skip_done:
@@ -238,80 +678,39 @@ class SsoFluxCatalogCreator:
                 self._logger.info(f'Skipping over existing file {output_path}')
                 return
 
-        object_list = self._cat.get_object_type_by_hp(pixel, 'sso')
         n_parallel = self._catalog_creator._flux_parallel
 
-        colls = object_list.get_collections()
-        writer = pq.ParquetWriter(output_path, arrow_schema)
-        fields_needed = arrow_schema.names
+        if self._catalog_creator._mjd_window:
+            todo = self._window_collections(pixel)
+        else:
+            object_list = self._cat.get_object_type_by_hp(pixel, 'sso')
+            todo = ((rg, c, None)
+                    for rg, c in enumerate(object_list.get_collections()))
+        writer = ParquetStreamWriter(output_path, arrow_schema)
         instrument_needed = ['lsst']
-        rg_written = 0
-        writer = None
-
-        # There is only one row group per main healpixel file currently
-        # so the loop could be dispensed with
-        for c in colls:
-            _sso_collection = c
-            l_bnd = 0
-            u_bnd = len(c)
-            if (u_bnd - l_bnd) < 5 * n_parallel:
-                n_parallel = 1
-            if n_parallel == 1:
-                n_per = u_bnd - l_bnd
-            else:
-                n_per = int((u_bnd - l_bnd + n_parallel)/n_parallel)
 
-            lb = l_bnd
-            u = min(l_bnd + n_per, u_bnd)
-            readers = []
-            if n_parallel == 1:
+        for rg, c, rows in todo:
+            u_bnd = len(c) if rows is None else len(rows)
+            if u_bnd == 0:
+                continue
+            if self._catalog_creator._flux_engine != 'galsim':
+                out_dict = self._compute_fast_fluxes(c, rows,
+                                                     instrument_needed)
+                writer.write(out_dict)
+            elif n_parallel == 1 or u_bnd < 5 * n_parallel:
                 out_dict = _do_sso_flux_chunk(None, c, instrument_needed,
-                                              l_bnd, u_bnd)
+                                              0, u_bnd, rows)
+                writer.write(out_dict)
             else:
-                out_dict = {}
-                for field in fields_needed:
-                    out_dict[field] = []
-
-                tm = max(int((n_per*60)/500), 10)
-                self._logger.info(f'Using timeout value {tm} for {n_per} sources')
-                p_list = []
-                for i in range(n_parallel):
-                    conn_rd, conn_wrt = Pipe(duplex=False)
-                    readers.append(conn_rd)
-
-                    # For debugging call directly
-                    proc = Process(target=_do_sso_flux_chunk,
-                                   name=f'proc_{i}',
-                                   args=(conn_wrt, _sso_collection,
-                                         instrument_needed, lb, u))
-                    proc.start()
-                    p_list.append(proc)
-                    lb = u
-                    u = min(lb + n_per, u_bnd)
-                self._logger.debug('Processes started')
-                for i in range(n_parallel):
-                    ready = readers[i].poll(tm)
-                    if not ready:
-                        self._logger.error(f'Process {i} timed out after {tm} sec')
-                        sys.exit(1)
-                    dat = readers[i].recv()
-                    for field in fields_needed:
-                        out_dict[field] += dat[field]
-                for p in p_list:
-                    p.join()
-
-            out_df = pd.DataFrame.from_dict(out_dict)
-            out_table = pa.Table.from_pandas(out_df,
-                                             schema=arrow_schema)
-
-            if not writer:
-                writer = pq.ParquetWriter(output_path, arrow_schema)
-            writer.write_table(out_table)
-
-            rg_written += 1
+                with self._catalog_creator._compute_in_pool(
+                        _do_sso_flux_chunk, 'sso', pixel, rg, u_bnd,
+                        instrument_needed, arrow_schema,
+                        extra_args=(rows,),
+                        min_timeout=10) as out_dict:
+                    writer.write(out_dict)
 
         writer.close()
-        self._logger.debug(f'# row groups written to flux file: {rg_written}')
+        self._logger.debug(f'# row groups written to flux file: {writer.rg_written}')
 
     def create_sso_flux_catalog(self):
         """
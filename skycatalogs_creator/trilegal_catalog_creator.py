@@ -2,13 +2,9 @@
 Code for creating sky catalogs for trilegal stars
 """
 import os
-import sys
-from multiprocessing import Process, Pipe
 from datetime import datetime
-import pandas as pd
 import pyarrow as pa
 import pyarrow.parquet as pq
-import numpy as np
 import json
 import galsim
 from skycatalogs.objects.base_object import LSST_BANDS, load_lsst_bandpasses
@@ -17,6 +13,7 @@ from skycatalogs.objects.trilegal_object import TrilegalConfigFragment
 from .utils.config_creator_utils import assemble_provenance
 from .utils.config_creator_utils import assemble_file_metadata
 from .utils.parquet_schema_utils import make_star_flux_schema
+from .utils.arrow_utils import ParquetStreamWriter
 from skycatalogs.utils.trilegal_utils import get_trilegal_hp_nrows
 from skycatalogs.utils.trilegal_utils import find_trilegal_subpixels
 
@@ -117,7 +114,7 @@ class TrilegalMainCatalogCreator:
                 self._logger.info(f'Removed old version of {outpath}')
             else:
                 self._logger.info(f'Skipping over existing file {outpath}')
-                return
+                return 0
 
         # Form queries and issue
         nrows = get_trilegal_hp_nrows(hp, nside=_NSIDE)
@@ -135,7 +132,11 @@ class TrilegalMainCatalogCreator:
 
         so_far = 0
 
-        writer = pq.ParquetWriter(outpath, arrow_schema)
+        # Parquet default max rows in a row group is 1M. Since
+        # trilegal has a small number of columns, we can afford
+        # to have more rows.
+        writer = ParquetStreamWriter(outpath, arrow_schema,
+                                     stride=self._stride)
 
         for pix in query_pixels:
             in_pixels = ','.join(str(p) for p in pix)
@@ -163,25 +164,8 @@ class TrilegalMainCatalogCreator:
             id_prefix = f'{self._truth_catalog}_hp{hp}_'
             results['id'] = [f'{id_prefix}{n}' for n in range(so_far, so_far + n_row)]
             so_far += n_row
-            l_bnd = 0
-            u_bnd = min(n_row, self._stride)
-            outpath = ''
-
-            while u_bnd > l_bnd:
-                out_dict = {k: results[k][l_bnd: u_bnd] for k in results}
-                out_df = pd.DataFrame.from_dict(out_dict)
-                out_table = pa.Table.from_pandas(out_df, schema=arrow_schema)
-
-                # Parquet default max rows in a row group is 1M. Since
-                # trilegal has a small number of columns, we can afford
-                # to have more rows.
-                writer.write_table(out_table, row_group_size=self._stride)
-                l_bnd = u_bnd
-                u_bnd = min(l_bnd + self._stride, n_row)
-                rg_written += 1
-                del out_dict
-                del out_df
-                del out_table
+            rg_written += writer.write(results)
+            del results
 
         writer.close()
         self._logger.debug(f'# row groups written to {outpath}: {rg_written}')
@@ -195,11 +179,8 @@ class TrilegalMainCatalogCreator:
             run_options=self._catalog_creator._run_options)
         schema = self._create_main_schema(metadata_input=file_metadata,
                                           metadata_key='provenance')
-        written = 0
-        for hp in hps:
-            self._logger.info(f'Beginning healpixel {hp}')
-            written += self._write_hp(hp, schema)
-            self._logger.info(f'Completed healpixel {hp}')
+        written = sum(self._catalog_creator._process_pixels(
+            self._write_hp, pixel_args=(schema,), pixels=hps))
         if written == 0:
             return
         # Add config information for trilegal
@@ -211,6 +192,17 @@ class TrilegalMainCatalogCreator:
         self._catalog_creator._config_writer.write_configs(trilegal_fragment)
 
 
+# Loaded once per process when first needed
+_roman_bandpasses = None
+
+
+def _get_roman_bandpasses():
+    global _roman_bandpasses
+    if _roman_bandpasses is None:
+        _roman_bandpasses = load_roman_bandpasses(include_all_bands=True)
+    return _roman_bandpasses
+
+
 def _do_trilegal_flux_chunk(send_conn, collection, instrument_needed,
                             l_bnd, u_bnd, main_path, row_group, debug=False):
     '''
@@ -283,7 +275,7 @@ def _do_trilegal_flux_chunk(send_conn, collection, instrument_needed,
 
     # Compute Roman fluxes if requested
     if 'roman' in instrument_needed:
-        roman_bandpasses = load_roman_bandpasses(include_all_bands=True)
+        roman_bandpasses = _get_roman_bandpasses()
         roman_fluxes = []
         sed_ix = 0
         for ix in range(l_bnd, u_bnd):
@@ -349,16 +341,10 @@ class TrilegalFluxCatalogCreator:
 
         n_parallel = self._catalog_creator._flux_parallel
 
-        writer = pq.ParquetWriter(output_path, arrow_schema)
-
         instrument_needed = ['lsst']
         if self._include_roman_flux:
             instrument_needed.append('roman')
 
-        rg_written = 0
-        writer = None
-        fields_needed = arrow_schema.names
-
         # Get all the objects in the pixel
         # For test pixel there is only one row group so only one collection
         # In general may have to iterate over row groups
@@ -367,78 +353,28 @@ class TrilegalFluxCatalogCreator:
             self._logger.warning(f'Cannot create flux file for pixel {pixel} because main file does not exist or is empty')
             return
 
+        writer = ParquetStreamWriter(output_path, arrow_schema)
         for rg, c in enumerate(obj_list.get_collections()):
-            l_bnd = 0
             u_bnd = len(c)
+            if u_bnd == 0:
+                continue
 
-            if (u_bnd - l_bnd) < 5 * n_parallel:
-                n_parallel = 1
-            if n_parallel == 1:
-                n_per = u_bnd - l_bnd
-            else:
-                n_per = int((u_bnd - l_bnd + n_parallel)/n_parallel)
-
-            lb = l_bnd
-            u = min(l_bnd + n_per, u_bnd)
-
-            if n_parallel == 1:
+            if n_parallel == 1 or u_bnd < 5 * n_parallel:
                 # For debugging call directly
                 out_dict = _do_trilegal_flux_chunk(None, c, instrument_needed,
-                                                   l_bnd, u_bnd, main_path,
+                                                   0, u_bnd, main_path,
                                                    rg, debug=True)
+                writer.write(out_dict)
             else:
-                out_dict = {}
-                readers = []
-                for field in fields_needed:
-                    out_dict[field] = []
-
-                tm = max(int((n_per*60)/500), 10)
-                self._logger.info(f'Using timeout value {tm} for {n_per} sources')
-                p_list = []
-                for i in range(n_parallel):
-                    conn_rd, conn_wrt = Pipe(duplex=False)
-                    readers.append(conn_rd)
-
-                    proc = Process(target=_do_trilegal_flux_chunk,
-                                   name=f'proc_{i}',
-                                   args=(conn_wrt, c,
-                                         instrument_needed, lb, u,
-                                         main_path, rg, False))
-                    proc.start()
-                    p_list.append(proc)
-                    lb = u
-                    u = min(lb + n_per, u_bnd)
-                self._logger.debug('Proceses started')
-                for i in range(n_parallel):
-                    ready = readers[i].poll(tm)
-                    if not ready:
-                        self._logger.error(
-                            f'Process {i} timed out after {tm} sec')
-                        sys.exit(1)
-                    dat = readers[i].recv()
-                    if len(dat.keys()) > 0:
-                        for field in fields_needed:
-                            if len(out_dict[field]) == 0:
-                                out_dict[field] = dat[field]
-                            else:
-                                out_dict[field] = np.concatenate([out_dict[field],
-                                                                  dat[field]])
-                for p in p_list:
-                    p.join()
-
-            out_df = pd.DataFrame.from_dict(out_dict)
-            out_table = pa.Table.from_pandas(out_df,
-                                             schema=arrow_schema)
-            n_row = len(out_table['id'])
-
-            if not writer:
-                writer = pq.ParquetWriter(output_path, arrow_schema)
-            writer.write_table(out_table, row_group_size=n_row)
-
-            rg_written += 1
+                with self._catalog_creator._compute_in_pool(
+                        _do_trilegal_flux_chunk, 'trilegal', pixel, rg, u_bnd,
+                        instrument_needed, arrow_schema,
+                        extra_args=(main_path, rg, False),
+                        min_timeout=10) as out_dict:
+                    writer.write(out_dict)
 
         writer.close()
-        self._logger.debug(f'# row groups written to flux file: {rg_written}')
+        self._logger.debug(f'# row groups written to flux file: {writer.rg_written}')
 
     def create_trilegal_flux_catalog(self):
         """
@@ -1,14 +1,53 @@
 import os
+import logging
+import multiprocessing as mp
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import pyarrow.parquet as pq
 import pyarrow as pa
-import pandas as pd
 
 from .creator_utils import make_MW_extinction_av
 from .creator_utils import make_MW_extinction_rv
+from .creator_utils import get_extinction_map
+
+
+def _writer_compression(metadata, names):
+    '''
+    Return dict of compression codecs for ParquetWriter, using the codec
+    of each input column and the most common one for columns in names,
+    which are not in the input
+    '''
+    if metadata.num_row_groups == 0:
+        return None
+    rg = metadata.row_group(0)
+    compression = dict()
+    for i in range(rg.num_columns):
+        col = rg.column(i)
+        codec = col.compression
+        compression[col.path_in_schema] = 'NONE' if codec == 'UNCOMPRESSED' else codec
+    if compression:
+        common = Counter(compression.values()).most_common(1)[0][0]
+        for name in names:
+            compression[name] = common
+    return compression
+
+
+# Writer used by worker processes
+_worker_writer = None
+
+
+def _init_worker(writer):
+    global _worker_writer
+    _worker_writer = writer
+
+
+def _write_pixel(pixel):
+    return pixel, _worker_writer.write(pixel)
 
 
 class AddExtinction():
-    def __init__(self, in_dir, out_dir, starts_with):
+    def __init__(self, in_dir, out_dir, starts_with,
+                 logname='skyCatalogs.creator'):
         '''
         Rewrite sky catalog-like parquet files, adding columns MW_ra, MW_rv
 
@@ -18,33 +57,83 @@ class AddExtinction():
         out_dir      string      directory where outputs are to be written
         starts_with  string      Form of input an output file name is always
                                  <starts_with><pixel>.parquet
+        logname      string      for Python logger
         '''
         self._in_dir = in_dir
         self._out_dir = out_dir
         self._starts_with = starts_with
+        self._logname = logname
 
     def write(self, pixel):
+        '''
+        Write output file for pixel one input row group at a time.  Input
+        columns are copied as is; row group sizes and compression are the
+        same as for the input file.  Each row group is written with an
+        explicit row_group_size since otherwise pyarrow splits tables into
+        row groups of at most 1Mi rows.  Even so, row groups are capped at
+        the writer's max_row_group_length (64Mi rows by default for recent
+        pyarrow), so larger input row groups are split.
+
+        Returns
+        -------
+        Number of rows written
+        '''
         fname = f'{self._starts_with}{str(pixel)}.parquet'
         infile = pq.ParquetFile(os.path.join(self._in_dir, fname))
         arrow_schema = (infile.schema).to_arrow_schema()
         out_schema = arrow_schema.append(pa.field('MW_av', pa.float32()))
         out_schema = out_schema.append(pa.field('MW_rv', pa.float32()))
+        compression = _writer_compression(infile.metadata,
+                                          ['MW_av', 'MW_rv'])
 
         writer = pq.ParquetWriter(os.path.join(self._out_dir, fname),
-                                  out_schema)
+                                  out_schema, compression=compression)
         n_row_group = infile.metadata.num_row_groups
+        n_rows = 0
 
         for g in range(n_row_group):
-            out_dict = dict()
             tbl = infile.read_row_group(g)
-            for c in arrow_schema.names:
-                out_dict[c] = [i.as_py() for i in tbl[c]]
-            out_dict['MW_av'] = make_MW_extinction_av(out_dict['ra'],
-                                                      out_dict['dec'])
-            out_dict['MW_rv'] = make_MW_extinction_rv(out_dict['ra'],
-                                                      out_dict['dec'])
-            out_df = pd.DataFrame.from_dict(out_dict)
-            out_table = pa.Table.from_pandas(out_df, schema=out_schema)
-            writer.write_table(out_table)
+            ra = tbl['ra'].to_numpy()
+            dec = tbl['dec'].to_numpy()
+            av = make_MW_extinction_av(ra, dec)
+            rv = make_MW_extinction_rv(ra, dec)
+            tbl = tbl.append_column(out_schema.field('MW_av'),
+                                    pa.array(av, type=pa.float32()))
+            tbl = tbl.append_column(out_schema.field('MW_rv'),
+                                    pa.array(rv, type=pa.float32()))
+            writer.write_table(tbl, row_group_size=max(1, tbl.num_rows))
+            n_rows += tbl.num_rows
 
         writer.close()
+        return n_rows
+
+    def write_pixels(self, pixels, n_proc=1):
+        '''
+        Call write for each pixel, either in this process or in a pool of
+        n_proc forked processes.  The dust map is loaded before processes
+        are started so they share it.  If a worker fails or dies the
+        exception (or BrokenProcessPool) is raised here
+        '''
+        logger = logging.getLogger(self._logname)
+        n_proc = min(n_proc, len(pixels))
+        if n_proc <= 1:
+            for p in pixels:
+                n_rows = self.write(p)
+                logger.info(f'Wrote {n_rows} rows for pixel {p}')
+            return
+
+        get_extinction_map()
+        logger.info(f'Distributing {len(pixels)} pixels among {n_proc} processes')
+        ctx = mp.get_context('fork')
+        with ProcessPoolExecutor(n_proc, mp_context=ctx,
+                                 initializer=_init_worker,
+                                 initargs=(self,)) as pool:
+            futures = [pool.submit(_write_pixel, p) for p in pixels]
+            try:
+                for fut in as_completed(futures):
+                    p, n_rows = fut.result()
+                    logger.info(f'Wrote {n_rows} rows for pixel {p}')
+            except BaseException:
+                for fut in futures:
+                    fut.cancel()
+                raise
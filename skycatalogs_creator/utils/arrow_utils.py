@@ -0,0 +1,175 @@
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+__all__ = ['make_list_array', 'make_table', 'make_record_batch',
+           'ParquetStreamWriter']
+
+
+def make_list_array(block, value_type=pa.float64()):
+    '''
+    Make an arrow list array from a 2-d numpy array without going through
+    Python lists.  Row i of block becomes element i of the list array.
+
+    Parameters
+    ----------
+    block       2-d numpy array    shape is (n_rows, n_values_per_row)
+    value_type  pyarrow DataType   type of list elements
+
+    Returns
+    -------
+    pa.ListArray of length n_rows. Values buffer is shared with block if
+    block is C-contiguous and already of the requested type
+    '''
+    block = np.ascontiguousarray(block)
+    if block.ndim != 2:
+        raise ValueError(f'make_list_array: expected 2-d array, not {block.ndim}-d')
+    n_rows, n_per = block.shape
+    if n_rows * n_per > np.iinfo(np.int32).max:
+        raise ValueError('make_list_array: too many values for list offsets')
+
+    offsets = np.arange(n_rows + 1, dtype=np.int32) * n_per
+    values = pa.array(block.reshape(-1), type=value_type, from_pandas=True)
+    return pa.ListArray.from_arrays(pa.array(offsets), values)
+
+
+def make_table(columns, arrow_schema):
+    '''
+    Make an arrow table with the given schema directly from numpy arrays,
+    bypassing pandas.  2-d arrays become list columns (see make_list_array).
+    As for pa.Table.from_pandas, NaN float values are stored as null and
+    entries in columns which are not in the schema are ignored.
+
+    Parameters
+    ----------
+    columns       dict      keys are column names; values are array-like
+    arrow_schema  pa.schema
+
+    Returns
+    -------
+    pa.Table
+    '''
+    arrays = [_to_arrow(columns[field.name], field) for field in arrow_schema]
+    return pa.Table.from_arrays(arrays, schema=arrow_schema)
+
+
+def make_record_batch(columns, arrow_schema, to_rename=None):
+    '''
+    Make an arrow record batch with the given schema from a dict of columns.
+    Columns are converted as for make_table; arrow arrays already of the
+    right type are used as is.
+
+    Parameters
+    ----------
+    columns       dict      keys are column names; values are array-like
+    arrow_schema  pa.schema
+    to_rename     dict      Associates input column name with output name
+                            if they differ
+
+    Returns
+    -------
+    pa.RecordBatch
+    '''
+    source = {}
+    if to_rename:
+        source = {out_name: in_name for in_name, out_name in to_rename.items()}
+    arrays = [_to_arrow(columns[source.get(field.name, field.name)], field)
+              for field in arrow_schema]
+    return pa.RecordBatch.from_arrays(arrays, schema=arrow_schema)
+
+
+def _to_arrow(val, field):
+    '''
+    Convert array-like val to an arrow array of type field.type
+    '''
+    if isinstance(val, pa.ChunkedArray):
+        val = val.combine_chunks()
+    if isinstance(val, pa.Array):
+        if val.type != field.type:
+            val = val.cast(field.type)
+        return val
+    if isinstance(val, np.ndarray) and val.ndim == 2:
+        return make_list_array(val, field.type.value_type)
+    return pa.array(val, type=field.type, from_pandas=True)
+
+
+class ParquetStreamWriter:
+    '''
+    Write dicts of numpy (or arrow) arrays to a parquet file as a stream of
+    record batches, without a pandas round trip.  The output file is not
+    created until there is something to write.
+
+    Parameters
+    ----------
+    output_path   string     path to output file
+    arrow_schema  pa.schema  schema for output file
+    stride        int        max number of rows in a row group. If None,
+                             each call to write produces a single row group
+    '''
+    def __init__(self, output_path, arrow_schema, stride=None):
+        self._output_path = output_path
+        self._schema = arrow_schema
+        self._stride = stride
+        self._writer = None
+        self._rg_written = 0
+
+    @property
+    def rg_written(self):
+        return self._rg_written
+
+    def write(self, columns, to_rename=None, stride=None):
+        '''
+        Parameters
+        ----------
+        columns     dict    Column names are the keys; values are array-like,
+                            all of the same length.  2-d numpy arrays are
+                            written as list columns
+        to_rename   dict    Associate input column name with output name
+                            if they differ
+        stride      int     If not None, overrides value from constructor
+
+        Returns
+        -------
+        Number of row groups written by this call
+        '''
+        batch = make_record_batch(columns, self._schema, to_rename=to_rename)
+        return self.write_batch(batch, stride=stride)
+
+    def write_batch(self, batch, stride=None):
+        '''
+        Write a record batch (or table) already conforming to the schema
+
+        Returns
+        -------
+        Number of row groups written by this call
+        '''
+        if stride is None:
+            stride = self._stride
+        n_row = batch.num_rows
+        if n_row == 0:
+            return 0
+        if not self._writer:
+            self._writer = pq.ParquetWriter(self._output_path, self._schema)
+        if not stride:
+            stride = n_row
+        written = 0
+        for l_bnd in range(0, n_row, stride):
+            rg = batch.slice(l_bnd, stride)
+            if isinstance(rg, pa.Table):
+                self._writer.write_table(rg, row_group_size=stride)
+            else:
+                self._writer.write_batch(rg, row_group_size=stride)
+            written += 1
+        self._rg_written += written
+        return written
+
+    def close(self):
+        if self._writer:
+            self._writer.close()
+            self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
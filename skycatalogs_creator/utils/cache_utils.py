@@ -0,0 +1,88 @@
+import os
+import hashlib
+import numpy as np
+
+__all__ = ['get_cache_dir', 'array_digest', 'file_digest', 'save_npz',
+           'save_npy', 'CACHE_ENV_VAR']
+
+# If set, root directory for data cached between runs
+CACHE_ENV_VAR = 'SKYCATALOGS_CREATOR_CACHE'
+
+
+def get_cache_dir(subdir=None, cache_root=None):
+    '''
+    Return path to a directory for data which may be reused by later runs,
+    creating it if necessary.
+
+    Parameters
+    ----------
+    subdir      string   if not None, path relative to cache root
+    cache_root  string   If None, use value of environment variable
+                         SKYCATALOGS_CREATOR_CACHE if set, else
+                         ~/.cache/skycatalogs_creator
+
+    Returns
+    -------
+    Absolute path of the directory
+    '''
+    if not cache_root:
+        cache_root = os.getenv(CACHE_ENV_VAR)
+    if not cache_root:
+        cache_root = os.path.join(os.path.expanduser('~'), '.cache',
+                                  'skycatalogs_creator')
+    path = cache_root
+    if subdir:
+        path = os.path.join(cache_root, subdir)
+    os.makedirs(path, exist_ok=True)
+    return os.path.abspath(path)
+
+
+def array_digest(*items):
+    '''
+    Return hex digest identifying a collection of strings and numpy arrays,
+    suitable for use in cache file names
+    '''
+    h = hashlib.sha1()
+    for item in items:
+        if isinstance(item, str):
+            h.update(item.encode())
+        else:
+            h.update(np.ascontiguousarray(item, dtype=np.float64).tobytes())
+    return h.hexdigest()[:16]
+
+
+def file_digest(path, block_size=2**20):
+    '''
+    Return hex digest of the contents of a file
+    '''
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _save_atomic(path, save_fn, *args, **kwargs):
+    '''
+    Write under another name and rename so that readers never see a
+    partial file
+    '''
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        save_fn(f, *args, **kwargs)
+    os.replace(tmp_path, path)
+
+
+def save_npz(path, **arrays):
+    '''
+    Save arrays to an npz file
+    '''
+    _save_atomic(path, np.savez, **arrays)
+
+
+def save_npy(path, array):
+    '''
+    Save an array to an npy file, which may be read back with
+    np.load(path, mmap_mode='r')
+    '''
+    _save_atomic(path, np.save, array)
@@ -1,11 +1,106 @@
+import os
 import numpy as np
+import healpy
 from dustmaps.sfd import SFDQuery
+from .cache_utils import get_cache_dir, save_npy
 
 _Av_adjustment = 2.742
 _MW_rv_constant = 3.1
 
+# 'exact' interpolates in the SFD map; 'healpix' looks up the value at
+# the center of the HEALPix pixel containing each position
+EXTINCTION_MODES = ('exact', 'healpix')
+_DEFAULT_EBV_NSIDE = 1024
 
-def make_MW_extinction_av(ra, dec):
+# Number of pixels for which SFD is queried at once when making a
+# HEALPix map
+_EBV_MAP_CHUNK = 1000000
+
+
+class MWExtinctionMap:
+    '''
+    Milky Way E(B-V) from the SFD map.  Use get_extinction_map() rather
+    than constructing directly so that maps are only loaded once per process
+
+    Parameters
+    ----------
+    mode       string   one of EXTINCTION_MODES
+    nside      int      HEALPix nside for mode 'healpix'
+    cache_dir  string   root directory for HEALPix maps saved between runs.
+                        If None, use cache_utils.get_cache_dir()
+    '''
+    def __init__(self, mode='exact', nside=_DEFAULT_EBV_NSIDE,
+                 cache_dir=None):
+        if mode not in EXTINCTION_MODES:
+            raise ValueError(f'Unknown extinction mode {mode}')
+        self._mode = mode
+        self._nside = nside
+        # SFD maps are only read if needed: always for mode 'exact', but
+        # for mode 'healpix' only to make a map not already saved
+        self._sfd = None
+        self._ebv_map = None
+        if mode == 'healpix':
+            self._ebv_map = self._get_healpix_map(cache_dir)
+
+    @property
+    def mode(self):
+        return self._mode
+
+    def _get_sfd(self):
+        if self._sfd is None:
+            self._sfd = SFDQuery()
+        return self._sfd
+
+    def _get_healpix_map(self, cache_dir):
+        '''
+        Return E(B-V) at the center of each (ring-ordered) pixel, memory
+        mapped from a file in the cache directory.  Make the file if
+        it doesn't exist
+        '''
+        path = os.path.join(get_cache_dir('extinction', cache_dir),
+                            f'sfd_ebv_nside_{self._nside}.npy')
+        if not os.path.exists(path):
+            n_pix = healpy.nside2npix(self._nside)
+            ebv = np.zeros(n_pix, dtype=np.float32)
+            for lo in range(0, n_pix, _EBV_MAP_CHUNK):
+                ipix = np.arange(lo, min(lo + _EBV_MAP_CHUNK, n_pix))
+                ra, dec = healpy.pix2ang(self._nside, ipix, lonlat=True)
+                ebv[ipix] = self._get_sfd().query_equ(ra, dec)
+            save_npy(path, ebv)
+        return np.load(path, mmap_mode='r')
+
+    def ebv(self, ra, dec):
+        '''
+        Return array of E(B-V) for arrays of ra, dec in degrees
+        '''
+        ra = np.asarray(ra, dtype=np.float64)
+        dec = np.asarray(dec, dtype=np.float64)
+        if self._ebv_map is None:
+            return np.array(self._get_sfd().query_equ(ra, dec))
+        ipix = healpy.ang2pix(self._nside, ra, dec, lonlat=True)
+        return np.asarray(self._ebv_map[ipix])
+
+
+# Maps already loaded by this process, keyed by (mode, nside, cache_dir)
+_extinction_maps = dict()
+
+
+def get_extinction_map(mode='exact', nside=_DEFAULT_EBV_NSIDE,
+                       cache_dir=None):
+    '''
+    Return MWExtinctionMap for the arguments, creating it only the first
+    time it's requested by this process
+    '''
+    if mode != 'healpix':
+        nside = None
+    key = (mode, nside, cache_dir)
+    if key not in _extinction_maps:
+        _extinction_maps[key] = MWExtinctionMap(mode, nside, cache_dir)
+    return _extinction_maps[key]
+
+
+def make_MW_extinction_av(ra, dec, mode='exact', nside=_DEFAULT_EBV_NSIDE,
+                          cache_dir=None):
     '''
     Given arrays of ra & dec, create a MW Av column corresponding to V-band
     correction.
@@ -19,12 +114,12 @@ def make_MW_extinction_av(ra, dec):
     Parameters
     ----------
     ra, dec - arrays specifying positions where Av is to be computed
+    mode, nside, cache_dir - passed to get_extinction_map
     Return:
     Array of Av values
     '''
 
-    sfd = SFDQuery()
-    ebv_raw = np.array(sfd.query_equ(np.array(ra), np.array(dec)))
+    ebv_raw = get_extinction_map(mode, nside, cache_dir).ebv(ra, dec)
 
     return _Av_adjustment * ebv_raw
 
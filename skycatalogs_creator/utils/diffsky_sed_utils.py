@@ -0,0 +1,232 @@
+import os
+import numpy as np
+import h5py
+from skycatalogs.utils.sed_tools import DiffskySedFactory
+
+__all__ = ['SED_LAYOUTS', 'DiffskySedWriter', 'DiffskySedFile',
+           'StoreDiffskySedFactory', 'install_diffsky_sed_reader']
+
+'''
+Read and write diffsky galaxy SED files (galaxy_sed_<pixel>.hdf5).
+
+Galaxies are divided into groups by galaxy_id // 100000.  Two layouts are
+supported:
+
+per_galaxy     Original layout. One (3, n_wave) dataset per galaxy, named
+               galaxy/<group>/<galaxy_id>
+consolidated   For each group a dataset galaxy/<group>/galaxy_id of sorted
+               ids and a dataset galaxy/<group>/sed of shape
+               (n_galaxy, 3, n_wave) whose rows are in the same order.
+               The file attribute sed_layout is set to 'consolidated'
+
+In both cases meta/wave_list holds wavelengths (angstroms) and the three
+rows of an SED are bulge, disk and knots.
+'''
+
+SED_LAYOUTS = ('per_galaxy', 'consolidated')
+
+_GROUP_SIZE = 100000
+
+# Target size in bytes of a chunk of a compressed consolidated dataset
+_CHUNK_BYTES = 2**20
+
+
+def _layout_of(f):
+    layout = f.attrs.get('sed_layout', 'per_galaxy')
+    if isinstance(layout, bytes):
+        layout = layout.decode()
+    return layout
+
+
+class DiffskySedWriter:
+    '''
+    Write SEDs for a pixel in either layout
+
+    Parameters
+    ----------
+    path         string     output file
+    wave         array      wavelengths in angstroms
+    galaxy_id    array      ids of all galaxies which will be written.
+                            Needed to size datasets for consolidated layout
+    layout       string     one of SED_LAYOUTS
+    compression  string     h5py compression filter (e.g. 'gzip', 'lzf')
+                            for consolidated layout, or None
+    '''
+    def __init__(self, path, wave, galaxy_id, layout='per_galaxy',
+                 compression=None):
+        if layout not in SED_LAYOUTS:
+            raise ValueError(f'Unknown SED layout {layout}')
+        self._layout = layout
+        self._n_wave = len(wave)
+        self._f = h5py.File(path, 'w', libver='latest')
+        self._f.create_dataset('meta/wave_list', shape=(self._n_wave,),
+                               maxshape=(self._n_wave,), dtype='f4',
+                               data=wave)
+        galaxy_id = np.asarray(galaxy_id, dtype=np.int64)
+        groups = galaxy_id // _GROUP_SIZE
+        self._groups = dict()
+        self._ids = dict()
+        self._seds = dict()
+        if layout == 'consolidated':
+            self._f.attrs['sed_layout'] = layout
+        chunk_rows = max(1, _CHUNK_BYTES // (3 * 4 * self._n_wave))
+        for g in np.unique(groups):
+            grp = self._f.create_group(f'galaxy/{g}')
+            self._groups[g] = grp
+            if layout == 'per_galaxy':
+                continue
+            ids = np.sort(galaxy_id[groups == g])
+            self._ids[g] = ids
+            grp.create_dataset('galaxy_id', data=ids)
+            chunks = None
+            if compression:
+                chunks = (min(chunk_rows, len(ids)), 3, self._n_wave)
+            self._seds[g] = grp.create_dataset(
+                'sed', shape=(len(ids), 3, self._n_wave), dtype='f4',
+                chunks=chunks, compression=compression)
+
+    def write(self, galaxy_id, bulge, disk, knots):
+        '''
+        Write SEDs for a batch of galaxies
+
+        Parameters
+        ----------
+        galaxy_id    array (N,)
+        bulge, disk, knots  arrays (N, n_wave)
+        '''
+        galaxy_id = np.asarray(galaxy_id, dtype=np.int64)
+        if len(galaxy_id) == 0:
+            return
+        block = np.stack([bulge, disk, knots], axis=1).astype('f4')
+        groups = galaxy_id // _GROUP_SIZE
+        if self._layout == 'per_galaxy':
+            for gid, g, sed in zip(galaxy_id, groups, block):
+                self._groups[g].create_dataset(
+                    str(gid), shape=(3, self._n_wave),
+                    maxshape=(3, self._n_wave), dtype='f4', data=sed)
+            return
+
+        for g in np.unique(groups):
+            in_group = np.flatnonzero(groups == g)
+            pos = np.searchsorted(self._ids[g], galaxy_id[in_group])
+            order = np.argsort(pos)
+            pos = pos[order]
+            rows = block[in_group[order]]
+            # Write each run of consecutive positions as one slice
+            breaks = np.flatnonzero(np.diff(pos) != 1) + 1
+            for lo, hi in zip(np.r_[0, breaks], np.r_[breaks, len(pos)]):
+                self._seds[g][pos[lo]:pos[hi - 1] + 1] = rows[lo:hi]
+
+    def close(self):
+        if self._f:
+            self._f.close()
+            self._f = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class DiffskySedFile:
+    '''
+    Read-only access to an SED file of either layout.  Items are looked up
+    by the same paths as for an h5py.File of the per_galaxy layout, e.g.
+    'meta/wave_list' or 'galaxy/<group>/<galaxy_id>', so code written for
+    that layout works unchanged.
+
+    Parameters
+    ----------
+    path   string
+    '''
+    def __init__(self, path):
+        self._f = h5py.File(path, 'r')
+        self._layout = _layout_of(self._f)
+        self._ids = dict()
+
+    @property
+    def layout(self):
+        return self._layout
+
+    def _group_ids(self, group):
+        if group not in self._ids:
+            self._ids[group] = self._f[f'galaxy/{group}/galaxy_id'][:]
+        return self._ids[group]
+
+    def get_sed(self, galaxy_id):
+        '''
+        Return (3, n_wave) float32 array for a galaxy. Raise KeyError if
+        there is none
+        '''
+        gid = int(galaxy_id)
+        group = str(gid // _GROUP_SIZE)
+        if self._layout == 'per_galaxy':
+            return self._f[f'galaxy/{group}/{gid}'][:]
+        if f'galaxy/{group}' not in self._f:
+            raise KeyError(f'No SED for galaxy {gid}')
+        ids = self._group_ids(group)
+        i = np.searchsorted(ids, gid)
+        if i == len(ids) or ids[i] != gid:
+            raise KeyError(f'No SED for galaxy {gid}')
+        return self._f[f'galaxy/{group}/sed'][i]
+
+    def __getitem__(self, key):
+        parts = key.strip('/').split('/')
+        if (self._layout != 'per_galaxy' and len(parts) == 3 and
+                parts[0] == 'galaxy' and parts[2].isdigit()):
+            return self.get_sed(parts[2])
+        return self._f[key]
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def close(self):
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class StoreDiffskySedFactory(DiffskySedFactory):
+    '''
+    DiffskySedFactory which can read SED files of either layout.
+    Construct from the factory belonging to a sky catalog
+
+    Parameters
+    ----------
+    factory    DiffskySedFactory
+    '''
+    def __init__(self, factory):
+        self.__dict__.update(factory.__dict__)
+        self._files = dict()
+
+    def _load_file(self, pixel):
+        if pixel not in self._files:
+            sed_filename = f'galaxy_sed_{pixel}.hdf5'
+            self._files[pixel] = DiffskySedFile(
+                os.path.join(self._catalog_dir, sed_filename))
+
+        if not hasattr(self, '_wave_list'):
+            self._wave_list = self._files[pixel]['meta/wave_list'][:]
+
+        return self._files[pixel]
+
+
+def install_diffsky_sed_reader(sky_cat):
+    '''
+    Replace the diffsky SED factory of sky_cat, if it has one, with one
+    which can read either layout
+    '''
+    factories = sky_cat._sed_factory
+    factory = factories.get('diffsky_galaxy')
+    if factory is not None and not isinstance(factory,
+                                              StoreDiffskySedFactory):
+        factories['diffsky_galaxy'] = StoreDiffskySedFactory(factory)
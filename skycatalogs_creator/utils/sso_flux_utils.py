@@ -0,0 +1,48 @@
+import numpy as np
+from skycatalogs.utils.sed_tools import normalize_sed
+
+__all__ = ['SsoFluxEngine', 'SSO_FLUX_TOLERANCE']
+
+# Max. relative difference allowed between SsoFluxEngine fluxes and those
+# computed by galsim for one observation at a time.  Both are the same
+# integral up to rounding, so this is about float32 precision
+SSO_FLUX_TOLERANCE = 1.0e-6
+
+
+class SsoFluxEngine:
+    '''
+    Compute fluxes for SSO observations.  All SSOs have the same SED,
+    normalized by trailed_source_mag, and flux is linear in the
+    normalization, so the SED is integrated against each band just once,
+    for magnorm 0.  Fluxes for any number of observations are then
+    the reference fluxes scaled by 10**(-0.4 * magnorm).
+
+    Parameters
+    ----------
+    sed         galsim.SED   the SED shared by all SSOs
+    bandpasses  dict         galsim.Bandpass values; keys are used to
+                             label output columns
+    '''
+    def __init__(self, sed, bandpasses):
+        self._band_names = list(bandpasses.keys())
+        ref_sed = normalize_sed(sed, 0.0)
+        self._ref_fluxes = np.array([ref_sed.calculateFlux(bp)
+                                     for bp in bandpasses.values()])
+
+    @property
+    def band_names(self):
+        return self._band_names
+
+    def compute(self, magnorm):
+        '''
+        Parameters
+        ----------
+        magnorm   array (N,)  trailed_source_mag for each observation
+
+        Returns
+        -------
+        array (N, n_bands) of fluxes, columns in the order of band_names
+        '''
+        magnorm = np.asarray(magnorm, dtype=np.float64)
+        scale = 10.0**(-0.4 * magnorm)
+        return scale[:, None] * self._ref_fluxes[None, :]
@@ -0,0 +1,174 @@
+import os
+import numpy as np
+import astropy.units as u
+import galsim
+from skycatalogs.utils.sed_tools import normalize_sed
+from .cache_utils import get_cache_dir, array_digest, save_npz
+
+__all__ = ['StarFluxCache', 'STAR_FLUX_TOLERANCE']
+
+# Max. relative difference allowed between StarFluxCache fluxes and those
+# computed by galsim for one object at a time.  Differences come from
+# galsim thinning the extinction curve
+STAR_FLUX_TOLERANCE = 5.0e-3
+
+
+def _product_weights(wave, throughput):
+    '''
+    Weights q such that sum(q * f(wave)) is the integral of f * throughput
+    when both are linear between consecutive wavelengths.  Same as the
+    integration galsim does for SEDs and bandpasses defined by tables
+    '''
+    h = np.diff(wave) / 6
+    q = np.zeros(len(wave))
+    q[:-1] += h * (2 * throughput[:-1] + throughput[1:])
+    q[1:] += h * (throughput[:-1] + 2 * throughput[1:])
+    return q
+
+
+class StarFluxCache:
+    '''
+    Compute star fluxes from a library of SED templates.  For each template
+    and band the integral of SED * extinction * throughput reduces to a
+    weighted sum over wavelength nodes.  The weights are computed once per
+    template and kept, in memory and on disk, so fluxes for all stars using
+    a template are found with one vectorized sum per band.  Extinction is
+    applied for each star's exact MW_av.
+
+    Parameters
+    ----------
+    extinguisher  MilkyWayExtinction  as used by skyCatalogs
+    bandpasses    dict                galsim.Bandpass values; keys are used
+                                      to label output columns
+    sed_dir       string              sed_filepath values are relative to
+                                      this directory
+    cache_dir     string              where to save weights between runs.
+                                      If None, use get_cache_dir()
+    logger        logging.Logger
+    '''
+    def __init__(self, extinguisher, bandpasses, sed_dir, cache_dir=None,
+                 logger=None):
+        self._band_names = list(bandpasses.keys())
+        self._bandpasses = list(bandpasses.values())
+        self._sed_dir = sed_dir
+        self._logger = logger
+
+        ext_wl = extinguisher.wls
+        ext_one = extinguisher.extinction.extinguish(ext_wl*u.nm, Av=1.0)
+        self._ext_wl = ext_wl
+        self._a_ratio = -2.5*np.log10(ext_one)
+
+        # Cached weights are only valid for the same bandpasses, extinction
+        # and SED library
+        digest_items = [sed_dir, ext_wl, self._a_ratio]
+        for name, bp in bandpasses.items():
+            wl = np.array(bp.wave_list)
+            digest_items += [name, wl, bp(wl)]
+        cache_dir = get_cache_dir('star_flux', cache_root=cache_dir)
+        self._cache_path = os.path.join(
+            cache_dir, f'star_flux_{array_digest(*digest_items)}.npz')
+
+        # For each template, list with (a_ratio, weights) for each band
+        self._templates = dict()
+        self._modified = False
+        self._load()
+
+    @property
+    def band_names(self):
+        return self._band_names
+
+    @property
+    def cache_path(self):
+        return self._cache_path
+
+    def _load(self):
+        if not os.path.exists(self._cache_path):
+            return
+        with np.load(self._cache_path) as npz:
+            names = npz['names']
+            offsets = npz['offsets']
+            a_ratio = npz['a_ratio']
+            weights = npz['weights']
+        for name, off in zip(names, offsets):
+            self._templates[str(name)] = [
+                (a_ratio[off[i]:off[i + 1]], weights[off[i]:off[i + 1]])
+                for i in range(len(self._bandpasses))]
+        if self._logger:
+            self._logger.info(f'Read weights for {len(names)} star SEDs from {self._cache_path}')
+
+    def save(self):
+        '''
+        Write weights for all templates seen so far to the cache file if
+        there are any new ones
+        '''
+        if not self._modified:
+            return
+        names = list(self._templates.keys())
+        offsets = []
+        a_ratio = []
+        weights = []
+        n = 0
+        for name in names:
+            off = [n]
+            for a, w in self._templates[name]:
+                a_ratio.append(a)
+                weights.append(w)
+                n += len(w)
+                off.append(n)
+            offsets.append(off)
+        save_npz(self._cache_path, names=np.array(names),
+                 offsets=np.array(offsets), a_ratio=np.concatenate(a_ratio),
+                 weights=np.concatenate(weights))
+        self._modified = False
+
+    def _compute_weights(self, sed_filepath):
+        sed = galsim.SED(os.path.join(self._sed_dir, sed_filepath),
+                         wave_type='nm', flux_type='flambda')
+        # Weights are for magnorm = 0
+        sed = normalize_sed(sed, 0.0)
+        out = []
+        for bp in self._bandpasses:
+            wl = np.union1d(np.union1d(sed.wave_list, self._ext_wl),
+                            bp.wave_list)
+            wl = wl[(wl >= bp.blue_limit) & (wl <= bp.red_limit)]
+            w = _product_weights(wl, bp(wl)) * sed(wl)
+            a = np.interp(wl, self._ext_wl, self._a_ratio)
+            out.append((a, w))
+        return out
+
+    def _get_weights(self, sed_filepath):
+        if sed_filepath not in self._templates:
+            self._templates[sed_filepath] = self._compute_weights(sed_filepath)
+            self._modified = True
+        return self._templates[sed_filepath]
+
+    def compute(self, sed_filepath, magnorm, av, chunk_size=2000):
+        '''
+        Compute fluxes in all bands
+
+        Parameters
+        ----------
+        sed_filepath  array (N,)  template for each star
+        magnorm       array (N,)
+        av            array (N,)  Milky Way A_V
+        chunk_size    int         max. number of stars per vectorized sum
+
+        Returns
+        -------
+        array (N, n_bands) of fluxes in photons/s/cm**2
+        '''
+        magnorm = np.asarray(magnorm, dtype=np.float64)
+        av = np.asarray(av, dtype=np.float64)
+        fluxes = np.zeros((len(magnorm), len(self._bandpasses)))
+        if len(magnorm) == 0:
+            return fluxes
+        names, inverse = np.unique(np.asarray(sed_filepath),
+                                   return_inverse=True)
+        for i_name, name in enumerate(names):
+            ixes = np.flatnonzero(inverse == i_name)
+            for i_band, (a, w) in enumerate(self._get_weights(str(name))):
+                for l_bnd in range(0, len(ixes), chunk_size):
+                    ix = ixes[l_bnd:l_bnd + chunk_size]
+                    ext = 10**(-0.4 * np.outer(av[ix], a))
+                    fluxes[ix, i_band] = ext @ w
+        return fluxes * 10**(-0.4 * magnorm)[:, None]
@@ -1,37 +1,117 @@
 import os
 import glob
+import json
+import pyarrow as pa
+import pyarrow.compute as pc
 import pyarrow.parquet as pq
-import pandas as pd
 import numpy as np
-import numpy.ma as ma
 import healpy
 from esutil.htm import HTM
+from .cache_utils import get_cache_dir, array_digest
 
 
 class UWStarFiles:
-    _files = {}  # shared state
+    '''
+    Index of UW star files, stars_chunk_<imin>_<imax>.parquet, each of
+    which holds stars with HTM (depth 20) ids in [imin, imax].  Ranges of
+    different files are assumed not to overlap.
+
+    The association of healpix pixels with files is computed once for all
+    pixels and saved in the cache directory, so lookups in later runs read
+    it from there.
 
-    def __init__(self, input_dir):
-        self._index_files(input_dir)
+    Parameters
+    ----------
+    input_dir   string   directory containing UW star files
+    cache_dir   string   Root directory for saved pixel to file maps.
+                         If None, use cache_utils.get_cache_dir()
+    '''
+    # Shared state: file ranges for each input directory and pixel maps
+    # for each (input directory, nside, res_factor)
+    _dir_index = {}
+    _pixel_maps = {}
+
+    def __init__(self, input_dir, cache_dir=None):
+        self._input_dir = os.path.abspath(input_dir)
+        self._cache_dir = cache_dir
+        self._index_files(self._input_dir)
         self.htm_indexer = HTM(depth=20)
 
     def _index_files(self, input_dir):
-        if self._files:
-            # The files have already been indexed.
-            return
-        files = sorted(glob.glob(os.path.join(input_dir,
-                                              'stars_chunk_*.parquet')))
-        for item in files:
-            tokens = os.path.basename(item).split('_')
-            imin = int(tokens[2])
-            imax = int(tokens[3].split('.')[0])
-            self._files[(imin, imax)] = item
+        if input_dir not in self._dir_index:
+            files = glob.glob(os.path.join(input_dir, 'stars_chunk_*.parquet'))
+            ranges = []
+            for item in files:
+                tokens = os.path.basename(item).split('_')
+                imin = int(tokens[2])
+                imax = int(tokens[3].split('.')[0])
+                ranges.append((imin, imax, item))
+            ranges.sort()
+            self._dir_index[input_dir] = (
+                np.array([r[0] for r in ranges], dtype=np.int64),
+                np.array([r[1] for r in ranges], dtype=np.int64),
+                [r[2] for r in ranges])
+        self._imin, self._imax, self._paths = self._dir_index[input_dir]
+        self._files = {(int(imin), int(imax)): item for imin, imax, item
+                       in zip(self._imin, self._imax, self._paths)}
+
+    def _file_indices(self, htm_ids):
+        '''
+        Return indices into self._paths of the files containing each of
+        htm_ids, or -1 where there is none
+        '''
+        htm_ids = np.asarray(htm_ids, dtype=np.int64)
+        ix = np.searchsorted(self._imin, htm_ids, side='right') - 1
+        found = (ix >= 0) & (htm_ids <= self._imax[np.maximum(ix, 0)])
+        return np.where(found, ix, -1)
+
+    def _make_pixel_map(self, nside, res_factor):
+        '''
+        Return dict associating each pixel with the (sorted) indices of files
+        covering it.  Pixels are sampled at the centers of the subpixels at
+        resolution nside*res_factor which they contain
+        '''
+        nside_fine = nside * res_factor
+        fine = np.arange(healpy.nside2npix(nside_fine))
+        ra, dec = healpy.pix2ang(nside_fine, fine, nest=True, lonlat=True)
+        ix = self._file_indices(self.htm_indexer.lookup_id(ra, dec))
+        # In nested ordering, subpixels of a pixel are consecutive
+        pixel = healpy.nest2ring(nside, fine // res_factor**2)
+        pairs = np.unique(np.stack([pixel, ix], axis=1)[ix >= 0], axis=0)
+        pixel_map = {}
+        for p, i in pairs:
+            pixel_map.setdefault(int(p), []).append(int(i))
+        return pixel_map
+
+    def _get_pixel_map(self, nside, res_factor):
+        key = (self._input_dir, nside, res_factor)
+        if key in self._pixel_maps:
+            return self._pixel_maps[key]
+
+        names = [os.path.basename(p) for p in self._paths]
+        digest = array_digest(self._input_dir, *names,
+                              np.array([nside, res_factor]))
+        path = os.path.join(get_cache_dir('uw_stars', self._cache_dir),
+                            f'pixel_files_{digest}.json')
+        if os.path.exists(path):
+            with open(path) as f:
+                saved = json.load(f)
+            pixel_map = {int(p): v for p, v in saved['pixels'].items()}
+        else:
+            pixel_map = self._make_pixel_map(nside, res_factor)
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump({'input_dir': self._input_dir, 'nside': nside,
+                           'res_factor': res_factor, 'files': names,
+                           'pixels': pixel_map}, f)
+            os.replace(tmp_path, path)
+        self._pixel_maps[key] = pixel_map
+        return pixel_map
 
     def find_files(self, pixel, nside=32, res_factor=16):
         """
-        Find the UW input files that cover a given healpixel by sampling the
-        interior of the healpixel and computing the htm indexes at those
-        locations.
+        Find the UW input files that cover a given healpixel, according
+        to the htm indexes at the centers of its subpixels.
 
         Parameters
         ----------
@@ -41,89 +121,129 @@ class UWStarFiles:
             Resolution parameter of the healpixel map.
         res_factor : int
             Sampling factor of the healpix to ensure coverage of the healpixel
-            by the UW files.
+            by the UW files.  Must be a power of 2, so that subpixels
+            are nested within the pixel
 
         Returns
         -------
-        list : List of filenames.
+        set : Set of filenames.
         """
-        corners = np.transpose(healpy.boundaries(nside, pixel))
-        subpixels = healpy.query_polygon(nside*res_factor, corners)
-        ra, dec = [], []
-        for subpix in subpixels:
-            coord = healpy.pix2ang(nside*res_factor, subpix, lonlat=True)
-            ra.append(coord[0])
-            dec.append(coord[1])
-        files = set()
-        indices = set(self.htm_indexer.lookup_id(ra, dec))
-        for index in indices:
-            for (imin, imax), item in self._files.items():
-                if imin <= index <= imax:
-                    files.add(item)
-        return files
-
-
-def _calculate_pixel_mask(ra, dec, pixel, nside=32):
+        if res_factor < 1 or res_factor & (res_factor - 1):
+            raise ValueError(f'res_factor must be a power of 2, not {res_factor}')
+        pixel_map = self._get_pixel_map(nside, res_factor)
+        return {self._paths[i] for i in pixel_map.get(int(pixel), [])}
+
+
+def _pixel_bounds(pixel, nside):
+    '''
+    Return (ra_min, ra_max, dec_min, dec_max) in degrees bounding a
+    healpix pixel, with a small margin.  ra_min and ra_max are None if
+    the pixel straddles ra = 0 or contains a pole
     '''
+    vec = healpy.boundaries(nside, pixel, step=8)
+    ra, dec = healpy.vec2ang(np.transpose(vec), lonlat=True)
+    margin = 0.01 * np.degrees(healpy.nside2resol(nside))
+    dec_min = dec.min() - margin
+    dec_max = dec.max() + margin
+    if (ra.max() - ra.min() > 180.0 or
+            healpy.ang2pix(nside, 0.0, 90.0, lonlat=True) == pixel or
+            healpy.ang2pix(nside, 0.0, -90.0, lonlat=True) == pixel):
+        return None, None, dec_min, dec_max
+    return ra.min() - margin, ra.max() + margin, dec_min, dec_max
+
+
+def _row_group_overlaps(rg_meta, col_ix, bounds):
+    '''
+    Return False if row group statistics for ra and decl show none of its
+    rows can be within bounds (as returned by _pixel_bounds), else True
+    '''
+    ra_min, ra_max, dec_min, dec_max = bounds
+    for col, lo, hi in (('decl', dec_min, dec_max), ('ra', ra_min, ra_max)):
+        if lo is None or col not in col_ix:
+            continue
+        stats = rg_meta.column(col_ix[col]).statistics
+        if stats is None or not stats.has_min_max:
+            continue
+        if stats.max < lo or stats.min > hi:
+            return False
+    return True
+
+
+def _star_parquet_reader(dirpath, pixel, output_arrow_schema, nside=32,
+                         read_stats=None, cache_dir=None):
+    '''
+    Get requisite info from parquet files for sources in pixel.
+    Row groups whose ra, decl statistics show they can't have sources in
+    the pixel are skipped.  Rows outside the pixel are dropped as each
+    row group is read, before any conversion.  Then do renames and
+    calculation for magnorm
+
     Parameters
     ----------
-    ra          Array of float
-    dec         Array of float
-    pixel       int
+    dirpath             string   directory containing UW star files
+    pixel               int
+    output_arrow_schema pa.schema   not used
+    nside               int
+    read_stats          dict     If not None, set keys row_groups_read,
+                                 row_groups_skipped and bytes_read
+                                 (compressed size of columns read)
+    cache_dir           string   Root directory for the saved pixel to file
+                                 map.  See UWStarFiles
 
     Returns
     -------
-    Mask, set to 1 for all elements not in the pixel
+    dict of numpy arrays, keyed by output column name
     '''
-    ra = np.array(ra)
-    dec = np.array(dec)
-    in_pix = healpy.pixelfunc.ang2pix(nside, ra, dec, nest=False, lonlat=True)
-    mask = ma.logical_not(in_pix == pixel)
-    return mask
-
-
-def _star_parquet_reader(dirpath, pixel, output_arrow_schema, nside=32):
-    # Get requisite info from parquet files for sources in pixel.
-    # Next do renames and calculation for magnorm
     to_read = ['simobjid', 'ra', 'decl', 'mura', 'mudecl', 'vrad',
                'parallax', 'sedfilename', 'flux_scale', 'ebv']
     rename = {'decl': 'dec', 'sedfilename': 'sed_filepath', 'mudecl': 'mudec',
               'vrad': 'radial_velocity'}
-    out_fields = ['id', 'ra', 'dec', 'mura', 'mudec', 'radial_velocity',
-                  'parallax', 'sed_filepath', 'magnorm', 'ebv']
 
-    uw_files = UWStarFiles(dirpath)
+    uw_files = UWStarFiles(dirpath, cache_dir=cache_dir)
     paths = uw_files.find_files(pixel, nside)
-    out_dict = {}
-    for k in out_fields:
-        out_dict[k] = []
-    for f in paths:
-        f_dict = {}
-        for k in out_fields:
-            f_dict[k] = []
-        meta = pq.read_metadata(f)
+    bounds = _pixel_bounds(pixel, nside)
+    n_read = 0
+    n_skipped = 0
+    bytes_read = 0
+    tables = []
+    for f in sorted(paths):
         pq_file = pq.ParquetFile(f)
+        meta = pq_file.metadata
+        col_ix = {meta.schema.column(i).path: i
+                  for i in range(meta.num_columns)}
         for rg in range(meta.num_row_groups):
+            rg_meta = meta.row_group(rg)
+            if not _row_group_overlaps(rg_meta, col_ix, bounds):
+                n_skipped += 1
+                continue
+            n_read += 1
+            bytes_read += sum(rg_meta.column(col_ix[c]).total_compressed_size
+                              for c in to_read)
             tbl = pq_file.read_row_group(rg, columns=to_read)
-            msk = _calculate_pixel_mask(tbl['ra'], tbl['decl'], pixel)
-            for col in to_read:
-                if col in rename:
-                    f_dict[rename[col]] += list(ma.array(np.array(tbl[col]),
-                                                         mask=msk).compressed())
-                elif col == 'flux_scale':
-                    # compute magnorm from flux_scale
-                    tmp = ma.array(np.array(tbl['flux_scale']),
-                                   mask=msk).compressed()
-                    f_dict['magnorm'] += list(-2.5*np.log(tmp)/np.log(10.0) - 18.402732642)
-                elif col == 'simobjid':
-                    # convert simobjid to string, change name to id
-                    tmp = [str(sim_id) for sim_id in tbl['simobjid']]
-                    f_dict['id'] += list(ma.array(np.array(tmp),
-                                                  mask=msk).compressed())
-                else:
-                    f_dict[col] += list(ma.array(np.array(tbl[col]),
-                                                 mask=msk).compressed())
-        for k in out_fields:
-            out_dict[k] += f_dict[k]
-
-    return pd.DataFrame(out_dict)
+            in_pix = healpy.pixelfunc.ang2pix(nside, tbl['ra'].to_numpy(),
+                                              tbl['decl'].to_numpy(),
+                                              nest=False, lonlat=True)
+            tbl = tbl.filter(pa.array(in_pix == pixel))
+            if tbl.num_rows > 0:
+                tables.append(tbl)
+    if read_stats is not None:
+        read_stats.update(row_groups_read=n_read,
+                          row_groups_skipped=n_skipped,
+                          bytes_read=bytes_read)
+
+    if tables:
+        tbl = pa.concat_tables(tables)
+    else:
+        tbl = pa.schema([pa.field(c, pa.float64()) for c in to_read]).empty_table()
+    out_dict = {'id': pc.cast(tbl['simobjid'], pa.string())}
+    for col in to_read:
+        if col in rename:
+            out_dict[rename[col]] = tbl[col]
+        elif col == 'flux_scale':
+            # compute magnorm from flux_scale
+            out_dict['magnorm'] = pc.subtract(
+                pc.multiply(pc.log10(tbl[col]), -2.5), 18.402732642)
+        elif col != 'simobjid':
+            out_dict[col] = tbl[col]
+
+    return {k: v.to_numpy() for k, v in out_dict.items()}
@@ -0,0 +1,88 @@
+"""
+Unit tests for rewriting parquet files with Milky Way extinction columns
+"""
+
+import unittest
+import os
+import tempfile
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from dustmaps.config import config as dustmaps_config
+from skycatalogs_creator.utils.add_extinction import AddExtinction
+from skycatalogs_creator.utils.creator_utils import make_MW_extinction_av
+from skycatalogs_creator.utils.creator_utils import make_MW_extinction_rv
+
+PIXEL = 9556
+STARTS_WITH = 'pointsource_'
+ROW_GROUP_SIZES = [50, 120, 7]
+COMPRESSION = {'id': 'SNAPPY', 'ra': 'ZSTD', 'dec': 'ZSTD', 'magnorm': 'GZIP'}
+
+
+def _have_sfd():
+    sfd_dir = os.path.join(dustmaps_config['data_dir'] or '', 'sfd')
+    return all(os.path.exists(os.path.join(sfd_dir, f'SFD_dust_4096_{p}.fits'))
+               for p in ('ngp', 'sgp'))
+
+
+@unittest.skipUnless(_have_sfd(), 'SFD dust maps not available')
+class AddExtinctionTest(unittest.TestCase):
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self._in_dir = os.path.join(self._tmpdir.name, 'in')
+        self._out_dir = os.path.join(self._tmpdir.name, 'out')
+        os.makedirs(self._in_dir)
+        os.makedirs(self._out_dir)
+
+        rng = np.random.default_rng(17)
+        self._tables = []
+        for n in ROW_GROUP_SIZES:
+            self._tables.append(pa.table(
+                {'id': [str(i) for i in rng.integers(0, 10**9, n)],
+                 'ra': rng.uniform(50.0, 60.0, n),
+                 'dec': rng.uniform(-40.0, -30.0, n),
+                 'magnorm': rng.uniform(15.0, 25.0, n).astype(np.float32)}))
+        path = os.path.join(self._in_dir, f'{STARTS_WITH}{PIXEL}.parquet')
+        with pq.ParquetWriter(path, self._tables[0].schema,
+                              compression=COMPRESSION) as writer:
+            for tbl in self._tables:
+                writer.write_table(tbl, row_group_size=tbl.num_rows)
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def testwrite(self):
+        adder = AddExtinction(self._in_dir, self._out_dir, STARTS_WITH)
+        self.assertEqual(adder.write(PIXEL), sum(ROW_GROUP_SIZES))
+
+        pf = pq.ParquetFile(os.path.join(self._out_dir,
+                                         f'{STARTS_WITH}{PIXEL}.parquet'))
+        meta = pf.metadata
+        self.assertEqual([meta.row_group(rg).num_rows
+                          for rg in range(meta.num_row_groups)],
+                         ROW_GROUP_SIZES)
+        # New columns use the most common codec of the input
+        expected = dict(COMPRESSION, MW_av='ZSTD', MW_rv='ZSTD')
+        for rg in range(meta.num_row_groups):
+            rg_meta = meta.row_group(rg)
+            codecs = {rg_meta.column(i).path_in_schema:
+                      rg_meta.column(i).compression
+                      for i in range(rg_meta.num_columns)}
+            self.assertEqual(codecs, expected)
+
+        for rg, tbl in enumerate(self._tables):
+            out = pf.read_row_group(rg)
+            self.assertTrue(out.select(tbl.column_names).equals(tbl))
+            ra = tbl['ra'].to_numpy()
+            dec = tbl['dec'].to_numpy()
+            self.assertEqual(out.schema.field('MW_av').type, pa.float32())
+            np.testing.assert_array_equal(
+                out['MW_av'].to_numpy(),
+                make_MW_extinction_av(ra, dec).astype(np.float32))
+            np.testing.assert_array_equal(
+                out['MW_rv'].to_numpy(),
+                make_MW_extinction_rv(ra, dec).astype(np.float32))
+
+
+if __name__ == '__main__':
+    unittest.main()
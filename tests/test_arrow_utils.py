@@ -0,0 +1,100 @@
+"""
+Unit tests for arrow utilities used to write skyCatalogs parquet files
+"""
+
+import unittest
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from skycatalogs_creator.utils.arrow_utils import make_list_array, make_table
+from skycatalogs_creator.utils.arrow_utils import ParquetStreamWriter
+
+SCHEMA = pa.schema([pa.field('galaxy_id', pa.int64()),
+                    pa.field('ra', pa.float64(), True),
+                    pa.field('size_disk_true', pa.float32(), True),
+                    pa.field('sed_val_disk', pa.list_(pa.float64()), True),
+                    pa.field('MW_rv', pa.float32(), True)],
+                   metadata={'provenance': b'{"inputs": "test"}'})
+
+
+class ArrowUtilsTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(27)
+        n_obj = 1000
+        self._dat = {'galaxy_id': np.arange(n_obj, dtype=np.int64),
+                     'ra': rng.uniform(50.0, 60.0, n_obj),
+                     'size_disk_true': rng.uniform(0.0, 2.0, n_obj),
+                     'sed_val_disk': rng.uniform(0.0, 5.0, (n_obj, 30)),
+                     'MW_rv': np.full(n_obj, 3.1),
+                     'not_in_schema': np.zeros(n_obj)}
+        self._dat['ra'][7] = np.nan
+        self._tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def testlist_array(self):
+        block = self._dat['sed_val_disk']
+        arr = make_list_array(block)
+        self.assertEqual(len(arr), block.shape[0])
+        self.assertEqual(arr[3].as_py(), block[3].tolist())
+
+        # Slices of the block are fine too
+        arr = make_list_array(block[10:20])
+        self.assertEqual(arr[0].as_py(), block[10].tolist())
+
+    def testmatches_pandas(self):
+        '''
+        Files written from tables made with make_table should be identical
+        to those made going through pandas
+        '''
+        pd_dat = dict(self._dat)
+        pd_dat['sed_val_disk'] = self._dat['sed_val_disk'].tolist()
+        pd_path = os.path.join(self._tmpdir.name, 'pandas.parquet')
+        arrow_path = os.path.join(self._tmpdir.name, 'arrow.parquet')
+
+        pd_table = pa.Table.from_pandas(pd.DataFrame.from_dict(pd_dat),
+                                        schema=SCHEMA)
+        with pq.ParquetWriter(pd_path, SCHEMA) as writer:
+            writer.write_table(pd_table)
+        with pq.ParquetWriter(arrow_path, SCHEMA) as writer:
+            writer.write_table(make_table(self._dat, SCHEMA))
+
+        with open(pd_path, 'rb') as f1, open(arrow_path, 'rb') as f2:
+            self.assertEqual(f1.read(), f2.read())
+
+    def teststream_writer(self):
+        '''
+        Check row group sizing and renames
+        '''
+        dat = dict(self._dat)
+        dat['raDeg'] = dat.pop('ra')
+        path = os.path.join(self._tmpdir.name, 'stream.parquet')
+        with ParquetStreamWriter(path, SCHEMA, stride=300) as writer:
+            written = writer.write(dat, to_rename={'raDeg': 'ra'})
+            written += writer.write({k: v[:10] for k, v in dat.items()},
+                                    to_rename={'raDeg': 'ra'})
+        self.assertEqual(written, 5)
+        self.assertEqual(writer.rg_written, 5)
+
+        pq_file = pq.ParquetFile(path)
+        self.assertEqual(pq_file.metadata.num_row_groups, 5)
+        self.assertEqual(pq_file.metadata.row_group(3).num_rows, 100)
+        tbl = pq_file.read()
+        self.assertEqual(tbl.schema.field('size_disk_true').type, pa.float32())
+        self.assertTrue(tbl['ra'][7].as_py() is None)
+        np.testing.assert_array_equal(np.array(tbl['ra'][8:20]),
+                                      self._dat['ra'][8:20])
+
+    def testnothing_to_write(self):
+        path = os.path.join(self._tmpdir.name, 'empty.parquet')
+        with ParquetStreamWriter(path, SCHEMA) as writer:
+            writer.write({k: v[:0] for k, v in self._dat.items()})
+        self.assertFalse(os.path.exists(path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+"""
+Unit tests for writing and reading diffsky SED files in the per-galaxy
+and consolidated layouts
+"""
+
+import unittest
+import os
+import tempfile
+import numpy as np
+from skycatalogs.utils.sed_tools import DiffskySedFactory
+from skycatalogs_creator.utils.diffsky_sed_utils import DiffskySedWriter
+from skycatalogs_creator.utils.diffsky_sed_utils import DiffskySedFile
+from skycatalogs_creator.utils.diffsky_sed_utils import StoreDiffskySedFactory
+from skycatalogs_creator.utils.diffsky_sed_utils import SED_LAYOUTS
+
+COSMOLOGY = {'H0': 71.0, 'Om0': 0.2648, 'Ob0': 0.0448, 'sigma8': 0.8,
+             'n_s': 0.963}
+PIXEL = 9556
+
+
+class DiffskySedStoreTest(unittest.TestCase):
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        rng = np.random.default_rng(42)
+        n_obj = 300
+        # Galaxies in three id groups, not in order
+        self._galaxy_id = rng.permutation(
+            np.r_[np.arange(100, 200), np.arange(100300, 100400),
+                  np.arange(300000, 300100)]).astype(np.int64)
+        self._wave = np.linspace(1000.0, 20000.0, 50)
+        self._seds = rng.uniform(0.0, 1.0, (n_obj, 3, len(self._wave)))
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def _write(self, layout, compression=None):
+        path = os.path.join(self._tmpdir.name, f'galaxy_sed_{PIXEL}.hdf5')
+        with DiffskySedWriter(path, self._wave, self._galaxy_id,
+                              layout=layout,
+                              compression=compression) as writer:
+            for lo in range(0, len(self._galaxy_id), 70):
+                hi = lo + 70
+                writer.write(self._galaxy_id[lo:hi], self._seds[lo:hi, 0],
+                             self._seds[lo:hi, 1], self._seds[lo:hi, 2])
+        return path
+
+    def testread_back(self):
+        for layout in SED_LAYOUTS:
+            for compression in (None, 'gzip'):
+                path = self._write(layout, compression)
+                with DiffskySedFile(path) as f:
+                    self.assertEqual(f.layout, layout)
+                    np.testing.assert_allclose(f['meta/wave_list'][:],
+                                               self._wave)
+                    for i in (0, 17, 299):
+                        gid = self._galaxy_id[i]
+                        key = f'galaxy/{gid//100000}/{gid}'
+                        np.testing.assert_allclose(f[key][:], self._seds[i],
+                                                   rtol=1e-6)
+                    self.assertFalse('galaxy/0/250' in f)
+                    self.assertFalse('galaxy/7/700000' in f)
+
+    def testfactory(self):
+        '''
+        Factory shim returns the same SEDs for either layout
+        '''
+        factory = DiffskySedFactory(self._tmpdir.name, None, COSMOLOGY)
+        gid = self._galaxy_id[5]
+        fluxes = []
+        for layout in SED_LAYOUTS:
+            self._write(layout)
+            shim = StoreDiffskySedFactory(factory)
+            seds = shim.create(PIXEL, gid, 0.5, 0.51)
+            fluxes.append([seds[c](600.0)
+                           for c in ('bulge', 'disk', 'knots')])
+            for f in shim._files.values():
+                f.close()
+        np.testing.assert_allclose(fluxes[0], fluxes[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
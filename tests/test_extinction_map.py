@@ -0,0 +1,59 @@
+"""
+Unit tests for Milky Way E(B-V) from a HEALPix map of SFD values
+"""
+
+import unittest
+import os
+import tempfile
+import numpy as np
+import healpy
+from dustmaps.config import config as dustmaps_config
+from skycatalogs_creator.utils.creator_utils import MWExtinctionMap
+
+NSIDE = 16
+
+
+def _have_sfd():
+    sfd_dir = os.path.join(dustmaps_config['data_dir'] or '', 'sfd')
+    return all(os.path.exists(os.path.join(sfd_dir, f'SFD_dust_4096_{p}.fits'))
+               for p in ('ngp', 'sgp'))
+
+
+class ExtinctionMapTest(unittest.TestCase):
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def testsaved_map(self):
+        # If the HEALPix map has been saved, SFD maps are not needed
+        path = os.path.join(self._tmpdir.name, 'extinction',
+                            f'sfd_ebv_nside_{NSIDE}.npy')
+        os.makedirs(os.path.dirname(path))
+        saved = np.linspace(0.0, 1.0, healpy.nside2npix(NSIDE),
+                            dtype=np.float32)
+        np.save(path, saved)
+        ext_map = MWExtinctionMap('healpix', NSIDE, self._tmpdir.name)
+        ipix = np.array([0, 100, 3000])
+        ra, dec = healpy.pix2ang(NSIDE, ipix, lonlat=True)
+        np.testing.assert_array_equal(ext_map.ebv(ra, dec), saved[ipix])
+        self.assertIsNone(ext_map._sfd)
+
+    @unittest.skipUnless(_have_sfd(), 'SFD dust maps not available')
+    def testcompare_exact(self):
+        exact = MWExtinctionMap('exact')
+        self.assertIsNone(exact._sfd)
+        healpix = MWExtinctionMap('healpix', NSIDE, self._tmpdir.name)
+        self.assertTrue(os.path.exists(os.path.join(
+            self._tmpdir.name, 'extinction', f'sfd_ebv_nside_{NSIDE}.npy')))
+
+        # At pixel centers the map has exact values, to float32 precision
+        ra, dec = healpy.pix2ang(NSIDE, np.arange(healpy.nside2npix(NSIDE)),
+                                 lonlat=True)
+        np.testing.assert_array_equal(healpix.ebv(ra, dec),
+                                      exact.ebv(ra, dec).astype(np.float32))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,168 @@
+"""
+Unit tests for FluxWorkerPool, using a stand-in sky catalog and a
+trivial chunk function
+"""
+
+import unittest
+import os
+import time
+import logging
+import numpy as np
+from concurrent.futures import TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from skycatalogs_creator.flux_worker_pool import FluxWorkerPool
+from skycatalogs_creator.flux_worker_pool import _SharedColumns
+
+FLUX_COLUMNS = ['lsst_flux_u', 'lsst_flux_g']
+N_PROC = 3
+
+
+class _ObjectList:
+    def __init__(self, pixel):
+        self._pixel = pixel
+
+    def get_collections(self):
+        return [f'{self._pixel}_{rg}' for rg in range(3)]
+
+
+class _SkyCatalog:
+    def get_object_type_by_hp(self, pixel, object_type):
+        return _ObjectList(pixel)
+
+
+def _expected_flux(n_obj, scale):
+    vals = scale * np.arange(n_obj, dtype=np.float32)
+    vals[::7] = np.nan
+    return vals
+
+
+def _dummy_chunk(send_conn, collection, instrument_needed, l_bnd, u_bnd,
+                 delay=0.0):
+    # Later chunks finish first, so results arrive out of order
+    time.sleep(delay / (1 + l_bnd))
+    out_dict = {'id': np.array([f'{collection}_{i}'
+                                for i in range(l_bnd, u_bnd)])}
+    for scale, col in enumerate(FLUX_COLUMNS, start=1):
+        out_dict[col] = _expected_flux(u_bnd, scale)[l_bnd:]
+    return out_dict
+
+
+def _failing_chunk(send_conn, collection, instrument_needed, l_bnd, u_bnd,
+                   action):
+    if l_bnd == 0:
+        if action == 'exit':
+            os._exit(1)
+        if action == 'hang':
+            time.sleep(60)
+        raise ValueError(f'Bad chunk {l_bnd}')
+    return _dummy_chunk(send_conn, collection, instrument_needed, l_bnd,
+                        u_bnd)
+
+
+class FluxWorkerPoolTest(unittest.TestCase):
+    def setUp(self):
+        self._pool = FluxWorkerPool(N_PROC, _SkyCatalog(),
+                                    logging.getLogger('test_flux_pool'),
+                                    chunk_size=10)
+
+    def tearDown(self):
+        self._pool.close()
+
+    def testround_trip(self):
+        n_obj = 95
+        with self._pool.compute(_dummy_chunk, 'galaxy', 9, 1, n_obj, ['lsst'],
+                                FLUX_COLUMNS, extra_args=(0.2,),
+                                timeout=10) as out_dict:
+            self.assertEqual(list(out_dict['id']),
+                             [f'9_1_{i}' for i in range(n_obj)])
+            for scale, col in enumerate(FLUX_COLUMNS, start=1):
+                expected = _expected_flux(n_obj, scale)
+                vals = out_dict[col]
+                self.assertEqual(len(vals), n_obj)
+                # NaN is stored as null
+                self.assertEqual(vals.null_count,
+                                 np.count_nonzero(np.isnan(expected)))
+                np.testing.assert_array_equal(
+                    vals.to_numpy(zero_copy_only=False), expected)
+            # No references to flux columns may outlive the with block
+            del vals
+
+    def testchunk_size(self):
+        self.assertEqual(self._pool.n_proc, N_PROC)
+        # Max. is chunk_size, but every worker gets some if possible
+        self.assertEqual(self._pool.chunk_size(95), 10)
+        self.assertEqual(self._pool.chunk_size(30), 10)
+        self.assertEqual(self._pool.chunk_size(12), 4)
+        self.assertEqual(self._pool.chunk_size(2), 1)
+        self.assertEqual(self._pool.chunk_size(0), 1)
+
+    def testfew_objects(self):
+        n_obj = N_PROC - 1
+        with self._pool.compute(_dummy_chunk, 'galaxy', 3, 2, n_obj, ['lsst'],
+                                FLUX_COLUMNS) as out_dict:
+            self.assertEqual(list(out_dict['id']), ['3_2_0', '3_2_1'])
+            vals = out_dict[FLUX_COLUMNS[1]]
+            self.assertEqual(vals.null_count, 1)
+            self.assertEqual(vals[1].as_py(), 2.0)
+            del vals
+
+    def testutilization(self):
+        for rg in range(3):
+            with self._pool.compute(_dummy_chunk, 'galaxy', 9, rg, 60,
+                                    ['lsst'], FLUX_COLUMNS,
+                                    extra_args=(0.05,)):
+                pass
+        busy = dict(self._pool._busy)
+        wall = self._pool._wall
+        self.assertGreater(wall, 0.05)
+        self.assertLessEqual(len(busy), N_PROC)
+        self.assertGreater(sum(busy.values()), 0.05)
+        for t in busy.values():
+            self.assertGreater(t, 0.0)
+            self.assertLessEqual(t, wall)
+
+        with self.assertLogs('test_flux_pool', level='INFO') as cm:
+            self._pool.close()
+        self.assertIn('All row groups: worker utilization', cm.output[-1])
+        self.assertEqual(self._pool._busy, dict())
+        self.assertEqual(self._pool._wall, 0.0)
+
+    def _compute_failing(self, action, timeout=None):
+        with self._pool.compute(_failing_chunk, 'galaxy', 9, 0, 50, ['lsst'],
+                                FLUX_COLUMNS, extra_args=(action,),
+                                timeout=timeout):
+            pass
+
+    def testworker_error(self):
+        with self.assertRaises(ValueError):
+            self._compute_failing('raise')
+        # The pool is still usable
+        with self._pool.compute(_dummy_chunk, 'galaxy', 9, 0, 20, ['lsst'],
+                                FLUX_COLUMNS) as out_dict:
+            self.assertEqual(len(out_dict['id']), 20)
+
+    def testworker_exit(self):
+        with self.assertRaises(BrokenProcessPool):
+            self._compute_failing('exit')
+
+    def testtimeout(self):
+        start = time.monotonic()
+        with self.assertRaises(TimeoutError):
+            self._compute_failing('hang', timeout=1)
+        # Don't wait for the stuck worker
+        self._pool.close(terminate=True)
+        self.assertLess(time.monotonic() - start, 30)
+
+    def testrelease(self):
+        shared = _SharedColumns(FLUX_COLUMNS, 5)
+        kept = shared.arrays()[FLUX_COLUMNS[0]]
+        # Memory an array still uses must not be unmapped
+        with self.assertRaises(BufferError):
+            shared.release()
+        self.assertEqual(len(kept.to_numpy(zero_copy_only=False)), 5)
+        del kept
+        shared.release()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+"""
+Unit tests comparing fluxes computed by SsoFluxEngine to those computed
+by galsim one observation at a time
+"""
+
+import unittest
+import os
+import tempfile
+import numpy as np
+from skycatalogs.utils.sed_tools import SsoSedFactory, normalize_sed
+from skycatalogs.objects.base_object import load_lsst_bandpasses
+from skycatalogs_creator.utils.sso_flux_utils import SsoFluxEngine
+from skycatalogs_creator.utils.sso_flux_utils import SSO_FLUX_TOLERANCE
+
+
+class SsoFluxCompare(unittest.TestCase):
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        # Roughly solar SED; wavelengths in angstroms
+        path = os.path.join(self._tmpdir.name, 'solar_sed.txt')
+        wl = np.linspace(2000.0, 12000.0, 2001)
+        flambda = wl**-5 / (np.exp(1.44e8/(wl*5800.0)) - 1)
+        np.savetxt(path, np.c_[wl, flambda/flambda.max()])
+        self._sed = SsoSedFactory(sed_path=path).create()
+        self._bandpasses = {f'lsst_flux_{b}': bp
+                            for b, bp in load_lsst_bandpasses().items()}
+        rng = np.random.default_rng(2718)
+        self._magnorm = rng.uniform(15.0, 25.0, 10)
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def testcompare_galsim(self):
+        engine = SsoFluxEngine(self._sed, self._bandpasses)
+        self.assertEqual(engine.band_names, list(self._bandpasses.keys()))
+        fluxes = engine.compute(self._magnorm)
+        self.assertEqual(fluxes.shape, (len(self._magnorm), 6))
+        for i, magnorm in enumerate(self._magnorm):
+            sed = normalize_sed(self._sed, magnorm)
+            ref = [sed.calculateFlux(bp) for bp in self._bandpasses.values()]
+            np.testing.assert_allclose(fluxes[i], ref,
+                                       rtol=SSO_FLUX_TOLERANCE)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,218 @@
+"""
+Unit tests for writing sso main files
+"""
+
+import unittest
+import os
+import json
+import sqlite3
+import logging
+import tempfile
+from types import SimpleNamespace
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import skycatalogs_creator.sso_catalog_creator as sso_catalog_creator
+from skycatalogs_creator.sso_catalog_creator import SsoMainCatalogCreator
+from skycatalogs_creator.sso_catalog_creator import _SsoPixelWriter
+from skycatalogs_creator.sso_catalog_creator import mjd_index_path
+
+SCHEMA = pa.schema([pa.field('id', pa.string()),
+                    pa.field('mjd', pa.float64()),
+                    pa.field('ra', pa.float64()),
+                    pa.field('dec', pa.float64())])
+ROW_GROUP_SIZE = 100
+N_DB_FILES = 3
+HEALPIXELS = [10, 11, 12]
+
+
+def _make_db(path, rng, n_obj, id_start):
+    with sqlite3.connect(path) as conn:
+        conn.execute('''create table results (ObjID integer,
+                     fieldMJD_TAI real, RA_deg real, Dec_deg real,
+                     RARateCosDec_deg_day real, DecRate_deg_day real,
+                     trailedSourceMag real, healpix integer)''')
+        # Few distinct mjd values, so that there are many ties within and
+        # among files
+        rows = zip(range(id_start, id_start + n_obj),
+                   60000.0 + 0.5 * rng.integers(0, 20, n_obj),
+                   rng.uniform(50.0, 60.0, n_obj),
+                   rng.uniform(-40.0, -30.0, n_obj),
+                   rng.normal(0.0, 0.1, n_obj), rng.normal(0.0, 0.1, n_obj),
+                   rng.uniform(18.0, 24.0, n_obj),
+                   rng.choice(HEALPIXELS, n_obj))
+        conn.executemany('insert into results values (?, ?, ?, ?, ?, ?, ?, ?)',
+                         [tuple(float(v) if isinstance(v, np.floating)
+                                else int(v) for v in r) for r in rows])
+    conn.close()
+
+
+def _make_table(rng, n_obj, mjd_start):
+    return pa.table({'id': [str(i) for i in range(n_obj)],
+                     'mjd': mjd_start + np.sort(rng.uniform(0.0, 1.0, n_obj)),
+                     'ra': rng.uniform(50.0, 60.0, n_obj),
+                     'dec': rng.uniform(-40.0, -30.0, n_obj)},
+                    schema=SCHEMA)
+
+
+class SsoMainTest(unittest.TestCase):
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def _make_creator(self, output_name, sso_shard=False):
+        output_dir = os.path.join(self._tmpdir.name, output_name)
+        os.makedirs(output_dir, exist_ok=True)
+        creator = SimpleNamespace(_output_dir=output_dir,
+                                  _logger=logging.getLogger('test_sso'),
+                                  _truth=self._truth, _sso_shard=sso_shard,
+                                  _parts=[],
+                                  _cache_dir=os.path.join(self._tmpdir.name,
+                                                          'cache'))
+        sso_creator = SsoMainCatalogCreator(creator)
+        sso_creator._row_group_size = 40
+        return sso_creator
+
+    def _make_dbs(self):
+        self._truth = os.path.join(self._tmpdir.name, 'truth')
+        os.makedirs(self._truth)
+        rng = np.random.default_rng(21)
+        db_files = []
+        for i in range(N_DB_FILES):
+            path = os.path.join(self._truth, f'sso_{i}.db')
+            _make_db(path, rng, 300, 1000 * i)
+            db_files.append(path)
+        return db_files
+
+    def testshard(self):
+        db_files = self._make_dbs()
+
+        # Small batches, to exercise merging of ties across batches, and
+        # spills
+        saved = (sso_catalog_creator._SHARD_FETCH_ROWS,
+                 sso_catalog_creator._SHARD_SPILL_ROWS)
+        sso_catalog_creator._SHARD_FETCH_ROWS = 7
+        sso_catalog_creator._SHARD_SPILL_ROWS = 100
+        try:
+            by_pixel = self._make_creator('by_pixel')
+            schema = by_pixel._create_main_schema()
+            hps_by_file = by_pixel._get_inventory(db_files)
+            self.assertEqual(set().union(*hps_by_file.values()),
+                             set(HEALPIXELS))
+            for hp in HEALPIXELS:
+                by_pixel._write_hp(hp, hps_by_file, schema)
+
+            sharded = self._make_creator('sharded', sso_shard=True)
+            written = sharded._shard_db_files(db_files, schema)
+        finally:
+            (sso_catalog_creator._SHARD_FETCH_ROWS,
+             sso_catalog_creator._SHARD_SPILL_ROWS) = saved
+        self.assertEqual(written, HEALPIXELS)
+
+        n_total = 0
+        for hp in HEALPIXELS:
+            paths = [os.path.join(c._output_dir, f'sso_{hp}.parquet')
+                     for c in (by_pixel, sharded)]
+            tables = [pq.read_table(p) for p in paths]
+            self.assertTrue(tables[0].equals(tables[1]))
+            n_total += tables[0].num_rows
+
+            # Rows are sorted by mjd, then id
+            mjd = tables[0]['mjd'].to_numpy()
+            ids = tables[0]['id'].to_pylist()
+            keys = list(zip(mjd, ids))
+            self.assertEqual(keys, sorted(keys))
+
+            metas = [pq.read_metadata(p) for p in paths]
+            self.assertEqual(
+                [metas[0].row_group(rg).num_rows
+                 for rg in range(metas[0].num_row_groups)],
+                [metas[1].row_group(rg).num_rows
+                 for rg in range(metas[1].num_row_groups)])
+            sidecars = []
+            for p in paths:
+                with open(mjd_index_path(p)) as f:
+                    sidecars.append(json.load(f))
+            self.assertEqual(sidecars[0], sidecars[1])
+        self.assertEqual(n_total, N_DB_FILES * 300)
+
+    def _inventory(self, sso_creator, db_files):
+        with self.assertLogs('test_sso', level='INFO') as cm:
+            hps_by_file = sso_creator._get_inventory(db_files)
+        scanning = [m for m in cm.output if 'Scanning' in m]
+        self.assertEqual(len(scanning), 1)
+        return hps_by_file, scanning[0].split('Scanning ')[1]
+
+    def testinventory(self):
+        db_files = self._make_dbs()
+        sso_creator = self._make_creator('out')
+        hps_by_file, msg = self._inventory(sso_creator, db_files)
+        self.assertTrue(msg.startswith(f'{N_DB_FILES} of {N_DB_FILES} '))
+        manifests = os.listdir(os.path.join(self._tmpdir.name, 'cache',
+                                            'sso'))
+        self.assertEqual(len(manifests), 1)
+
+        # Nothing has changed, so the manifest is used
+        again, msg = self._inventory(self._make_creator('out'), db_files)
+        self.assertTrue(msg.startswith(f'0 of {N_DB_FILES} '))
+        self.assertEqual(again, hps_by_file)
+
+        # Add rows in a new healpixel to one file, and just change the
+        # modification time of another
+        size = os.path.getsize(db_files[0])
+        with sqlite3.connect(db_files[0]) as conn:
+            conn.executemany(
+                'insert into results values (?, ?, ?, ?, ?, ?, ?, ?)',
+                [(i, 60001.0, 55.0, -35.0, 0.0, 0.0, 20.0, 13)
+                 for i in range(5000, 5500)])
+        conn.close()
+        self.assertNotEqual(os.path.getsize(db_files[0]), size)
+        st = os.stat(db_files[1])
+        os.utime(db_files[1], ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+        rescanned, msg = self._inventory(self._make_creator('out'), db_files)
+        self.assertTrue(msg.startswith(f'2 of {N_DB_FILES} '))
+        self.assertEqual(rescanned[db_files[0]], hps_by_file[db_files[0]] | {13})
+        for f in db_files[1:]:
+            self.assertEqual(rescanned[f], hps_by_file[f])
+
+        # The updated manifest is used next time
+        _, msg = self._inventory(self._make_creator('out'), db_files)
+        self.assertTrue(msg.startswith(f'0 of {N_DB_FILES} '))
+
+    def testpixel_writer(self):
+        rng = np.random.default_rng(23)
+        sizes = [30, 0, 250, 1, 99, 100, 37]
+        tables = [_make_table(rng, n, 60000.0 + i)
+                  for i, n in enumerate(sizes)]
+        path = os.path.join(self._tmpdir.name, 'sso_7.parquet')
+        with _SsoPixelWriter(path, SCHEMA, ROW_GROUP_SIZE) as writer:
+            for tbl in tables:
+                writer.write(tbl)
+
+        n_total = sum(sizes)
+        pf = pq.ParquetFile(path)
+        meta = pf.metadata
+        self.assertEqual(meta.num_rows, n_total)
+        row_counts = [meta.row_group(rg).num_rows
+                      for rg in range(meta.num_row_groups)]
+        n_full = n_total // ROW_GROUP_SIZE
+        self.assertEqual(row_counts, [ROW_GROUP_SIZE] * n_full +
+                         [n_total - n_full * ROW_GROUP_SIZE])
+        self.assertTrue(pf.read().equals(pa.concat_tables(tables)))
+
+        with open(mjd_index_path(path)) as f:
+            index = json.load(f)['row_groups']
+        self.assertEqual(len(index), meta.num_row_groups)
+        i_mjd = SCHEMA.get_field_index('mjd')
+        for rg, entry in enumerate(index):
+            stats = meta.row_group(rg).column(i_mjd).statistics
+            self.assertEqual(entry['num_rows'], row_counts[rg])
+            self.assertEqual(entry['mjd_min'], stats.min)
+            self.assertEqual(entry['mjd_max'], stats.max)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+"""
+Unit tests for selecting row groups and rows of sso main files in an
+mjd window
+"""
+
+import unittest
+import os
+import logging
+import tempfile
+from types import SimpleNamespace
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from skycatalogs_creator.sso_catalog_creator import _SsoPixelWriter
+from skycatalogs_creator.sso_catalog_creator import _row_group_mjd_ranges
+from skycatalogs_creator.sso_catalog_creator import _window_row_groups
+from skycatalogs_creator.sso_catalog_creator import _window_rows
+from skycatalogs_creator.sso_catalog_creator import mjd_index_path
+from skycatalogs_creator.sso_catalog_creator import SsoFluxCatalogCreator
+
+SCHEMA = pa.schema([pa.field('id', pa.string()),
+                    pa.field('mjd', pa.float64()),
+                    pa.field('ra', pa.float64()),
+                    pa.field('dec', pa.float64())])
+PIXEL = 5
+ROW_GROUP_SIZE = 100
+MJD_MIN = 60002.5
+MJD_MAX = 60004.0
+
+
+class SsoWindowTest(unittest.TestCase):
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        rng = np.random.default_rng(60000)
+        n_obj = 1000
+        self._mjd = np.sort(rng.uniform(60000.0, 60010.0, n_obj))
+        tbl = pa.table({'id': [str(i) for i in range(n_obj)],
+                        'mjd': self._mjd,
+                        'ra': rng.uniform(50.0, 60.0, n_obj),
+                        'dec': rng.uniform(-40.0, -30.0, n_obj)})
+        self._path = os.path.join(self._tmpdir.name, f'sso_{PIXEL}.parquet')
+        with _SsoPixelWriter(self._path, SCHEMA, ROW_GROUP_SIZE) as writer:
+            writer.write(tbl)
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def testrow_groups(self):
+        ranges = _row_group_mjd_ranges(self._path)
+        self.assertEqual(len(ranges), 10)
+
+        # Without the sidecar, parquet statistics give the same ranges
+        os.remove(mjd_index_path(self._path))
+        self.assertEqual(_row_group_mjd_ranges(self._path), ranges)
+
+        active = _window_row_groups(ranges, MJD_MIN, MJD_MAX)
+        groups = np.arange(len(self._mjd)) // ROW_GROUP_SIZE
+        in_window = (self._mjd >= MJD_MIN) & (self._mjd < MJD_MAX)
+        self.assertEqual(active, sorted(set(groups[in_window])))
+        self.assertLess(len(active), len(ranges))
+
+        self.assertEqual(_window_row_groups(ranges, None, None),
+                         list(range(len(ranges))))
+        self.assertEqual(_window_row_groups(ranges, None, 59000.0), [])
+
+    def testrows(self):
+        ranges = _row_group_mjd_ranges(self._path)
+        pf = pq.ParquetFile(self._path)
+        selected = []
+        for rg in _window_row_groups(ranges, MJD_MIN, MJD_MAX):
+            mjd = pf.read_row_group(rg, columns=['mjd'])['mjd'].to_numpy()
+            rows = _window_rows(mjd, MJD_MIN, MJD_MAX)
+            self.assertIsInstance(rows, range)
+            selected.append(mjd[np.asarray(rows, dtype=int)])
+        selected = np.concatenate(selected)
+        in_window = (self._mjd >= MJD_MIN) & (self._mjd < MJD_MAX)
+        np.testing.assert_array_equal(selected, self._mjd[in_window])
+
+        # If rows in the window aren't contiguous an array is returned
+        rows = _window_rows(np.array([1.5, 0.5, 2.0, 3.0]), 1.0, 3.0)
+        self.assertIsInstance(rows, np.ndarray)
+        np.testing.assert_array_equal(rows, [0, 2])
+
+    def testmissing_pixel(self):
+        creator = SimpleNamespace(_output_dir=self._tmpdir.name,
+                                  _logger=logging.getLogger('test_sso'),
+                                  _mjd_window=(MJD_MIN, None))
+        sso_creator = SsoFluxCatalogCreator(creator)
+        self.assertEqual(list(sso_creator._window_collections(PIXEL + 2)),
+                         [])
+
+
+if __name__ == '__main__':
+    unittest.main()
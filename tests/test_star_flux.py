@@ -0,0 +1,76 @@
+"""
+Unit tests comparing fluxes computed by StarFluxCache to those computed
+by galsim one object at a time
+"""
+
+import unittest
+import os
+import tempfile
+import numpy as np
+import galsim
+from skycatalogs.utils.sed_tools import MilkyWayExtinction, normalize_sed
+from skycatalogs.objects.base_object import load_lsst_bandpasses
+from skycatalogs_creator.utils.star_flux_utils import StarFluxCache
+from skycatalogs_creator.utils.star_flux_utils import STAR_FLUX_TOLERANCE
+
+SED_NAMES = ['starSED/test/hot.txt', 'starSED/test/cool.txt']
+
+
+class StarFluxCompare(unittest.TestCase):
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self._sed_dir = os.path.join(self._tmpdir.name, 'seds')
+        self._cache_dir = os.path.join(self._tmpdir.name, 'cache')
+        wl = np.linspace(100.0, 1500.0, 2801)
+        for name, temp in zip(SED_NAMES, (15000.0, 4000.0)):
+            path = os.path.join(self._sed_dir, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            flambda = wl**-5 / (np.exp(1.44e7/(wl*temp)) - 1)
+            np.savetxt(path, np.c_[wl, flambda/flambda.max()])
+
+        self._extinguisher = MilkyWayExtinction()
+        self._bandpasses = {f'lsst_flux_{b}': bp
+                            for b, bp in load_lsst_bandpasses().items()}
+        rng = np.random.default_rng(1618)
+        n_obj = 10
+        self._sed_filepath = np.array(SED_NAMES)[rng.integers(0, 2, n_obj)]
+        self._magnorm = rng.uniform(15.0, 25.0, n_obj)
+        self._av = rng.uniform(0.0, 3.0, n_obj)
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def _make_cache(self):
+        return StarFluxCache(self._extinguisher, self._bandpasses,
+                             self._sed_dir, cache_dir=self._cache_dir)
+
+    def testcompare_galsim(self):
+        fluxes = self._make_cache().compute(self._sed_filepath,
+                                            self._magnorm, self._av)
+        for i in range(len(self._magnorm)):
+            sed = galsim.SED(os.path.join(self._sed_dir,
+                                          self._sed_filepath[i]),
+                             wave_type='nm', flux_type='flambda')
+            sed = normalize_sed(sed, self._magnorm[i])
+            sed = self._extinguisher.extinguish(sed, self._av[i])
+            ref = [sed.calculateFlux(bp) for bp in self._bandpasses.values()]
+            np.testing.assert_allclose(fluxes[i], ref,
+                                       rtol=STAR_FLUX_TOLERANCE)
+
+    def testpersist(self):
+        flux_cache = self._make_cache()
+        fluxes = flux_cache.compute(self._sed_filepath, self._magnorm,
+                                    self._av)
+        flux_cache.save()
+        self.assertTrue(os.path.exists(flux_cache.cache_path))
+
+        # A new cache gets weights from the file rather than the SEDs
+        for name in SED_NAMES:
+            os.remove(os.path.join(self._sed_dir, name))
+        reread = self._make_cache().compute(self._sed_filepath,
+                                            self._magnorm, self._av)
+        np.testing.assert_array_equal(reread, fluxes)
+
+
+if __name__ == '__main__':
+    unittest.main()
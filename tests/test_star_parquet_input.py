@@ -0,0 +1,144 @@
+"""
+Unit tests for reading stars in a healpix pixel from UW star files,
+skipping row groups which can't contain any
+"""
+
+import unittest
+import os
+import tempfile
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import healpy
+from esutil.htm import HTM
+from skycatalogs_creator.utils.star_parquet_input import UWStarFiles
+from skycatalogs_creator.utils.star_parquet_input import _star_parquet_reader
+from skycatalogs_creator.utils.star_parquet_input import _pixel_bounds
+
+NSIDE = 4
+ROW_GROUP_SIZE = 200
+
+# HTM ids at depth 20 are in [8 * 4**20, 16 * 4**20)
+HTM_MIN = 8 * 4**20
+HTM_MAX = 16 * 4**20 - 1
+
+
+class StarParquetInputTest(unittest.TestCase):
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self._input_dir = os.path.join(self._tmpdir.name, 'uw')
+        self._cache_dir = os.path.join(self._tmpdir.name, 'cache')
+        os.makedirs(self._input_dir)
+
+        rng = np.random.default_rng(32)
+        n_obj = 20000
+        ra = rng.uniform(0.0, 360.0, n_obj)
+        dec = np.degrees(np.arcsin(rng.uniform(-1.0, 1.0, n_obj)))
+        # Extra stars near ra = 0 and the poles
+        ra[:2000] = rng.uniform(-3.0, 3.0, 2000) % 360.0
+        dec[2000:3000] = rng.uniform(80.0, 90.0, 1000)
+        dec[3000:4000] = rng.uniform(-90.0, -80.0, 1000)
+        htm_id = HTM(depth=20).lookup_id(ra, dec)
+        stars = pa.table({'simobjid': np.arange(n_obj, dtype=np.int64),
+                          'ra': ra, 'decl': dec,
+                          'mura': rng.normal(0.0, 1.0, n_obj),
+                          'mudecl': rng.normal(0.0, 1.0, n_obj),
+                          'vrad': rng.normal(0.0, 1.0, n_obj),
+                          'parallax': rng.uniform(0.0, 1.0, n_obj),
+                          'sedfilename': pa.array(['sed.txt'] * n_obj),
+                          'flux_scale': rng.uniform(1e-14, 1e-10, n_obj),
+                          'ebv': rng.uniform(0.0, 0.1, n_obj)})
+
+        # Two files.  Rows of one are sorted by decl and of the other
+        # by ra, so that statistics of each prune row groups
+        middle = (HTM_MIN + HTM_MAX) // 2
+        self._all = []
+        for imin, imax, key in ((HTM_MIN, middle, 'decl'),
+                                (middle + 1, HTM_MAX, 'ra')):
+            tbl = stars.filter(pa.array((htm_id >= imin) & (htm_id <= imax)))
+            tbl = tbl.sort_by(key)
+            pq.write_table(tbl, os.path.join(
+                self._input_dir, f'stars_chunk_{imin}_{imax}.parquet'),
+                row_group_size=ROW_GROUP_SIZE)
+            self._all.append(tbl)
+        self._all = pa.concat_tables(self._all)
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def _expected(self, pixel):
+        in_pix = healpy.ang2pix(NSIDE, self._all['ra'].to_numpy(),
+                                self._all['decl'].to_numpy(), lonlat=True)
+        tbl = self._all.filter(pa.array(in_pix == pixel))
+        return tbl.sort_by('simobjid')
+
+    def testpixel_bounds(self):
+        # Pixel centered on ra = 0
+        wrap = healpy.ang2pix(NSIDE, 0.0, 30.0, lonlat=True)
+        north = healpy.ang2pix(NSIDE, 0.0, 90.0, lonlat=True)
+        south = healpy.ang2pix(NSIDE, 0.0, -90.0, lonlat=True)
+        for pixel in (wrap, north, south):
+            ra_min, ra_max, dec_min, dec_max = _pixel_bounds(pixel, NSIDE)
+            self.assertIsNone(ra_min)
+            self.assertIsNone(ra_max)
+        self.assertGreater(_pixel_bounds(north, NSIDE)[3], 89.9)
+        self.assertLess(_pixel_bounds(south, NSIDE)[2], -89.9)
+
+    def testsame_rows(self):
+        uw_files = UWStarFiles(self._input_dir, cache_dir=self._cache_dir)
+        # Pixels straddling ra = 0, polar pixels and some others
+        wrap = healpy.ang2pix(NSIDE, np.zeros(3),
+                              np.array([30.0, 9.6, -30.0]), lonlat=True)
+        north = healpy.ang2pix(NSIDE, 0.0, 90.0, lonlat=True)
+        south = healpy.ang2pix(NSIDE, 0.0, -90.0, lonlat=True)
+        pixels = list(wrap) + [north, south, 17, 100, 150]
+        n_skipped = 0
+        for pixel in pixels:
+            expected = self._expected(pixel)
+            self.assertGreater(expected.num_rows, 0)
+            if pixel in wrap:
+                ra = expected['ra'].to_numpy()
+                self.assertTrue(np.any(ra < 1.0) and np.any(ra > 359.0))
+            read_stats = {}
+            got = _star_parquet_reader(self._input_dir, pixel, None,
+                                       nside=NSIDE, read_stats=read_stats,
+                                       cache_dir=self._cache_dir)
+            order = np.argsort(got['id'].astype(np.int64))
+            np.testing.assert_array_equal(
+                got['id'][order].astype(np.int64),
+                expected['simobjid'].to_numpy())
+            for col, name in (('ra', 'ra'), ('decl', 'dec'),
+                              ('mudecl', 'mudec'),
+                              ('vrad', 'radial_velocity'),
+                              ('parallax', 'parallax'), ('ebv', 'ebv')):
+                np.testing.assert_array_equal(got[name][order],
+                                              expected[col].to_numpy())
+
+            # Every row group of the pixel's files is either read or
+            # skipped, and skipped ones have no rows in the pixel
+            paths = uw_files.find_files(pixel, NSIDE)
+            total_groups = sum(pq.ParquetFile(f).num_row_groups
+                               for f in paths)
+            n_read = read_stats['row_groups_read']
+            self.assertEqual(n_read + read_stats['row_groups_skipped'],
+                             total_groups)
+            self.assertGreaterEqual(n_read,
+                                    self._groups_with_rows(paths, pixel))
+            self.assertGreater(read_stats['bytes_read'], 0)
+            n_skipped += read_stats['row_groups_skipped']
+        self.assertGreater(n_skipped, 0)
+
+    def _groups_with_rows(self, paths, pixel):
+        n = 0
+        for f in paths:
+            pf = pq.ParquetFile(f)
+            for rg in range(pf.num_row_groups):
+                tbl = pf.read_row_group(rg, columns=['ra', 'decl'])
+                in_pix = healpy.ang2pix(NSIDE, tbl['ra'].to_numpy(),
+                                        tbl['decl'].to_numpy(), lonlat=True)
+                n += int(np.any(in_pix == pixel))
+        return n
+
+
+if __name__ == '__main__':
+    unittest.main()
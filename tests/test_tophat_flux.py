@@ -0,0 +1,67 @@
+"""
+Unit tests comparing fluxes computed by TophatFluxEngine to those computed
+by galsim one object at a time
+"""
+
+import unittest
+import numpy as np
+from skycatalogs.utils.sed_tools import TophatSedFactory, MilkyWayExtinction
+from skycatalogs.objects.base_object import load_lsst_bandpasses
+from skycatalogs_creator.utils.tophat_utils import TophatFluxEngine
+from skycatalogs_creator.utils.tophat_utils import TOPHAT_FLUX_TOLERANCE
+
+# cosmoDC2 tophat bins, [start, width] in angstroms
+SED_BINS = [[1000, 246], [1246, 306], [1552, 381], [1933, 474],
+            [2407, 591], [2998, 186], [3184, 197], [3381, 209],
+            [3590, 222], [3812, 236], [4048, 251], [4299, 266],
+            [4565, 283], [4848, 300], [5148, 319], [5467, 339],
+            [5806, 360], [6166, 382], [6548, 406], [6954, 431],
+            [7385, 458], [7843, 486], [8329, 517], [8846, 549],
+            [9395, 582], [9977, 619], [10596, 658], [11254, 698],
+            [11952, 741], [12693, 787]]
+COSMOLOGY = {'H0': 71.0, 'Om0': 0.2648, 'Ob0': 0.0448, 'sigma8': 0.8,
+             'n_s': 0.963}
+
+
+class TophatFluxCompare(unittest.TestCase):
+    def setUp(self):
+        self._factory = TophatSedFactory(SED_BINS, COSMOLOGY)
+        self._extinguisher = MilkyWayExtinction()
+        bandpasses = load_lsst_bandpasses()
+        self._bandpasses = {f'lsst_flux_{b}': bp
+                            for b, bp in bandpasses.items()}
+        self._engine = TophatFluxEngine(self._factory, self._extinguisher,
+                                        self._bandpasses)
+        rng = np.random.default_rng(2718)
+        n_obj = 20
+        self._sed_vals = rng.uniform(0.0, 5.0e-3,
+                                     size=(n_obj, len(SED_BINS)))
+        self._sed_vals[0, :] = 0.0
+        self._z = rng.uniform(0.01, 3.0, size=n_obj)
+        self._z_H = self._z - rng.uniform(0.0, 0.005, size=n_obj)
+        self._av = rng.uniform(0.0, 0.9, size=n_obj)
+        self._mu = rng.uniform(0.9, 1.1, size=n_obj)
+
+    def testcompare_galsim(self):
+        fluxes = self._engine.compute(self._sed_vals, self._z, self._z_H,
+                                      self._av, self._mu)
+        self.assertEqual(fluxes.shape, (len(self._z), len(self._bandpasses)))
+        np.testing.assert_array_equal(fluxes[0], 0.0)
+        for i in range(1, len(self._z)):
+            sed = self._factory.create(self._sed_vals[i], self._z_H[i],
+                                       self._z[i])
+            sed = self._extinguisher.extinguish(sed, self._av[i]) * self._mu[i]
+            ref = [sed.calculateFlux(bp) for bp in self._bandpasses.values()]
+            np.testing.assert_allclose(fluxes[i], ref,
+                                       rtol=TOPHAT_FLUX_TOLERANCE)
+
+    def testout_of_range(self):
+        av = np.array([0.1, 5.0])
+        fluxes = self._engine.compute(self._sed_vals[1:3], self._z[1:3],
+                                      self._z_H[1:3], av, self._mu[1:3])
+        self.assertTrue(np.all(np.isfinite(fluxes[0])))
+        self.assertTrue(np.all(np.isnan(fluxes[1])))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+"""
+Unit tests comparing batch tophat magnorm computation to the scalar
+computation done by TophatSedFactory.magnorm
+"""
+
+import unittest
+import numpy as np
+from skycatalogs.utils.sed_tools import TophatSedFactory
+from skycatalogs_creator.utils.tophat_utils import batch_magnorm
+from skycatalogs_creator.utils.tophat_utils import compare_magnorm
+from skycatalogs_creator.utils.tophat_utils import MAGNORM_TOLERANCE
+
+# Subset of the cosmoDC2 tophat bins, [start, width] in angstroms
+SED_BINS = [[1000, 246], [1246, 306], [1552, 381], [1933, 474],
+            [2407, 591], [2998, 186], [3184, 197], [3381, 209],
+            [3590, 222], [3812, 236], [4048, 251], [4299, 266],
+            [4565, 283], [4848, 300], [5148, 319], [5467, 339],
+            [5806, 360], [6166, 382], [6548, 406], [6954, 431]]
+COSMOLOGY = {'H0': 71.0, 'Om0': 0.2648, 'Ob0': 0.0448, 'sigma8': 0.8,
+             'n_s': 0.963}
+
+
+class TophatMagnormCompare(unittest.TestCase):
+    def setUp(self):
+        self._factory = TophatSedFactory(SED_BINS, COSMOLOGY)
+        rng = np.random.default_rng(31415)
+        n_obj = 500
+        self._sed_vals = rng.uniform(0.0, 5.0, size=(n_obj, len(SED_BINS)))
+        # Include some objects with no flux at 500 nm
+        self._sed_vals[:5, :] = 0.0
+        self._z_H = rng.uniform(0.01, 3.0, size=n_obj)
+
+    def testcompare_magnorm(self):
+        batch = batch_magnorm(self._factory, self._sed_vals, self._z_H)
+        self.assertEqual(len(batch), len(self._z_H))
+        diff = compare_magnorm(self._factory, self._sed_vals, self._z_H,
+                               magnorm=batch)
+        self.assertLessEqual(diff, MAGNORM_TOLERANCE)
+
+    def testempty(self):
+        batch = batch_magnorm(self._factory, np.zeros((0, len(SED_BINS))),
+                              np.zeros(0))
+        self.assertEqual(len(batch), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+"""
+Unit tests for finding the UW star files covering a healpix pixel
+"""
+
+import unittest
+import os
+import tempfile
+import numpy as np
+import healpy
+from esutil.htm import HTM
+from skycatalogs_creator.utils.star_parquet_input import UWStarFiles
+
+NSIDE = 8
+RES_FACTOR = 4
+N_FILES = 50
+
+# HTM ids at depth 20 are in [8 * 4**20, 16 * 4**20)
+HTM_MIN = 8 * 4**20
+HTM_MAX = 16 * 4**20 - 1
+
+
+def _query_polygon_files(paths_by_range, pixel, nside, res_factor):
+    '''
+    Files for pixel found by sampling subpixels inside its boundary, as
+    the original implementation did
+    '''
+    corners = np.transpose(healpy.boundaries(nside, pixel))
+    subpixels = healpy.query_polygon(nside * res_factor, corners)
+    ra, dec = healpy.pix2ang(nside * res_factor, subpixels, lonlat=True)
+    files = set()
+    for index in set(HTM(depth=20).lookup_id(ra, dec)):
+        for (imin, imax), item in paths_by_range.items():
+            if imin <= index <= imax:
+                files.add(item)
+    return files
+
+
+class UWStarFilesTest(unittest.TestCase):
+    def setUp(self):
+        self._tmpdir = tempfile.TemporaryDirectory()
+        self._input_dir = os.path.join(self._tmpdir.name, 'uw')
+        self._cache_dir = os.path.join(self._tmpdir.name, 'cache')
+        os.makedirs(self._input_dir)
+        # Only file names are used to find files.  Leave gaps between
+        # some ranges so not every position is covered
+        rng = np.random.default_rng(20)
+        edges = np.unique(rng.integers(HTM_MIN, HTM_MAX, 2 * N_FILES))
+        edges = edges[:len(edges) // 2 * 2]
+        self._paths_by_range = dict()
+        for imin, imax in edges.reshape(-1, 2):
+            path = os.path.join(self._input_dir,
+                                f'stars_chunk_{imin}_{imax}.parquet')
+            open(path, 'w').close()
+            self._paths_by_range[(int(imin), int(imax))] = path
+
+    def tearDown(self):
+        self._tmpdir.cleanup()
+
+    def testfind_files(self):
+        uw_files = UWStarFiles(self._input_dir, cache_dir=self._cache_dir)
+        for pixel in range(healpy.nside2npix(NSIDE)):
+            self.assertEqual(
+                uw_files.find_files(pixel, NSIDE, RES_FACTOR),
+                _query_polygon_files(self._paths_by_range, pixel, NSIDE,
+                                     RES_FACTOR))
+        cached = os.listdir(os.path.join(self._cache_dir, 'uw_stars'))
+        self.assertEqual(len(cached), 1)
+
+    def testres_factor(self):
+        uw_files = UWStarFiles(self._input_dir, cache_dir=self._cache_dir)
+        with self.assertRaises(ValueError):
+            uw_files.find_files(0, NSIDE, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()